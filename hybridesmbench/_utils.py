@@ -1,13 +1,24 @@
 """Provide utility functions for HybridESMBench."""
 
+import contextlib
+import functools
+import hashlib
 import importlib
 import inspect
-from collections.abc import Callable
+import threading
+import warnings
+from collections.abc import Callable, Iterator
 from pathlib import Path
 from typing import Any
 
-from esmvalcore.preprocessor import extract_levels
-from iris import Constraint
+import cftime
+import iris
+import iris.analysis.cartography
+import iris.common.lenient
+import numpy as np
+from esmvalcore.preprocessor import distance_metric, extract_levels
+from iris.common.lenient import LENIENT
+from iris.coords import CellMeasure
 from iris.cube import Cube
 from loguru import logger
 
@@ -36,6 +47,154 @@ PLEV_19_LEVELS: list[float] = [
 ]
 
 
+# Cell areas of regular grids and reference grids that have already been
+# validated (shared by all threads of the process)
+_CELL_AREAS: dict[str, CellMeasure] = {}
+_VALIDATED_REFERENCES: set[tuple[str, int, int, str]] = set()
+_REFERENCE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=64)
+def _load_reference(path: str, size: int, mtime_ns: int) -> Cube:
+    """Load and realize reference dataset (once per process).
+
+    `size` and `mtime_ns` are only used to invalidate the cache when the file
+    changes.
+
+    """
+    logger.debug(f"Loading reference dataset {path}")
+    ref_cube = iris.load_cube(path)
+    ref_cube.data  # realize data so that it is read only once
+    return ref_cube
+
+
+def _get_grid_key(cube: Cube) -> str | None:
+    """Get hash of regular horizontal grid of cube (`None` if irregular)."""
+    lat = cube.coords("latitude", dim_coords=True)
+    lon = cube.coords("longitude", dim_coords=True)
+    if not lat or not lon:
+        return None
+    grid_hash = hashlib.sha256()
+    for coord in (lat[0], lon[0]):
+        grid_hash.update(str(coord.units).encode())
+        grid_hash.update(np.ascontiguousarray(coord.points).tobytes())
+        if coord.has_bounds():
+            grid_hash.update(np.ascontiguousarray(coord.bounds).tobytes())
+    return grid_hash.hexdigest()
+
+
+def _get_cell_area(cube: Cube, grid_key: str) -> CellMeasure:
+    """Get cell areas of regular horizontal grid (once per grid)."""
+    with _REFERENCE_LOCK:
+        if grid_key in _CELL_AREAS:
+            return _CELL_AREAS[grid_key]
+    lat = cube.coord("latitude", dim_coords=True).copy()
+    lon = cube.coord("longitude", dim_coords=True).copy()
+    for coord in (lat, lon):
+        if not coord.has_bounds():
+            coord.guess_bounds()
+    grid_cube = Cube(
+        np.zeros((lat.shape[0], lon.shape[0]), dtype=np.float32),
+        dim_coords_and_dims=[(lat, 0), (lon, 1)],
+    )
+    with warnings.catch_warnings():
+        warnings.filterwarnings(
+            "ignore",
+            message="Using DEFAULT_SPHERICAL_EARTH_RADIUS",
+            category=UserWarning,
+            module="iris",
+        )
+        area = iris.analysis.cartography.area_weights(grid_cube)
+    cell_area = CellMeasure(
+        area,
+        standard_name="cell_area",
+        units="m2",
+        measure="area",
+    )
+    logger.debug(f"Calculated cell areas of {area.shape} grid")
+    with _REFERENCE_LOCK:
+        return _CELL_AREAS.setdefault(grid_key, cell_area)
+
+
+def _validate_reference(
+    cube: Cube,
+    ref_cube: Cube,
+    ref_key: tuple[str, int, int],
+    grid_key: str | None,
+) -> None:
+    """Check that reference dataset is on grid of data (once per grid)."""
+    if grid_key is not None:
+        with _REFERENCE_LOCK:
+            if (*ref_key, grid_key) in _VALIDATED_REFERENCES:
+                return
+    for coord_name in ("latitude", "longitude"):
+        coord = cube.coord(coord_name)
+        ref_coord = ref_cube.coord(coord_name)
+        if coord.shape != ref_coord.shape or not np.allclose(
+            coord.core_points(), ref_coord.core_points()
+        ):
+            msg = (
+                f"Reference dataset {ref_key[0]} is not given on the same "
+                f"horizontal grid as variable '{cube.var_name}' ({coord_name} "
+                f"differs)"
+            )
+            raise HybridESMBenchException(msg)
+    if grid_key is not None:
+        with _REFERENCE_LOCK:
+            _VALIDATED_REFERENCES.add((*ref_key, grid_key))
+
+
+def distance_to_reference(
+    cube: Cube,
+    metric: str,
+    reference: str | Path,
+) -> Cube:
+    """Calculate distance metric between data and reference dataset.
+
+    Uses :func:`esmvalcore.preprocessor.distance_metric`. The reference
+    dataset is only read once per process and validated once per horizontal
+    grid. For regular grids, cell areas (used as weights for weighted metrics)
+    are also only calculated once per grid.
+
+    Parameters
+    ----------
+    cube:
+        Input data.
+    metric:
+        Distance metric that is calculated, e.g., `"weighted_rmse"`.
+    reference:
+        Path to file containing the reference dataset.
+
+    Returns
+    -------
+    Cube
+        Distance metric.
+
+    Raises
+    ------
+    HybridESMBenchException
+        Reference dataset is not given on the same horizontal grid as the
+        data.
+
+    """
+    path = Path(reference).resolve()
+    stat = path.stat()
+    ref_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    ref_cube = _load_reference(*ref_key)
+    grid_key = _get_grid_key(cube)
+    _validate_reference(cube, ref_cube, ref_key, grid_key)
+    if grid_key is not None and not cube.cell_measures("cell_area"):
+        cube = cube.copy()
+        cube.add_cell_measure(
+            _get_cell_area(cube, grid_key),
+            (
+                cube.coord_dims(cube.coord("latitude", dim_coords=True))[0],
+                cube.coord_dims(cube.coord("longitude", dim_coords=True))[0],
+            ),
+        )
+    return distance_metric([cube], metric, reference=ref_cube)[0]
+
+
 def extract_final_20_years(cube: Cube) -> Cube:
     """Extract final 20 years of dataset.
 
@@ -52,17 +211,95 @@ def extract_final_20_years(cube: Cube) -> Cube:
         Final 20 years of data.
 
     """
+    return extract_years(cube, last_n_years=20)
+
+
+def extract_years(
+    cube: Cube,
+    start_year: int | None = None,
+    end_year: int | None = None,
+    last_n_years: int | None = None,
+) -> Cube:
+    """Extract years of dataset.
+
+    The year of each time point is determined with a single vectorized search
+    of the time points within the (numeric) boundaries of all years, which
+    supports all calendars. The data is then extracted with a single slice
+    along the time dimension (data stays lazy).
+
+    Parameters
+    ----------
+    cube:
+        Input data.
+    start_year:
+        First year to extract (inclusive). If `None`, start at the beginning
+        of the data.
+    end_year:
+        Last year to extract (inclusive). If `None`, extract until the end of
+        the data.
+    last_n_years:
+        If given, only extract the last `last_n_years` years that are
+        available (after applying `start_year` and `end_year`). If data covers
+        less years, extract all of them.
+
+    Returns
+    -------
+    Cube
+        Data within the desired years.
+
+    Raises
+    ------
+    HybridESMBenchException
+        No data within the desired years available.
+
+    """
+    if start_year is None and end_year is None and last_n_years is None:
+        return cube
+
+    # Get year of every time point by searching the time points within the
+    # numeric values of 1 January of all years
     time_coord = cube.coord("time")
-    final_20_years = sorted(
-        set(c.year for c in time_coord.units.num2date(time_coord.points))
-    )[-20:]
-    cube = cube.extract(
-        Constraint(time=lambda c: c.point.year in final_20_years)
+    points = time_coord.core_points()
+    (first_date, last_date) = time_coord.units.num2date(
+        [points.min(), points.max()]
+    )
+    calendar = time_coord.units.calendar
+    boundaries = time_coord.units.date2num(
+        [
+            cftime.datetime(year, 1, 1, calendar=calendar)
+            for year in range(first_date.year, last_date.year + 2)
+        ]
     )
-    return cube
+    years = first_date.year + np.searchsorted(boundaries, points, "right") - 1
 
+    # Select desired years
+    mask = np.full(years.shape, True)
+    if start_year is not None:
+        mask &= years >= start_year
+    if end_year is not None:
+        mask &= years <= end_year
+    if last_n_years is not None:
+        selected_years = np.unique(years[mask])[-last_n_years:]
+        if selected_years.size:
+            mask &= years >= selected_years[0]
+    indices = np.flatnonzero(mask)
+    if not indices.size:
+        msg = (
+            f"No data within years {start_year} to {end_year} available for "
+            f"variable '{cube.var_name}'"
+        )
+        raise HybridESMBenchException(msg)
+    if mask.all():
+        return cube
+
+    # Since time is monotonic, the selected indices are contiguous
+    time_dims = cube.coord_dims(time_coord)
+    slices: list[slice] = [slice(None)] * cube.ndim
+    slices[time_dims[0]] = slice(indices[0], indices[-1] + 1)
+    return cube[tuple(slices)]
 
-def extract_vertical_level(var_id: str, cube: Cube, **kwargs: Any) -> Cube:
+
+def extract_vertical_level(cube: Cube, var_id: str, **kwargs: Any) -> Cube:
     """Extract vertical level of cube based on `var_id`.
 
     This interprets numbers in the `var_id` as vertical coordinate values
@@ -83,10 +320,10 @@ def extract_vertical_level(var_id: str, cube: Cube, **kwargs: Any) -> Cube:
 
     Parameters
     ----------
-    var_id:
-        Variable ID.
     cube:
         Input data.
+    var_id:
+        Variable ID.
     **kwargs
         Additional keyword arguments passed to
         :func:`esmvalcore.preprocessor.extract_levels`.
@@ -107,26 +344,53 @@ def extract_vertical_level(var_id: str, cube: Cube, **kwargs: Any) -> Cube:
             f"Variable ID '{var_id}' does not match `cube.var_name`, needs to "
             f"start with '{cube.var_name}'"
         )
-    level_str = var_id.replace(cube.var_name, "", 1)
+        raise ValueError(msg)
+    level = get_vertical_level(var_id, cube.var_name)
 
     # Single level data
-    if not level_str:
+    if level is None:
         logger.debug(f"No level extraction necessary for variable '{var_id}'")
         return cube
 
+    logger.debug(f"Extracting level {level} for variable '{var_id}'")
+    kwargs.setdefault("scheme", "linear")
+    return extract_levels(cube, level, **kwargs)
+
+
+def get_vertical_level(var_id: str, var_name: str) -> float | None:
+    """Get vertical level described by `var_id`.
+
+    Parameters
+    ----------
+    var_id:
+        Variable ID (e.g., `ta85000`).
+    var_name:
+        Variable name (e.g., `ta`).
+
+    Returns
+    -------
+    float | None
+        Vertical level (usually, a pressure level). `None` if `var_id` does
+        not describe a vertical level.
+
+    Raises
+    ------
+    HybridESMBenchException
+        `var_id` does not describe a valid level.
+
+    """
+    level_str = var_id.replace(var_name, "", 1)
+    if not level_str:
+        return None
     try:
-        level = float(var_id.replace(cube.var_name, "", 1))
+        return float(level_str)
     except ValueError as exc:
         msg = (
-            f"Variable ID '{var_id}' for variable '{cube.var_name}' does not "
+            f"Variable ID '{var_id}' for variable '{var_name}' does not "
             f"describe a valid level"
         )
         raise HybridESMBenchException(msg) from exc
 
-    logger.debug(f"Extracting level {level} for variable '{var_id}'")
-    kwargs.setdefault("scheme", "linear")
-    return extract_levels(cube, level, **kwargs)
-
 
 def get_classes(
     parent_module_name: str,
@@ -166,6 +430,71 @@ def get_classes(
     return classes
 
 
+def _get_lenient_registry() -> dict[str, Any]:
+    """Get lenient metadata services and clients registered by iris.
+
+    iris registers these on import only in the importing thread, and there is
+    no public API to register them in other threads. Without them, metadata
+    comparisons (e.g., in cube arithmetic) are strict in all other threads.
+
+    """
+    return {
+        name: value
+        for (name, value) in vars(iris.common.lenient._LENIENT).items()
+        if name not in ("active", "enable")
+    }
+
+
+def _register_lenient_registry(registry: dict[str, Any]) -> None:
+    """Register missing lenient metadata services and clients of iris."""
+    lenient = iris.common.lenient._LENIENT
+    for name, value in registry.items():
+        if name in lenient:
+            continue
+        if value is True:
+            lenient.register_service(name)
+        else:
+            lenient.register_client(name, value)
+
+
+def get_iris_state() -> dict[str, Any]:
+    """Get thread-local run-time settings of iris (of the current thread).
+
+    These are the :data:`iris.FUTURE` flags (e.g., set by ESMValCore), the
+    lenient cube arithmetic option :data:`iris.common.lenient.LENIENT`, and
+    the lenient metadata services of iris; new threads start with their
+    default values and without any lenient services.
+
+    """
+    return {
+        "future": dict(vars(iris.FUTURE)),
+        "lenient": {"maths": LENIENT["maths"]},
+        "lenient_registry": _get_lenient_registry(),
+    }
+
+
+@contextlib.contextmanager
+def use_iris_state(state: dict[str, Any]) -> Iterator[None]:
+    """Use run-time settings of iris (in the current thread).
+
+    Parameters
+    ----------
+    state:
+        Settings as returned by :func:`get_iris_state`.
+
+    """
+    _register_lenient_registry(state["lenient_registry"])
+
+    # Only flags that differ are set (setting deprecated flags would warn)
+    future = {
+        name: value
+        for (name, value) in state["future"].items()
+        if getattr(iris.FUTURE, name) != value
+    }
+    with iris.FUTURE.context(**future), LENIENT.context(**state["lenient"]):
+        yield
+
+
 def get_timerange(cube: Cube) -> str | None:
     """Get time range of cube."""
     if not cube.coords("time"):
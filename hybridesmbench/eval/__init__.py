@@ -1,16 +1,36 @@
 """Evaluate hybrid Earth system model simulations."""
 
+import multiprocessing
 import warnings
 from collections.abc import Iterable
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
 from pathlib import Path
+from typing import Any
+
+from loguru import logger
 
-from hybridesmbench.eval._diags import DIAGS
-from hybridesmbench.eval._loaders import LOADERS
+from hybridesmbench._utils import get_iris_state, use_iris_state
+from hybridesmbench.eval._dask import DaskBackend
+from hybridesmbench.eval._diags import DIAGS, Diagnostic
+from hybridesmbench.eval._loaders import LOADERS, Loader
+from hybridesmbench.eval._preprocessor import PreprocessingPlanner
 from hybridesmbench.exceptions import (
     HybridESMBenchException,
     HybridESMBenchWarning,
 )
-from hybridesmbench.typing import DiagnosticName, ModelType
+from hybridesmbench.typing import (
+    Compression,
+    DaskConfig,
+    DiagnosticName,
+    ExecutorType,
+    ModelType,
+    PreprocessingMode,
+)
 
 __all__ = [
     "evaluate",
@@ -26,6 +46,20 @@ def evaluate(
     diagnostics: Iterable[DiagnosticName] | None = None,
     fail_on_diag_error: bool = True,
     fail_on_missing_variable: bool = True,
+    preprocessing_mode: PreprocessingMode = "default",
+    cache_dir: str | Path | None = None,
+    max_workers: int = 1,
+    executor: ExecutorType = "thread",
+    max_cache_bytes: int | None = None,
+    cache_cmorized: bool = False,
+    prefetch_depth: int = 2,
+    max_prefetch_bytes: int | None = None,
+    incremental: bool = False,
+    resume: bool = False,
+    save_input_files: bool = True,
+    input_compression: Compression | None = "zlib",
+    downcast_input_files: bool = False,
+    dask_config: DaskConfig | None = None,
 ) -> dict[str, Path | None]:
     """Evaluate hybrid Earth system model output.
 
@@ -49,7 +83,107 @@ def evaluate(
     fail_on_missing_variable:
         If `True`, raise exception if a variable is not available. If `False`,
         only raise a warning.
+    preprocessing_mode:
+        If ``"default"``, run the preprocessor steps of the diagnostics in
+        their given order. If ``"optimized"``, apply time selections and time
+        means before horizontal regridding where this is mathematically
+        equivalent, which considerably reduces the amount of data that needs
+        to be regridded (this requires that the mask of the data does not
+        change over time, which is checked once per variable). If
+        ``"check"``, use the default order, but additionally run the
+        optimized order and warn if the results differ.
+    cache_dir:
+        Directory used to persistently cache data across runs (e.g.,
+        regridding weights of the native model grid). Can be shared by
+        multiple runs and processes. If `None`, do not cache data
+        persistently.
+    max_workers:
+        Maximum number of diagnostics that run concurrently. If 1, run all
+        diagnostics sequentially.
+    executor:
+        Type of the worker pool used if `max_workers` is greater than 1. If
+        ``"thread"``, all diagnostics share the loader and the intermediate
+        preprocessing results; preprocessing of one diagnostic then overlaps
+        with plotting of another one. If ``"process"``, each diagnostic uses
+        its own loader in a separate process. Preprocessing is then not shared
+        across processes, i.e., common preprocessing steps run once per
+        diagnostic (only data cached persistently in `cache_dir` is shared).
+        Since worker processes are spawned, the calling script needs an
+        ``if __name__ == "__main__":`` guard.
+    max_cache_bytes:
+        Maximum number of bytes of realized data kept in the in-memory cache
+        of the loader (least recently used data is evicted first). If `None`,
+        only limit the number of cached objects. The cache is released after
+        all diagnostics have finished.
+    cache_cmorized:
+        If `True`, cache the loaded variables after running the ESMValCore
+        fixes (i.e., the CMORization) in `cache_dir`. Reruns on unchanged model
+        output then skip the fixes. Requires `cache_dir`.
+    prefetch_depth:
+        Maximum number of variables that the loader opens and fixes ahead in
+        the background while previously loaded variables are preprocessed.
+        If 0, do not prefetch variables.
+    max_prefetch_bytes:
+        Maximum number of bytes of realized data that prefetched variables
+        which have not been used yet keep in memory. If `None`, only limit
+        the number of prefetched variables (see `prefetch_depth`).
+    incremental:
+        If `True`, reuse the latest session directory of each diagnostic in
+        `work_dir` (if available). Preprocessed variables whose input files
+        and preprocessor settings did not change since the previous run are
+        not recomputed, and diagnostics whose inputs did not change at all are
+        skipped.
+    resume:
+        If `True`, continue the latest session of each diagnostic in
+        `work_dir` (e.g., after an interrupted or partially failed run). All
+        preprocessed variables and diagnostics recorded as completed in the
+        session manifest are reused as they are; variables that failed to
+        load (see `fail_on_missing_variable`) and diagnostics that did not
+        finish are run again. Sessions are only recorded if `incremental` or
+        `resume` is enabled, so runs that might need to be continued later
+        should also use `resume=True` (a new session is started if none
+        exists yet).
+    save_input_files:
+        If `True`, save the preprocessed input data of each diagnostic in its
+        session directory. If `False`, the preprocessed data is only handed to
+        the diagnostics in memory, which avoids writing and reading back files
+        (cannot be combined with `incremental` or `resume`).
+    input_compression:
+        Compression of the saved input data (``"zlib"`` or ``"zstd"``). If
+        `None`, do not compress data. Files are written in the background
+        while the diagnostics run.
+    downcast_input_files:
+        If `True`, save 64-bit floating point input data as 32-bit floating
+        point data (only affects the saved files, not the data handed to the
+        diagnostics).
+    dask_config:
+        Configuration of the Dask execution backend used for all computations
+        (see :class:`hybridesmbench.typing.DaskConfig`). All keys are
+        optional:
 
+        * ``scheduler``: ``"threads"`` or ``"processes"`` use the
+          corresponding local Dask scheduler. ``"local_cluster"`` creates a
+          :class:`distributed.LocalCluster` that is shut down once all
+          diagnostics have finished. ``"distributed"`` connects to an
+          existing cluster at ``address``. If not given, use the current
+          Dask configuration (e.g., a :class:`distributed.Client` created by
+          the user).
+        * ``address``: Address of the scheduler of an existing cluster
+          (only for ``scheduler="distributed"``).
+        * ``n_workers``: Number of workers (for ``"threads"`` and
+          ``"processes"``, this is the number of threads and processes,
+          respectively).
+        * ``threads_per_worker``: Number of threads per worker (only for
+          ``"local_cluster"``).
+        * ``memory_limit``: Memory limit per worker, e.g., ``"6 GiB"`` (only
+          for ``"local_cluster"``).
+        * ``chunks``: Chunk policy for data loaded from model output. If
+          ``"reductions"`` (default), chunk each variable according to the
+          reductions of the diagnostics that use it, e.g., with chunks that
+          span the entire time axis for climatologies or entire vertical
+          columns for vertical interpolation. If ``"time"``, always use
+          chunks that span the entire time axis (in addition). If
+          ``"auto"``, let Dask choose the chunks of each file.
 
     Returns
     -------
@@ -60,6 +194,8 @@ def evaluate(
     """
     path = Path(path)
     work_dir = Path(work_dir)
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir).expanduser()
 
     if model_type not in LOADERS:
         msg = (
@@ -67,7 +203,17 @@ def evaluate(
             f"{list(LOADERS)}"
         )
         raise HybridESMBenchException(msg)
-    loader = LOADERS[model_type](path, model_name=model_name)
+    dask_backend = DaskBackend(dask_config)
+    loader = LOADERS[model_type](
+        path,
+        model_name=model_name,
+        cache_dir=cache_dir,
+        max_cache_bytes=max_cache_bytes,
+        cache_cmorized=cache_cmorized,
+        prefetch_depth=prefetch_depth,
+        max_prefetch_bytes=max_prefetch_bytes,
+        chunk_policy=dask_backend.chunk_policy,
+    )
 
     if diagnostics is None:
         diagnostics = list(DIAGS)
@@ -78,24 +224,188 @@ def evaluate(
                 f"{list(DIAGS)}"
             )
             raise HybridESMBenchException(msg)
+    if executor not in ("thread", "process"):
+        msg = (
+            f"Got invalid executor '{executor}', must be one of "
+            f"['thread', 'process']"
+        )
+        raise HybridESMBenchException(msg)
+    diagnostics = list(dict.fromkeys(diagnostics))
+    use_processes = max_workers > 1 and executor == "process"
 
-    output: dict[str, Path | None] = {}
-    for diag_name in diagnostics:
-        diagnostic = DIAGS[diag_name](
-            work_dir, fail_on_missing_variable=fail_on_missing_variable
+    # Preprocessing chains of all diagnostics are planned together so that
+    # common steps (e.g., regridding of the same variable) only run once
+    # (worker processes set up their own diagnostics and planners instead)
+    planner: PreprocessingPlanner | None = None
+    all_diagnostics: dict[str, Diagnostic] = {}
+    planning_errors: dict[str, Exception] = {}
+    if not use_processes:
+        planner = PreprocessingPlanner(
+            loader, mode=preprocessing_mode, cache_dir=cache_dir
         )
-        try:
-            output_dir: Path | None = diagnostic.run(loader)
-        except Exception as exc:
-            msg = (
-                f"Diagnostic '{diag_name}' failed to run on model "
-                f"'{loader.model_name}' of type '{loader.model_type}'"
+        all_diagnostics = {
+            diag_name: DIAGS[diag_name](
+                work_dir,
+                fail_on_missing_variable=fail_on_missing_variable,
+                incremental=incremental,
+                resume=resume,
+                save_input_files=save_input_files,
+                input_compression=input_compression,
+                downcast_input_files=downcast_input_files,
+            )
+            for diag_name in diagnostics
+        }
+        for diag_name, diagnostic in list(all_diagnostics.items()):
+            # Diagnostics that cannot be planned are handled like diagnostics
+            # that fail to run (see below)
+            try:
+                diagnostic.plan_preprocessing(planner)
+            except Exception as exc:
+                planning_errors[diag_name] = exc
+                all_diagnostics.pop(diag_name)
+
+    # All computations use the configured Dask backend (clusters created by
+    # it are shut down afterwards)
+    with dask_backend:
+        # Run diagnostics concurrently if desired
+        pool: Executor | None = None
+        futures: dict[str, Future] = {}
+        if max_workers > 1:
+            if use_processes:
+                pool = ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                for diag_name in diagnostics:
+                    futures[diag_name] = pool.submit(
+                        _run_diagnostic,
+                        path,
+                        model_type,
+                        work_dir,
+                        diag_name,
+                        model_name=model_name,
+                        fail_on_missing_variable=fail_on_missing_variable,
+                        incremental=incremental,
+                        resume=resume,
+                        save_input_files=save_input_files,
+                        input_compression=input_compression,
+                        downcast_input_files=downcast_input_files,
+                        preprocessing_mode=preprocessing_mode,
+                        cache_dir=cache_dir,
+                        max_cache_bytes=max_cache_bytes,
+                        cache_cmorized=cache_cmorized,
+                        prefetch_depth=prefetch_depth,
+                        max_prefetch_bytes=max_prefetch_bytes,
+                        dask_config=dask_backend.worker_config,
+                    )
+            else:
+                pool = ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix="diagnostic",
+                )
+                iris_state = get_iris_state()
+                for diag_name, diagnostic in all_diagnostics.items():
+                    futures[diag_name] = pool.submit(
+                        _run_diagnostic_in_thread,
+                        diagnostic,
+                        loader,
+                        planner,
+                        iris_state,
+                    )
+            logger.debug(
+                f"Running {len(futures)} diagnostics with up to {max_workers} "
+                f"{executor} workers"
             )
-            if fail_on_diag_error:
-                raise HybridESMBenchException(msg) from exc
-            msg = f"{msg}: {exc}"
-            warnings.warn(msg, HybridESMBenchWarning, stacklevel=2)
-            output_dir = None
-        output[diag_name] = output_dir
+
+        output: dict[str, Path | None] = {}
+        try:
+            for diag_name in diagnostics:
+                try:
+                    if diag_name in planning_errors:
+                        raise planning_errors[diag_name]
+                    if diag_name in futures:
+                        output_dir: Path | None = futures[diag_name].result()
+                    else:
+                        output_dir = all_diagnostics[diag_name].run(
+                            loader, planner
+                        )
+                except Exception as exc:
+                    msg = (
+                        f"Diagnostic '{diag_name}' failed to run on model "
+                        f"'{loader.model_name}' of type '{loader.model_type}'"
+                    )
+                    if fail_on_diag_error:
+                        raise HybridESMBenchException(msg) from exc
+                    msg = f"{msg}: {exc}"
+                    warnings.warn(msg, HybridESMBenchWarning, stacklevel=2)
+                    output_dir = None
+                output[diag_name] = output_dir
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            loader.close()
 
     return output
+
+
+def _run_diagnostic_in_thread(
+    diagnostic: Diagnostic,
+    loader: Loader,
+    planner: PreprocessingPlanner,
+    iris_state: dict[str, Any],
+) -> Path:
+    """Run single diagnostic in a worker thread (with the given iris state)."""
+    with use_iris_state(iris_state):
+        return diagnostic.run(loader, planner)
+
+
+def _run_diagnostic(
+    path: Path,
+    model_type: ModelType,
+    work_dir: Path,
+    diag_name: DiagnosticName,
+    *,
+    model_name: str | None,
+    fail_on_missing_variable: bool,
+    incremental: bool,
+    resume: bool,
+    save_input_files: bool,
+    input_compression: Compression | None,
+    downcast_input_files: bool,
+    preprocessing_mode: PreprocessingMode,
+    cache_dir: Path | None,
+    max_cache_bytes: int | None,
+    cache_cmorized: bool,
+    prefetch_depth: int,
+    max_prefetch_bytes: int | None,
+    dask_config: DaskConfig,
+) -> Path:
+    """Run single diagnostic with its own loader (e.g., in a subprocess)."""
+    dask_backend = DaskBackend(dask_config)
+    with (
+        dask_backend,
+        LOADERS[model_type](
+            path,
+            model_name=model_name,
+            cache_dir=cache_dir,
+            max_cache_bytes=max_cache_bytes,
+            cache_cmorized=cache_cmorized,
+            prefetch_depth=prefetch_depth,
+            max_prefetch_bytes=max_prefetch_bytes,
+            chunk_policy=dask_backend.chunk_policy,
+        ) as loader,
+    ):
+        planner = PreprocessingPlanner(
+            loader, mode=preprocessing_mode, cache_dir=cache_dir
+        )
+        diagnostic = DIAGS[diag_name](
+            work_dir,
+            fail_on_missing_variable=fail_on_missing_variable,
+            incremental=incremental,
+            resume=resume,
+            save_input_files=save_input_files,
+            input_compression=input_compression,
+            downcast_input_files=downcast_input_files,
+        )
+        diagnostic.plan_preprocessing(planner)
+        return diagnostic.run(loader, planner)
@@ -0,0 +1,145 @@
+"""Set up the Dask execution backend."""
+
+import contextlib
+from typing import Any, Self
+
+import dask
+from loguru import logger
+from ncdata.threadlock_sharing import enable_lockshare
+
+from hybridesmbench.exceptions import HybridESMBenchException
+from hybridesmbench.typing import ChunkPolicy, DaskConfig
+
+_SCHEDULERS = ["threads", "processes", "local_cluster", "distributed"]
+_CHUNK_POLICIES = ["auto", "reductions", "time"]
+
+
+class DaskBackend:
+    """Set up the Dask execution backend.
+
+    Use the backend as context manager; all clusters and clients created by
+    it are closed (and the previous Dask configuration is restored) on exit.
+    Clusters that are only connected to (``scheduler="distributed"``) are not
+    shut down. Setting up the backend makes iris, ncdata and xarray share
+    their netCDF lock (see :func:`ncdata.threadlock_sharing.enable_lockshare`).
+
+    Parameters
+    ----------
+    config:
+        Configuration of the backend (see
+        :func:`hybridesmbench.eval.evaluate`). If `None` or if no
+        ``scheduler`` is given, use the current Dask configuration (e.g., a
+        :class:`distributed.Client` created by the user).
+
+    """
+
+    def __init__(self, config: DaskConfig | None = None) -> None:
+        """Initialize class instance."""
+        self._config: DaskConfig = DaskConfig(**(config or {}))
+        invalid_keys = set(self._config) - set(DaskConfig.__annotations__)
+        if invalid_keys:
+            msg = (
+                f"Got invalid Dask configuration keys {sorted(invalid_keys)}, "
+                f"valid keys are {list(DaskConfig.__annotations__)}"
+            )
+            raise HybridESMBenchException(msg)
+        scheduler = self._config.get("scheduler")
+        if scheduler is not None and scheduler not in _SCHEDULERS:
+            msg = (
+                f"Got invalid Dask scheduler '{scheduler}', must be one of "
+                f"{_SCHEDULERS}"
+            )
+            raise HybridESMBenchException(msg)
+        if (scheduler == "distributed") != ("address" in self._config):
+            msg = (
+                "Dask configuration key 'address' is required for (and only "
+                "valid with) scheduler 'distributed'"
+            )
+            raise HybridESMBenchException(msg)
+        if self.chunk_policy not in _CHUNK_POLICIES:
+            msg = (
+                f"Got invalid chunk policy '{self.chunk_policy}', must be one "
+                f"of {_CHUNK_POLICIES}"
+            )
+            raise HybridESMBenchException(msg)
+        self._exit_stack = contextlib.ExitStack()
+        self._address: str | None = None
+
+    def __enter__(self) -> Self:
+        """Enter context manager (set up backend)."""
+        try:
+            self._setup()
+        except BaseException:
+            self._exit_stack.close()
+            raise
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Exit context manager (tear down backend)."""
+        self._exit_stack.close()
+        self._address = None
+
+    @property
+    def chunk_policy(self) -> ChunkPolicy:
+        """Get chunk policy for data loaded from files."""
+        return self._config.get("chunks", "reductions")
+
+    @property
+    def worker_config(self) -> DaskConfig:
+        """Get configuration for worker processes of :func:`evaluate`.
+
+        Worker processes connect to the cluster of this backend (if any)
+        instead of creating their own.
+
+        """
+        if self._address is None:
+            return DaskConfig(**self._config)
+        return DaskConfig(
+            scheduler="distributed",
+            address=self._address,
+            chunks=self.chunk_policy,
+        )
+
+    def _connect(self, address: str) -> None:
+        """Connect to cluster and use it for all computations."""
+        from distributed import Client
+
+        client = self._exit_stack.enter_context(Client(address))
+        self._address = address
+        logger.debug(
+            f"Using Dask cluster at {address} (dashboard: "
+            f"{client.dashboard_link})"
+        )
+
+    def _setup(self) -> None:
+        """Set up backend."""
+        # The netCDF library is not thread-safe; iris, ncdata and xarray use
+        # the same lock for it so that files can be read and written
+        # concurrently by different threads (e.g., by Dask, diagnostics, the
+        # prefetcher of the loader, and background writers of files). This is
+        # not undone on exit since other packages may rely on it as well
+        # (ESMValCore enables the same sharing when it is imported).
+        enable_lockshare(iris=True, xarray=True)
+
+        scheduler = self._config.get("scheduler")
+        if scheduler in ("threads", "processes"):
+            dask_config: dict[str, Any] = {"scheduler": scheduler}
+            if "n_workers" in self._config:
+                dask_config["num_workers"] = self._config["n_workers"]
+            self._exit_stack.enter_context(dask.config.set(dask_config))
+            logger.debug(f"Using Dask configuration {dask_config}")
+        elif scheduler == "local_cluster":
+            from distributed import LocalCluster
+
+            cluster_kwargs: dict[str, Any] = {
+                k: v
+                for (k, v) in self._config.items()
+                if k in ("n_workers", "threads_per_worker", "memory_limit")
+            }
+            cluster = self._exit_stack.enter_context(
+                LocalCluster(**cluster_kwargs)
+            )
+            logger.debug(f"Created Dask cluster {cluster}")
+            self._connect(cluster.scheduler_address)
+        elif scheduler == "distributed":
+            self._connect(self._config["address"])
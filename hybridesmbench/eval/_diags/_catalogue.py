@@ -0,0 +1,118 @@
+"""Compile reference data metadata into a catalogue."""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+
+import yaml
+from loguru import logger
+
+CATALOGUE_FILE = "catalogue.json"
+
+_VERSION = 1
+
+
+def compile_catalogue(data_dir: Path) -> dict[str, Any]:
+    """Compile all ``metadata.yml`` files of a data directory.
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    Returns
+    -------
+    dict[str, Any]
+        Catalogue with the SHA-256 hashes of all ``metadata.yml`` files
+        (`sources`) and the metadata of all reference datasets indexed by
+        their paths relative to `data_dir` (`datasets`).
+
+    """
+    sources: dict[str, str] = {}
+    datasets: dict[str, dict[str, Any]] = {}
+    for metadata_file in sorted(data_dir.rglob("metadata.yml")):
+        content = metadata_file.read_bytes()
+        rel_path = metadata_file.relative_to(data_dir).as_posix()
+        sources[rel_path] = hashlib.sha256(content).hexdigest()
+        datasets.update(yaml.safe_load(content))
+    return {"version": _VERSION, "sources": sources, "datasets": datasets}
+
+
+def check_catalogue(data_dir: Path) -> bool:
+    """Check if catalogue of a data directory matches its YAML sources.
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    Returns
+    -------
+    bool
+        `True` if the catalogue exists and is up to date, `False` otherwise.
+
+    """
+    catalogue_file = data_dir / CATALOGUE_FILE
+    try:
+        with catalogue_file.open(encoding="utf-8") as file:
+            catalogue = json.load(file)
+    except (OSError, ValueError):
+        return False
+    return catalogue == compile_catalogue(data_dir)
+
+
+def load_catalogue(data_dir: Path) -> dict[str, dict[str, Any]]:
+    """Load metadata of all reference datasets of a data directory.
+
+    If no compiled catalogue is available, the ``metadata.yml`` files are
+    parsed directly (slow).
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    Returns
+    -------
+    dict[str, dict[str, Any]]
+        Metadata of all reference datasets indexed by their paths relative
+        to `data_dir`.
+
+    """
+    catalogue_file = data_dir / CATALOGUE_FILE
+    try:
+        with catalogue_file.open(encoding="utf-8") as file:
+            catalogue = json.load(file)
+    except OSError:
+        catalogue = {}
+    if catalogue.get("version") == _VERSION:
+        logger.debug(f"Loaded catalogue {catalogue_file}")
+    else:
+        logger.debug(
+            f"No valid catalogue {catalogue_file} available, reading "
+            f"metadata.yml files in {data_dir}"
+        )
+        catalogue = compile_catalogue(data_dir)
+    return catalogue["datasets"]
+
+
+def save_catalogue(data_dir: Path) -> Path:
+    """Compile and save catalogue of a data directory.
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    Returns
+    -------
+    Path
+        Path to catalogue file.
+
+    """
+    catalogue_file = data_dir / CATALOGUE_FILE
+    with catalogue_file.open("w", encoding="utf-8") as file:
+        json.dump(compile_catalogue(data_dir), file, separators=(",", ":"))
+        file.write("\n")
+    return catalogue_file
@@ -0,0 +1,182 @@
+"""Hand in-memory input data to ESMValTool diagnostics.
+
+This is the only module that relies on implementation details of ESMValTool
+diagnostics (see :func:`check_esmvaltool_version`).
+
+"""
+
+from collections.abc import Callable
+from typing import Any
+from unittest import mock
+
+import esmvaltool
+import esmvaltool.diag_scripts.shared.iris_helpers as ih
+from esmvaltool.diag_scripts import portrait_plot
+from esmvaltool.diag_scripts.monitor.multi_datasets import MultiDatasets
+from esmvaltool.diag_scripts.shared import select_metadata
+from iris.coords import AuxCoord
+from iris.cube import Cube
+from loguru import logger
+
+from hybridesmbench.exceptions import HybridESMBenchException
+
+# ESMValTool version (major, minor) whose implementation details are used here
+_SUPPORTED_VERSION = (2, 13)
+
+
+def check_esmvaltool_version() -> None:
+    """Check that the installed version of ESMValTool is supported.
+
+    Raises
+    ------
+    HybridESMBenchException
+        Installed version of ESMValTool is not supported.
+
+    """
+    version = tuple(int(v) for v in esmvaltool.__version__.split(".")[:2])
+    if version != _SUPPORTED_VERSION:
+        supported = ".".join(str(v) for v in _SUPPORTED_VERSION)
+        msg = (
+            f"ESMValTool v{esmvaltool.__version__} is not supported, "
+            f"diagnostics require ESMValTool v{supported}.x"
+        )
+        raise HybridESMBenchException(msg)
+
+
+def _fix_cube(cube: Cube) -> None:
+    """Fix cube (in-place).
+
+    Same fixes as applied by
+    :meth:`MultiDatasets._load_and_preprocess_data` after loading a file.
+
+    """
+    # Fix time coordinate if present
+    if cube.coords("time", dim_coords=True):
+        ih.unify_time_coord(cube)
+
+    # Add scalar latitude and longitude coordinates if these are not present
+    # (necessary for calculation of area weights)
+    if not cube.coords("latitude"):
+        lat_coord = AuxCoord(
+            0.0,
+            bounds=[-90.0, 90.0],
+            var_name="lat",
+            standard_name="latitude",
+            long_name="latitude",
+            units="degrees_north",
+        )
+        cube.add_aux_coord(lat_coord, ())
+    if not cube.coords("longitude"):
+        lon_coord = AuxCoord(
+            180.0,
+            bounds=[0.0, 360.0],
+            var_name="lon",
+            standard_name="longitude",
+            long_name="longitude",
+            units="degrees_east",
+        )
+        cube.add_aux_coord(lon_coord, ())
+
+    # Fix Z-coordinate if present
+    if cube.coords("air_pressure", dim_coords=True):
+        z_coord = cube.coord("air_pressure", dim_coords=True)
+        z_coord.attributes["positive"] = "down"
+        z_coord.convert_units("hPa")
+    elif cube.coords("altitude", dim_coords=True):
+        z_coord = cube.coord("altitude")
+        z_coord.attributes["positive"] = "up"
+
+
+class InMemoryMultiDatasets(MultiDatasets):
+    """ESMValTool's multi datasets diagnostic with in-memory input data.
+
+    Input datasets whose cubes are already available in memory are taken from
+    there instead of reading their files. All other datasets are read from
+    disk as usual.
+
+    This overrides a private method of ESMValTool's
+    :class:`~esmvaltool.diag_scripts.monitor.multi_datasets.MultiDatasets`.
+
+    Parameters
+    ----------
+    cfg:
+        Diagnostic configuration.
+    load_cube:
+        Function that returns the cube of an input file if it is available in
+        memory, `None` otherwise.
+
+    """
+
+    def __init__(
+        self,
+        cfg: dict[str, Any],
+        load_cube: Callable[[str], Cube | None],
+    ) -> None:
+        """Initialize class instance."""
+        self._load_cube = load_cube
+        super().__init__(cfg)
+
+    def _load_and_preprocess_data(self) -> list[dict]:
+        """Load and preprocess data."""
+        all_input_data = self.cfg["input_data"]
+        cubes: dict[str, Cube] = {}
+        for filename in all_input_data:
+            cube = self._load_cube(filename)
+            if cube is not None:
+                cubes[filename] = cube
+        logger.debug(
+            f"Using {len(cubes)} of {len(all_input_data)} input datasets from "
+            f"memory"
+        )
+
+        # Read all other datasets with the original implementation
+        self.cfg["input_data"] = {
+            f: d for (f, d) in all_input_data.items() if f not in cubes
+        }
+        try:
+            if self.cfg["input_data"]:
+                super()._load_and_preprocess_data()
+        finally:
+            self.cfg["input_data"] = all_input_data
+
+        for filename, cube in cubes.items():
+            _fix_cube(cube)
+            all_input_data[filename]["cube"] = cube
+            all_input_data[filename]["ancestors"] = [filename]
+
+        return list(all_input_data.values())
+
+
+def run_portrait_plot(
+    cfg: dict[str, Any],
+    load_value: Callable[[str], float | None],
+) -> None:
+    """Run ESMValTool's portrait plot diagnostic with in-memory input data.
+
+    Runs :func:`esmvaltool.diag_scripts.portrait_plot.main`, but input
+    datasets whose values are already available in memory are taken from
+    there instead of reading their files. Patching the module is only safe
+    since ESMValTool diagnostics are not run concurrently in the same process.
+
+    Parameters
+    ----------
+    cfg:
+        Diagnostic configuration.
+    load_value:
+        Function that returns the scalar value of an input file if it is
+        available in memory, `None` otherwise.
+
+    """
+    open_file = portrait_plot.open_file
+
+    def _open_file(metadata: list[dict], **selection: Any) -> float:
+        """Get value of selected dataset from memory or its file."""
+        metas = select_metadata(metadata, **selection)
+        if len(metas) == 1:
+            value = load_value(metas[0]["filename"])
+            if value is not None:
+                return value
+        return open_file(metadata, **selection)
+
+    with mock.patch.object(portrait_plot, "open_file", _open_file):
+        portrait_plot.main(cfg)
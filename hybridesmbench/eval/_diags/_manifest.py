@@ -0,0 +1,134 @@
+"""Record the artifacts of a diagnostic session."""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any
+
+from loguru import logger
+
+
+def get_hash(obj: Any) -> str:
+    """Get SHA-256 hash of JSON representation of an object."""
+    obj_json = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(obj_json.encode()).hexdigest()
+
+
+class SessionManifest:
+    """Record the artifacts of a diagnostic session.
+
+    The manifest is stored in the file ``manifest.json`` in the session
+    directory. It records which variables have been preprocessed (together
+    with a hash of their inputs) or failed to load, and whether the
+    diagnostic itself has been run successfully (together with a hash of its
+    inputs). Recorded artifacts can be reused when a session is continued.
+
+    Parameters
+    ----------
+    session_dir:
+        Session directory of the diagnostic.
+
+    """
+
+    FILE_NAME = "manifest.json"
+    _VERSION = 2
+
+    def __init__(self, session_dir: Path) -> None:
+        """Initialize class instance."""
+        self._file = session_dir / self.FILE_NAME
+        self._data = self._load()
+
+    @property
+    def failed_variables(self) -> list[str]:
+        """Get variables that failed to load."""
+        return [
+            var_id
+            for (var_id, entry) in self._data["variables"].items()
+            if entry["status"] == "failed"
+        ]
+
+    @property
+    def variables(self) -> dict[str, str | None]:
+        """Get hashes of all successfully preprocessed variables."""
+        return {
+            var_id: entry["key"]
+            for (var_id, entry) in self._data["variables"].items()
+            if entry["status"] == "done"
+        }
+
+    def discard_diagnostic(self) -> None:
+        """Discard record of diagnostic run."""
+        self._data["diagnostic"] = None
+
+    def discard_variable(self, var_id: str) -> None:
+        """Discard record of variable."""
+        self._data["variables"].pop(var_id, None)
+
+    def is_diagnostic_done(self, key: str) -> bool:
+        """Check if diagnostic run with the given hash is recorded."""
+        return self._data["diagnostic"] == key
+
+    def is_variable_done(
+        self,
+        var_id: str,
+        path: Path,
+        key: str | None = None,
+    ) -> bool:
+        """Check if variable is recorded as preprocessed and saved.
+
+        If `key` is given, the recorded hash needs to match it.
+
+        """
+        entry = self._data["variables"].get(var_id)
+        if entry is None or entry["status"] != "done":
+            return False
+        if key is not None and entry["key"] != key:
+            return False
+        return path.is_file()
+
+    def save(self) -> None:
+        """Save manifest (atomically)."""
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=self._file.parent,
+            suffix=".json.tmp",
+            delete=False,
+            encoding="utf-8",
+        ) as file:
+            json.dump(self._data, file, indent=2)
+        os.replace(file.name, self._file)
+        logger.debug(f"Saved session manifest {self._file}")
+
+    def set_diagnostic(self, key: str) -> None:
+        """Record successful diagnostic run."""
+        self._data["diagnostic"] = key
+
+    def set_variable(self, var_id: str, key: str | None) -> None:
+        """Record successfully preprocessed variable."""
+        self._data["variables"][var_id] = {"status": "done", "key": key}
+
+    def set_variable_failed(self, var_id: str, error: str) -> None:
+        """Record variable that failed to load."""
+        self._data["variables"][var_id] = {
+            "status": "failed",
+            "key": None,
+            "error": error,
+        }
+
+    def _load(self) -> dict[str, Any]:
+        """Load manifest from file (if possible)."""
+        try:
+            with self._file.open(encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") != self._VERSION:
+            return {
+                "version": self._VERSION,
+                "variables": {},
+                "diagnostic": None,
+            }
+        logger.debug(f"Loaded session manifest {self._file}")
+        return data
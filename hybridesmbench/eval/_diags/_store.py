@@ -0,0 +1,501 @@
+"""Consolidated store of reference datasets."""
+
+import hashlib
+import json
+import warnings
+from pathlib import Path
+from typing import Any
+
+import iris
+import numpy as np
+import xarray as xr
+from cf_units import Unit
+from iris.coords import AuxCoord, CellMethod, Coord, DimCoord
+from iris.cube import Cube, CubeAttrsDict
+from loguru import logger
+
+from hybridesmbench.eval._diags._catalogue import load_catalogue
+
+STORE_DIR = "store"
+
+_INDEX_FILE = "index.json"
+_VERSION = 2
+
+
+def _get_groups(data_dir: Path) -> dict[str, list[str]]:
+    """Get reference datasets of all variable groups."""
+    groups: dict[str, list[str]] = {}
+    for filename in load_catalogue(data_dir):
+        groups.setdefault(filename.split("/")[0], []).append(filename)
+    return groups
+
+
+def _get_sources(data_dir: Path, filenames: list[str]) -> dict[str, str]:
+    """Get SHA-256 hashes of reference datasets."""
+    return {
+        f: hashlib.sha256((data_dir / f).read_bytes()).hexdigest()
+        for f in filenames
+    }
+
+
+def _load_index(data_dir: Path) -> dict[str, Any] | None:
+    """Load index of store (if available)."""
+    index_file = data_dir / STORE_DIR / _INDEX_FILE
+    try:
+        with index_file.open(encoding="utf-8") as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != _VERSION:
+        return None
+    return index
+
+
+def _load_value(path: Path) -> float:
+    """Load scalar dataset (same as ESMValTool's portrait plot does)."""
+    with xr.open_dataset(path) as dataset:
+        var_name = list(dataset.data_vars.keys())[0]
+        return dataset[var_name].values.item()
+
+
+def _encode_attributes(attributes: dict[str, Any]) -> dict[str, Any]:
+    """Encode attributes as JSON-serializable objects.
+
+    The types of numpy values are preserved since :mod:`iris` takes them into
+    account when comparing attributes.
+
+    """
+    encoded: dict[str, Any] = {}
+    for key, value in attributes.items():
+        if isinstance(value, np.ndarray | np.generic):
+            value = {
+                "value": value.tolist(),
+                "dtype": value.dtype.str,
+                "scalar": isinstance(value, np.generic),
+            }
+        else:
+            value = {"value": value}
+        encoded[key] = value
+    return encoded
+
+
+def _decode_attributes(encoded: dict[str, Any]) -> dict[str, Any]:
+    """Decode attributes encoded with :func:`_encode_attributes`."""
+    attributes: dict[str, Any] = {}
+    for key, value in encoded.items():
+        if "dtype" not in value:
+            attributes[key] = value["value"]
+            continue
+        array = np.array(value["value"], dtype=value["dtype"])
+        attributes[key] = array[()] if value["scalar"] else array
+    return attributes
+
+
+def _get_coord_metadata(coord: Coord) -> dict[str, Any]:
+    """Get metadata of coordinate."""
+    return {
+        "type": "dim" if isinstance(coord, DimCoord) else "aux",
+        "standard_name": coord.standard_name,
+        "long_name": coord.long_name,
+        "var_name": coord.var_name,
+        "units": str(coord.units),
+        "calendar": coord.units.calendar,
+        "attributes": _encode_attributes(coord.attributes),
+        "climatological": coord.climatological,
+        "has_bounds": coord.has_bounds(),
+    }
+
+
+def _create_coord(
+    metadata: dict[str, Any],
+    points: Any,
+    bounds: Any | None,
+) -> Coord:
+    """Create coordinate from its metadata and values."""
+    coord_cls = DimCoord if metadata["type"] == "dim" else AuxCoord
+    return coord_cls(
+        points,
+        bounds=bounds if metadata["has_bounds"] else None,
+        standard_name=metadata["standard_name"],
+        long_name=metadata["long_name"],
+        var_name=metadata["var_name"],
+        units=Unit(metadata["units"], calendar=metadata["calendar"]),
+        attributes=_decode_attributes(metadata["attributes"]),
+        climatological=metadata["climatological"],
+    )
+
+
+def _get_series_layout(cubes: list[Cube]) -> list[tuple[str, str]] | None:
+    """Get names and dtypes of time-dependent coordinates of time series.
+
+    Returns `None` if the cubes are not 1D time series with identical
+    time-dependent coordinates (and can thus not be stored in common arrays).
+
+    """
+    layouts = set()
+    for cube in cubes:
+        if (
+            cube.ndim != 1
+            or cube.dtype.kind != "f"
+            or not cube.coords("time", dim_coords=True)
+            or any(c.nbounds not in (0, 2) for c in cube.coords(dimensions=0))
+        ):
+            return None
+        layouts.add(
+            tuple((c.name(), c.dtype.str) for c in cube.coords(dimensions=0))
+        )
+    if len(layouts) != 1 or len({c.dtype for c in cubes}) != 1:
+        return None
+    return list(layouts.pop())
+
+
+def _save_series(
+    cubes: list[Cube],
+    filenames: list[str],
+    layout: list[tuple[str, str]],
+    path: Path,
+) -> None:
+    """Save time series as arrays along a common `dataset` dimension.
+
+    Shorter time series are padded at the end; the actual length of each time
+    series and the metadata of its cube and coordinates are stored alongside.
+
+    """
+    n_time = max(c.shape[0] for c in cubes)
+    n_data = len(cubes)
+    data = np.full((n_data, n_time), np.nan, dtype=cubes[0].dtype)
+    coords = {
+        idx: np.zeros((n_data, n_time), dtype=dtype)
+        for (idx, (_, dtype)) in enumerate(layout)
+    }
+    bounds = {
+        idx: np.zeros((n_data, n_time, 2), dtype=dtype)
+        for (idx, (_, dtype)) in enumerate(layout)
+    }
+    metadata = []
+    for data_idx, cube in enumerate(cubes):
+        length = cube.shape[0]
+        data[data_idx, :length] = np.ma.filled(
+            cube.data.astype(data.dtype), np.nan
+        )
+        for coord_idx, coord in enumerate(cube.coords(dimensions=0)):
+            coords[coord_idx][data_idx, :length] = coord.points
+            if coord.has_bounds():
+                bounds[coord_idx][data_idx, :length] = coord.bounds
+        metadata.append(
+            {
+                "length": length,
+                "standard_name": cube.standard_name,
+                "long_name": cube.long_name,
+                "var_name": cube.var_name,
+                "units": str(cube.units),
+                "global_attributes": _encode_attributes(
+                    cube.attributes.globals
+                ),
+                "local_attributes": _encode_attributes(cube.attributes.locals),
+                "cell_methods": [
+                    [m.method, m.coord_names, m.intervals, m.comments]
+                    for m in cube.cell_methods
+                ],
+                "coords": [
+                    _get_coord_metadata(c) for c in cube.coords(dimensions=0)
+                ],
+                "scalar_coords": [
+                    {
+                        **_get_coord_metadata(c),
+                        "points": c.points.tolist(),
+                        "bounds": (
+                            None if c.bounds is None else c.bounds.tolist()
+                        ),
+                        "dtype": c.dtype.str,
+                    }
+                    for c in cube.coords(dimensions=())
+                ],
+            }
+        )
+
+    variables = {
+        "data": (("dataset", "time"), data),
+        "metadata": (
+            "dataset",
+            np.array([json.dumps(m).encode() for m in metadata]),
+        ),
+    }
+    for idx in coords:
+        variables[f"coord{idx}"] = (("dataset", "time"), coords[idx])
+        variables[f"coord{idx}_bounds"] = (
+            ("dataset", "time", "bnds"),
+            bounds[idx],
+        )
+    series = xr.Dataset(variables, coords={"dataset": filenames})
+    encoding: dict[str, dict[str, Any]] = {
+        name: {"zlib": True, "chunksizes": (1, *var.shape[1:])}
+        for (name, var) in series.data_vars.items()
+        if name != "metadata"
+    }
+    encoding["metadata"] = {"zlib": True}
+    series.to_netcdf(path, encoding=encoding)
+
+
+def _load_series(series: xr.Dataset, idx: int) -> Cube:
+    """Load time series of a single dataset.
+
+    Only the slices of the store arrays that belong to the dataset are read.
+
+    """
+    metadata = json.loads(series["metadata"][idx].values.item())
+    length = metadata["length"]
+    data = series["data"][idx, :length].values
+    cube = Cube(
+        np.ma.masked_invalid(data),
+        standard_name=metadata["standard_name"],
+        long_name=metadata["long_name"],
+        var_name=metadata["var_name"],
+        units=metadata["units"],
+        attributes=CubeAttrsDict(
+            globals=_decode_attributes(metadata["global_attributes"]),
+            locals=_decode_attributes(metadata["local_attributes"]),
+        ),
+        cell_methods=[
+            CellMethod(m, coords=c, intervals=i, comments=t)
+            for (m, c, i, t) in metadata["cell_methods"]
+        ],
+    )
+    for coord_idx, coord_metadata in enumerate(metadata["coords"]):
+        coord = _create_coord(
+            coord_metadata,
+            series[f"coord{coord_idx}"][idx, :length].values,
+            series[f"coord{coord_idx}_bounds"][idx, :length].values,
+        )
+        if isinstance(coord, DimCoord):
+            cube.add_dim_coord(coord, 0)
+        else:
+            cube.add_aux_coord(coord, 0)
+    for coord_metadata in metadata["scalar_coords"]:
+        dtype = coord_metadata["dtype"]
+        bounds = coord_metadata["bounds"]
+        coord = _create_coord(
+            coord_metadata,
+            np.array(coord_metadata["points"], dtype=dtype),
+            None if bounds is None else np.array(bounds, dtype=dtype),
+        )
+        cube.add_aux_coord(coord, ())
+    return cube
+
+
+def check_store(data_dir: Path) -> bool:
+    """Check if store of a data directory matches its reference datasets.
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    Returns
+    -------
+    bool
+        `True` if the store exists and is up to date, `False` otherwise.
+
+    """
+    index = _load_index(data_dir)
+    if index is None:
+        return False
+    groups = _get_groups(data_dir)
+    if sorted(index["groups"]) != sorted(groups):
+        return False
+    return all(
+        index["groups"][group]["sources"] == _get_sources(data_dir, filenames)
+        for (group, filenames) in groups.items()
+    )
+
+
+def save_store(data_dir: Path) -> Path:
+    """Compile and save store of a data directory.
+
+    Each variable group is stored in a single netCDF file. If all reference
+    datasets of a variable group are scalars, they are stored as one array
+    along a `dataset` dimension. If they are 1D time series, their data and
+    time-dependent coordinates are stored as arrays along a `dataset` and a
+    (padded) `time` dimension, together with the metadata of each dataset.
+    Other variable groups are not stored and need to be read from their
+    original files.
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    Returns
+    -------
+    Path
+        Path to store directory.
+
+    """
+    store_dir = data_dir / STORE_DIR
+    store_dir.mkdir(parents=True, exist_ok=True)
+    for old_file in store_dir.iterdir():
+        old_file.unlink()
+    index: dict[str, Any] = {"version": _VERSION, "groups": {}}
+    for group, filenames in sorted(_get_groups(data_dir).items()):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            cubes = [iris.load(data_dir / f)[0] for f in filenames]
+        layout = _get_series_layout(cubes)
+        if all(c.ndim == 0 for c in cubes):
+            store_type = "values"
+            values = xr.Dataset(
+                {
+                    "value": (
+                        "dataset",
+                        [_load_value(data_dir / f) for f in filenames],
+                    )
+                },
+                coords={"dataset": filenames},
+            )
+            values.to_netcdf(store_dir / f"{group}.nc")
+        elif layout is not None:
+            store_type = "series"
+            _save_series(cubes, filenames, layout, store_dir / f"{group}.nc")
+        else:
+            store_type = "files"
+        index["groups"][group] = {
+            "type": store_type,
+            "sources": _get_sources(data_dir, filenames),
+        }
+    with (store_dir / _INDEX_FILE).open("w", encoding="utf-8") as file:
+        json.dump(index, file, indent=1)
+    return store_dir
+
+
+class ReferenceStore:
+    """Read reference datasets from consolidated store.
+
+    The store file of a variable group is only opened once the first dataset
+    of that group is requested; only the data of requested datasets is read
+    from it. If a dataset is not available in the store (e.g., because its
+    file cannot be read), `None` is returned and the original file needs to
+    be read instead.
+
+    Parameters
+    ----------
+    data_dir:
+        Data directory of a diagnostic.
+
+    """
+
+    def __init__(self, data_dir: Path) -> None:
+        """Initialize class instance."""
+        self._data_dir = data_dir
+        self._index = _load_index(data_dir) or {"groups": {}}
+        self._series: dict[str, tuple[xr.Dataset, dict[str, int]] | None] = {}
+        self._values: dict[str, dict[str, float]] = {}
+
+    def load_cube(self, path: str | Path) -> Cube | None:
+        """Load reference dataset as cube.
+
+        Parameters
+        ----------
+        path:
+            Path to reference dataset.
+
+        Returns
+        -------
+        Cube | None
+            Reference dataset. `None` if it is not available in the store.
+
+        """
+        (group, filename) = self._get_group(path, "series")
+        if group is None:
+            return None
+        store_file = self._data_dir / STORE_DIR / f"{group}.nc"
+        if group not in self._series:
+            try:
+                series = xr.open_dataset(store_file)
+            except Exception as exc:
+                logger.debug(
+                    f"Cannot open {store_file}, using original files "
+                    f"instead: {exc}"
+                )
+                self._series[group] = None
+            else:
+                datasets = series["dataset"].values.tolist()
+                self._series[group] = (
+                    series,
+                    {d: i for (i, d) in enumerate(datasets)},
+                )
+                logger.debug(f"Opened {store_file}")
+        if self._series[group] is None:
+            return None
+        (series, datasets) = self._series[group]
+        if filename not in datasets:
+            return None
+        try:
+            return _load_series(series, datasets[filename])
+        except Exception as exc:
+            logger.debug(
+                f"Cannot load '{filename}' from {store_file}, using original "
+                f"file instead: {exc}"
+            )
+            return None
+
+    def load_value(self, path: str | Path) -> float | None:
+        """Load scalar reference dataset.
+
+        Parameters
+        ----------
+        path:
+            Path to reference dataset.
+
+        Returns
+        -------
+        float | None
+            Value of reference dataset. `None` if it is not available in the
+            store.
+
+        """
+        (group, filename) = self._get_group(path, "values")
+        if group is None:
+            return None
+        if group not in self._values:
+            store_file = self._data_dir / STORE_DIR / f"{group}.nc"
+            try:
+                with xr.open_dataset(store_file) as values:
+                    self._values[group] = dict(
+                        zip(
+                            values["dataset"].values.tolist(),
+                            np.asarray(values["value"].values).tolist(),
+                            strict=True,
+                        )
+                    )
+            except Exception as exc:
+                logger.debug(
+                    f"Cannot load values from {store_file}, using original "
+                    f"files instead: {exc}"
+                )
+                self._values[group] = {}
+            else:
+                logger.debug(
+                    f"Loaded {len(self._values[group])} values from "
+                    f"{store_file}"
+                )
+        return self._values[group].get(filename)
+
+    def _get_group(
+        self,
+        path: str | Path,
+        store_type: str,
+    ) -> tuple[str, str] | tuple[None, None]:
+        """Get variable group and relative path of a reference dataset."""
+        try:
+            filename = Path(path).relative_to(self._data_dir).as_posix()
+        except ValueError:
+            return (None, None)
+        group = filename.split("/")[0]
+        group_index = self._index["groups"].get(group)
+        if (
+            group_index is None
+            or group_index["type"] != store_type
+            or filename not in group_index["sources"]
+        ):
+            return (None, None)
+        return (group, filename)
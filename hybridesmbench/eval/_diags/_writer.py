@@ -0,0 +1,220 @@
+"""Save input data of diagnostics in the background."""
+
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any
+
+import dask.array as da
+import netCDF4
+import numpy as np
+from iris.cube import Cube
+from loguru import logger
+from ncdata.iris import from_iris
+from ncdata.xarray import to_xarray
+
+from hybridesmbench._utils import get_iris_state, use_iris_state
+from hybridesmbench.exceptions import HybridESMBenchException
+from hybridesmbench.typing import Compression
+
+_Task = tuple[Cube, Path, Future]
+
+# Smaller variables are stored contiguously and uncompressed (the overhead of
+# chunking would outweigh the gain of compression)
+_MIN_CHUNKED_BYTES = 16 * 1024
+
+
+def _get_chunksizes(shape: tuple[int, ...]) -> tuple[int, ...]:
+    """Get chunk shape of variable.
+
+    Each chunk contains a single horizontal field (e.g., one month of a
+    climatology on a regular grid); 1D variables are stored in one chunk.
+
+    """
+    if len(shape) < 2:
+        return shape
+    return (1,) * (len(shape) - 2) + shape[-2:]
+
+
+class InputWriter:
+    """Save cubes to netCDF files in background threads.
+
+    Cubes are added to a bounded queue that is drained by writer threads, so
+    computations can continue while files are written. Adding a cube blocks
+    while the queue is full. Files are written atomically with
+    :meth:`xarray.Dataset.to_netcdf`, which holds xarray's netCDF lock; this
+    lock is shared with iris and ncdata (see
+    :class:`hybridesmbench.eval._dask.DaskBackend`).
+
+    Parameters
+    ----------
+    compression:
+        Compression used for all variables (``"zlib"`` or ``"zstd"``). If
+        `None`, do not compress data.
+    complevel:
+        Compression level.
+    downcast:
+        If `True`, save 64-bit floating point data as 32-bit floating point
+        data.
+    max_workers:
+        Number of writer threads.
+    max_queue_size:
+        Maximum number of cubes waiting to be written.
+
+    """
+
+    def __init__(
+        self,
+        compression: Compression | None = "zlib",
+        complevel: int = 4,
+        downcast: bool = False,
+        max_workers: int = 2,
+        max_queue_size: int = 4,
+    ) -> None:
+        """Initialize class instance."""
+        if compression not in ("zlib", "zstd", None):
+            msg = (
+                f"Got invalid compression '{compression}', must be one of "
+                f"['zlib', 'zstd', None]"
+            )
+            raise HybridESMBenchException(msg)
+        if compression == "zstd" and not getattr(
+            netCDF4, "__has_zstandard_support__", False
+        ):
+            msg = "Compression 'zstd' is not supported by the netCDF library"
+            raise HybridESMBenchException(msg)
+        self._compression = compression
+        self._complevel = complevel
+        self._downcast = downcast
+        self._max_workers = max_workers
+        self._queue: queue.Queue[_Task | None] = queue.Queue(max_queue_size)
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "InputWriter":
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Exit context manager."""
+        self.close()
+
+    def close(self) -> None:
+        """Wait until all files are written and stop writer threads.
+
+        The writer can still be used afterwards (new threads are started when
+        required).
+
+        """
+        with self._lock:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def submit(self, cube: Cube, path: Path) -> Future:
+        """Add cube to queue of files that are written.
+
+        Parameters
+        ----------
+        cube:
+            Cube that is saved. Must not be modified until it is written.
+        path:
+            Path to output file.
+
+        Returns
+        -------
+        Future
+            Future whose result is `path` once the file is written.
+
+        """
+        with self._lock:
+            if not self._threads:
+                self._threads = [
+                    threading.Thread(
+                        target=self._work,
+                        args=(get_iris_state(),),
+                        name=f"input_writer_{idx}",
+                        daemon=True,
+                    )
+                    for idx in range(self._max_workers)
+                ]
+                for thread in self._threads:
+                    thread.start()
+        future: Future = Future()
+        self._queue.put((cube, path, future))
+        return future
+
+    def _get_var_kwargs(self, variables: Any) -> dict[str, dict[str, Any]]:
+        """Get keyword arguments for creating netCDF variables."""
+        var_kwargs: dict[str, dict[str, Any]] = {}
+        for var_name, var in variables.items():
+            if (
+                var.data is None
+                or var.dtype.kind not in "fiu"
+                or var.data.nbytes < _MIN_CHUNKED_BYTES
+            ):
+                continue
+            shape = var.data.shape
+            var_kwargs[var_name] = {"chunksizes": _get_chunksizes(shape)}
+            if self._compression is not None:
+                var_kwargs[var_name].update(
+                    {
+                        "compression": self._compression,
+                        "complevel": self._complevel,
+                        "shuffle": True,
+                    }
+                )
+        return var_kwargs
+
+    def _save(self, cube: Cube, path: Path) -> None:
+        """Save cube to netCDF file (atomically)."""
+        if self._downcast and cube.dtype == np.float64:
+            cube = cube.copy(cube.core_data().astype(np.float32))
+        ncdata = from_iris(cube)
+
+        # Lazy data (e.g., coordinates) needs to be realized before writing
+        # since reading it may require the netCDF lock as well
+        for var in ncdata.variables.values():
+            if isinstance(var.data, da.Array):
+                var.data = var.data.compute()
+        var_kwargs = self._get_var_kwargs(ncdata.variables)
+
+        # Write the raw netCDF variables without any CF encoding/decoding by
+        # xarray
+        dataset = to_xarray(
+            ncdata,
+            mask_and_scale=False,
+            decode_times=False,
+            decode_coords=False,
+            decode_timedelta=False,
+        )
+        for var_name, var in dataset.variables.items():
+            var.encoding.update(var_kwargs.get(var_name, {}))
+            if "_FillValue" not in var.attrs:
+                var.encoding["_FillValue"] = None
+
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        try:
+            dataset.to_netcdf(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        logger.debug(f"Saved {path}")
+
+    def _work(self, iris_state: dict[str, Any]) -> None:
+        """Write files from queue until stopped."""
+        with use_iris_state(iris_state):
+            while (task := self._queue.get()) is not None:
+                (cube, path, future) = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    self._save(cube, path)
+                except Exception as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(path)
@@ -2,21 +2,44 @@
 
 import datetime
 import inspect
+import re
+import shutil
+import threading
 import warnings
+from concurrent.futures import Future
 from pathlib import Path
 from typing import Any
 
+import dask
 import iris
+import matplotlib.pyplot as plt
 import yaml
 from iris.cube import Cube
 from loguru import logger
 
 from hybridesmbench._utils import get_timerange
+from hybridesmbench.eval._diags._catalogue import load_catalogue
+from hybridesmbench.eval._diags._esmvaltool import check_esmvaltool_version
+from hybridesmbench.eval._diags._manifest import SessionManifest, get_hash
+from hybridesmbench.eval._diags._store import ReferenceStore
+from hybridesmbench.eval._diags._writer import InputWriter
 from hybridesmbench.eval._loaders import Loader
+from hybridesmbench.eval._preprocessor import (
+    PreprocessingPlanner,
+    PreprocessorStep,
+)
 from hybridesmbench.exceptions import (
     HybridESMBenchException,
     HybridESMBenchWarning,
 )
+from hybridesmbench.typing import Compression
+
+# Suffix of session directory names, e.g., maps_20250101_120000
+_SESSION_DIR_REGEX = re.compile(r"_\d{8}_\d{6}")
+
+# Plotting with matplotlib (as done by the ESMValTool diagnostics) is not
+# thread-safe; thus, only one diagnostic can create plots at a time
+_PLOT_LOCK = threading.Lock()
 
 
 class Diagnostic:
@@ -26,6 +49,26 @@ class Diagnostic:
     ----------
     work_dir:
         Work directory where files created by the diagnostic are stored.
+    incremental:
+        If `True`, reuse the latest session directory of this diagnostic in
+        `work_dir` (if available). Artifacts whose inputs did not change since
+        the previous run (as recorded in the session manifest, see
+        :class:`SessionManifest`) are not recomputed.
+    resume:
+        If `True`, continue the latest session of this diagnostic in
+        `work_dir` (if available). All artifacts recorded as completed in the
+        session manifest are reused without checking their inputs; variables
+        that failed to load are retried.
+    save_input_files:
+        If `True`, save the preprocessed input data of the diagnostic in the
+        session directory (needed for `incremental` and `resume`). If `False`,
+        the input data is only kept in memory.
+    input_compression:
+        Compression of the saved input data (``"zlib"`` or ``"zstd"``). If
+        `None`, do not compress data.
+    downcast_input_files:
+        If `True`, save 64-bit floating point input data as 32-bit floating
+        point data.
 
     """
 
@@ -35,21 +78,77 @@ class Diagnostic:
         self,
         work_dir: Path,
         fail_on_missing_variable: bool = True,
+        incremental: bool = False,
+        resume: bool = False,
+        save_input_files: bool = True,
+        input_compression: Compression | None = "zlib",
+        downcast_input_files: bool = False,
     ) -> None:
         """Initialize class instance."""
+        if not save_input_files and (incremental or resume):
+            msg = (
+                "Options `incremental` and `resume` require "
+                "`save_input_files=True`"
+            )
+            raise HybridESMBenchException(msg)
         self._root_dir = Path(inspect.getfile(self.__class__)).parent
         self._data_dir = self._root_dir / "data"
+        self._incremental = incremental
+        self._resume = resume
+        self._save_input_files = save_input_files
+        self._input_writer = InputWriter(
+            compression=input_compression,
+            downcast=downcast_input_files,
+        )
+        self._manifest: SessionManifest | None = None
         self._session_dir = self._get_session_dir(work_dir)
         self._fail_on_missing_variable = fail_on_missing_variable
         logger.debug(f"Initialized diagnostic '{self.name}'")
 
-    def run(self, loader: Loader, **kwargs: Any) -> Path:
+    def plan_preprocessing(self, planner: PreprocessingPlanner) -> None:
+        """Register preprocessing chains of all variables in planner.
+
+        Does nothing by default.
+
+        Parameters
+        ----------
+        planner:
+            Preprocessing planner.
+
+        """
+
+    def discard_preprocessing(self, planner: PreprocessingPlanner) -> None:
+        """Unregister preprocessing chains that have not been run yet.
+
+        This releases shared results that are only kept for this diagnostic
+        (e.g., after it failed). Does nothing by default.
+
+        Parameters
+        ----------
+        planner:
+            Preprocessing planner.
+
+        """
+
+    def run(
+        self,
+        loader: Loader,
+        planner: PreprocessingPlanner | None = None,
+        **kwargs: Any,
+    ) -> Path:
         """Run diagnostics.
 
         Parameters
         ----------
         loader:
             Loader instance of hybrid Earth system model output.
+        planner:
+            Preprocessing planner shared with other diagnostics. Needs to use
+            the same `loader` and preprocessing chains of this diagnostic need
+            to be registered already (see :meth:`plan_preprocessing`). If
+            `None`, use a new planner that is only used by this diagnostic.
+            Chains that have not been run when the diagnostic fails are
+            unregistered (see :meth:`discard_preprocessing`).
         **kwargs
             Additional keyword arguments for running a diagnostic.
 
@@ -61,14 +160,26 @@ class Diagnostic:
         """
         logger.debug(f"Running diagnostic '{self.name}'")
 
-        self.session_dir.mkdir(parents=True, exist_ok=True)
-        self.input_dir.mkdir(parents=True, exist_ok=True)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        logger.debug(f"Created session directory {self.session_dir}")
-        logger.debug(f"Created input directory {self.input_dir}")
-        logger.debug(f"Created output directory {self.output_dir}")
-
-        self._run_diag(loader, **kwargs)
+        if planner is None:
+            planner = PreprocessingPlanner(loader)
+            self.plan_preprocessing(planner)
+        try:
+            self.session_dir.mkdir(parents=True, exist_ok=True)
+            self.input_dir.mkdir(parents=True, exist_ok=True)
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            logger.debug(f"Created session directory {self.session_dir}")
+            logger.debug(f"Created input directory {self.input_dir}")
+            logger.debug(f"Created output directory {self.output_dir}")
+            # Only sessions that can be continued need to keep track of their
+            # artifacts
+            if self._incremental or self._resume:
+                self._manifest = SessionManifest(self.session_dir)
+            self._run_diag(loader, planner, **kwargs)
+        except BaseException:
+            # Shared results of other diagnostics must not be kept alive for
+            # chains that will never run
+            self.discard_preprocessing(planner)
+            raise
 
         logger.debug(f"Finished diagnostic '{self.name}'")
 
@@ -117,11 +228,26 @@ class Diagnostic:
 
     def _get_session_dir(self, work_dir: Path) -> Path:
         """Get session directory."""
+        if self._incremental or self._resume:
+            session_dirs = sorted(
+                d
+                for d in work_dir.glob(f"{self.name}_*")
+                if _SESSION_DIR_REGEX.fullmatch(d.name.removeprefix(self.name))
+                and (d / SessionManifest.FILE_NAME).is_file()
+            )
+            if session_dirs:
+                logger.debug(f"Reusing session directory {session_dirs[-1]}")
+                return session_dirs[-1]
         now = datetime.datetime.now(datetime.UTC).strftime("%Y%m%d_%H%M%S")
         session_dir = work_dir / f"{self.name}_{now}"
         return session_dir
 
-    def _run_diag(self, loader: Loader, **kwargs: Any) -> None:
+    def _run_diag(
+        self,
+        loader: Loader,
+        planner: PreprocessingPlanner,
+        **kwargs: Any,
+    ) -> None:
         """Run diagnostic function.
 
         Should be implemented by child classes.
@@ -147,9 +273,64 @@ class ESMValToolDiagnostic(Diagnostic):
     }
     _DIAG_CFG: dict[str, Any]
 
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """Initialize class instance."""
+        check_esmvaltool_version()
+        super().__init__(*args, **kwargs)
+
+        # In-memory registry of preprocessed input data (keyed by filename)
+        # that is handed to the ESMValTool diagnostic without reading files
+        self._cubes: dict[str, Cube] = {}
+        self._reference_store = ReferenceStore(self._data_dir)
+
+        # Input files that are written in the background (keyed by variable
+        # ID) and hashes of their inputs
+        self._pending_files: dict[str, tuple[Future, str | None]] = {}
+
+        # Preprocessor steps of variables whose chains are registered in the
+        # planner but have not been handed to it yet
+        self._planned: dict[str, list[PreprocessorStep]] = {}
+
+    def plan_preprocessing(self, planner: PreprocessingPlanner) -> None:
+        """Register preprocessing chains of all variables in planner.
+
+        Parameters
+        ----------
+        planner:
+            Preprocessing planner.
+
+        """
+        # Steps of all variables are determined first so that either all or
+        # none of the chains are registered
+        planned = {
+            var_id: self._get_preprocessor(var_id) for var_id in self._VARS
+        }
+        for var_id, steps in planned.items():
+            planner.add(self._VARS[var_id], steps)
+        self._planned = planned
+
+    def discard_preprocessing(self, planner: PreprocessingPlanner) -> None:
+        """Unregister preprocessing chains that have not been run yet.
+
+        Parameters
+        ----------
+        planner:
+            Preprocessing planner.
+
+        """
+        for var_id, steps in self._planned.items():
+            planner.discard(self._VARS[var_id], steps)
+        if self._planned:
+            logger.debug(
+                f"Discarded {len(self._planned)} preprocessing chains of "
+                f"diagnostic '{self.name}'"
+            )
+        self._planned = {}
+
     def _get_cfg(
         self,
         loader: Loader,
+        planner: PreprocessingPlanner,
         **additional_cfg: Any,
     ) -> dict[str, Any]:
         """Get configuration dictionary for ESMValTool diagnostic."""
@@ -169,70 +350,154 @@ class ESMValToolDiagnostic(Diagnostic):
 
         # Setup input data
         metadata_dict: dict[str, dict] = {}
+        new_cubes: dict[str, tuple[Path, Cube]] = {}
+        new_keys: dict[str, str | None] = {}
+        self._cubes = {}
+        self._reference_store = ReferenceStore(self._data_dir)
+        self._pending_files = {}
         file_idx = 0
 
         # Hybrid ESM input data
         logger.debug(
             f"Using variables {list(self._VARS)} for diagnostic '{self.name}'"
         )
+        if self._resume and self._manifest is not None:
+            failed_variables = self._manifest.failed_variables
+            if failed_variables:
+                logger.debug(f"Retrying failed variables {failed_variables}")
+
+        # Variables that need to be loaded are prefetched in the background so
+        # that opening and fixing files overlaps with preprocessing
+        all_steps: dict[str, list[PreprocessorStep]] = {}
+        all_paths: dict[str, Path] = {}
+        all_keys: dict[str, str | None] = {}
+        to_load: list[str] = []
         for var_id, var_dict in self._VARS.items():
-            try:
-                cube = loader.load_variable(**var_dict)
-            except Exception as exc:
-                msg = (
-                    f"Failed to extract variable '{var_id}' from {loader.path}"
-                )
-                if self._fail_on_missing_variable:
-                    raise HybridESMBenchException(msg)
-                msg = f"{msg}: {exc}"
-                warnings.warn(msg, HybridESMBenchWarning, stacklevel=2)
-                continue
-            logger.debug(
-                f"Running preprocessor on variable '{var_id}' for diagnostic "
-                f"'{self.name}'"
+            all_steps[var_id] = self._get_preprocessor(var_id)
+            all_paths[var_id] = (
+                self.input_dir / f"{var_id}_{loader.path.name}.nc"
             )
-            cube = self._preprocess(var_id, cube)
-            path = self.input_dir / f"{var_id}_{loader.path.name}.nc"
-            logger.debug(f"Saving {path}")
-            iris.save(cube, path)
-            logger.debug(f"Saved {path}")
-
-            # Setup metadata for hybrid ESM output
-            metadata = loader.get_metadata(**var_dict)
-            metadata["diagnostic"] = self.name
-            metadata["filename"] = str(path)
-            metadata["preprocessor"] = f"{self.name}_preprocessor"
-            metadata["recipe_dataset_index"] = file_idx
-            metadata["variable_group"] = var_id
-
-            # Data-specific metadata
-            metadata["long_name"] = cube.long_name
-            metadata["short_name"] = cube.var_name
-            metadata["standard_name"] = cube.standard_name
-            metadata["units"] = str(cube.units)
-            timerange = get_timerange(cube)
-            if timerange is not None:
-                metadata["timerange"] = timerange
-                metadata["start_year"] = timerange.split("/")[0][:4]
-                metadata["end_year"] = timerange.split("/")[1][:4]
-
-            metadata = self._update_metadata(var_id, loader, metadata)
-
-            metadata_dict[str(path)] = metadata
-            file_idx += 1
-
-        # Other input data
-        for metadata_file in self._data_dir.rglob("metadata.yml"):
-            with metadata_file.open("r", encoding="utf-8") as file:
-                metadata = yaml.safe_load(file)
-                logger.debug(f"Loaded metadata file {metadata_file}")
-
-            for filename in metadata:
-                filepath = str(self._data_dir / filename)
-                metadata_dict[filepath] = metadata[filename]
-                metadata_dict[filepath]["filename"] = filepath
-                metadata_dict[filepath]["recipe_dataset_index"] = file_idx
+            # Hashing the inputs requires stat'ing all model files, which is
+            # only worth it if the session can be continued
+            all_keys[var_id] = None
+            if self._manifest is not None:
+                all_keys[var_id] = self._get_variable_key(
+                    var_dict, all_steps[var_id], loader, planner
+                )
+            if not self._can_reuse_variable(
+                var_id, all_keys[var_id], all_paths[var_id]
+            ):
+                planner.prefetch(var_dict, all_steps[var_id])
+                to_load.append(var_id)
+
+        try:
+            for var_id, var_dict in self._VARS.items():
+                steps = all_steps[var_id]
+                path = all_paths[var_id]
+                key = all_keys[var_id]
+
+                # From here on, the chain is unregistered by the planner
+                # (see below)
+                self._planned.pop(var_id, None)
+                if var_id not in to_load:
+                    planner.discard(var_dict, steps)
+                    logger.debug(f"Reusing variable '{var_id}' from {path}")
+                    cube = iris.load_cube(path)
+                    self._cubes[str(path)] = cube
+                else:
+                    to_load.remove(var_id)
+
+                    try:
+                        (cube, n_applied) = planner.load_variable(
+                            var_dict, steps
+                        )
+                    except Exception as exc:
+                        planner.discard(var_dict, steps)
+                        msg = (
+                            f"Failed to extract variable '{var_id}' from "
+                            f"{loader.path}"
+                        )
+                        if self._manifest is not None:
+                            self._manifest.set_variable_failed(
+                                var_id, f"{msg}: {exc}"
+                            )
+                            self._manifest.save()
+                        if self._fail_on_missing_variable:
+                            raise HybridESMBenchException(msg)
+                        msg = f"{msg}: {exc}"
+                        warnings.warn(msg, HybridESMBenchWarning, stacklevel=2)
+                        continue
+                    logger.debug(
+                        f"Running preprocessor on variable '{var_id}' for "
+                        f"diagnostic '{self.name}'"
+                    )
+                    cube = planner.preprocess(var_dict, steps, cube, n_applied)
+                    new_cubes[var_id] = (path, cube)
+                    new_keys[var_id] = key
+
+                # Setup metadata for hybrid ESM output
+                metadata = loader.get_metadata(**var_dict)
+                metadata["diagnostic"] = self.name
+                metadata["filename"] = str(path)
+                metadata["preprocessor"] = f"{self.name}_preprocessor"
+                metadata["recipe_dataset_index"] = file_idx
+                metadata["variable_group"] = var_id
+
+                # Data-specific metadata
+                metadata["long_name"] = cube.long_name
+                metadata["short_name"] = cube.var_name
+                metadata["standard_name"] = cube.standard_name
+                metadata["units"] = str(cube.units)
+                timerange = get_timerange(cube)
+                if timerange is not None:
+                    metadata["timerange"] = timerange
+                    metadata["start_year"] = timerange.split("/")[0][:4]
+                    metadata["end_year"] = timerange.split("/")[1][:4]
+
+                metadata = self._update_metadata(var_id, loader, metadata)
+
+                metadata_dict[str(path)] = metadata
                 file_idx += 1
+        finally:
+            # Prefetched variables that are not used anymore (e.g., because
+            # of an error) must not block prefetching of other variables
+            for var_id in to_load:
+                planner.cancel_prefetch(self._VARS[var_id], all_steps[var_id])
+
+        # Compute data of all variables at once so that the dask scheduler
+        # can overlap I/O and computations across variables; the results are
+        # handed to the ESMValTool diagnostic in memory
+        logger.debug(
+            f"Computing {len(new_cubes)} variables for diagnostic "
+            f"'{self.name}'"
+        )
+        if self._manifest is not None:
+            for var_id in new_keys:
+                self._manifest.discard_variable(var_id)
+            self._manifest.save()
+        arrays = dask.compute(
+            *[c.core_data() for (_, c) in new_cubes.values()]
+        )
+        for (path, cube), array in zip(
+            new_cubes.values(), arrays, strict=True
+        ):
+            cube.data = array
+            self._cubes[str(path)] = cube
+
+        # Files are written in the background while the diagnostic runs (the
+        # cubes are copied since the diagnostic may modify them in-place)
+        if self._save_input_files:
+            for var_id, (path, cube) in new_cubes.items():
+                future = self._input_writer.submit(cube.copy(), path)
+                self._pending_files[var_id] = (future, new_keys[var_id])
+
+        # Other input data (from compiled catalogue of all metadata.yml files)
+        for filename, metadata in load_catalogue(self._data_dir).items():
+            filepath = str(self._data_dir / filename)
+            metadata_dict[filepath] = metadata
+            metadata_dict[filepath]["filename"] = filepath
+            metadata_dict[filepath]["recipe_dataset_index"] = file_idx
+            file_idx += 1
 
         new_metadata_file = self.input_dir / "metadata.yml"
         with new_metadata_file.open("w", encoding="utf-8") as file:
@@ -259,16 +524,149 @@ class ESMValToolDiagnostic(Diagnostic):
 
         return cfg
 
-    def _preprocess(self, var_id: str, cube: Cube) -> Cube:
-        """Preprocess input data."""
-        return cube
+    def _get_preprocessor(self, var_id: str) -> list[PreprocessorStep]:
+        """Get preprocessor steps for variable."""
+        return []
+
+    def _can_reuse_variable(
+        self,
+        var_id: str,
+        key: str | None,
+        path: Path,
+    ) -> bool:
+        """Check if preprocessed variable of previous run can be reused."""
+        if self._manifest is None:
+            return False
+        if self._incremental:
+            return key is not None and self._manifest.is_variable_done(
+                var_id, path, key
+            )
+        return self._manifest.is_variable_done(var_id, path)
+
+    def _get_variable_key(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+        loader: Loader,
+        planner: PreprocessingPlanner,
+    ) -> str | None:
+        """Get hash of all inputs of a preprocessed variable.
+
+        Returns `None` if the inputs cannot be determined.
+
+        """
+        try:
+            fingerprint = loader.get_fingerprint(**var_dict)
+        except Exception as exc:
+            logger.debug(f"Cannot get fingerprint of {var_dict}: {exc}")
+            return None
+        return get_hash(
+            {
+                "fingerprint": fingerprint,
+                "var_dict": var_dict,
+                "steps": steps,
+                "preprocessing_mode": planner.mode,
+            }
+        )
 
-    def _run_diag(self, loader: Loader, **kwargs: Any) -> None:
+    def _run_diag(
+        self,
+        loader: Loader,
+        planner: PreprocessingPlanner,
+        **kwargs: Any,
+    ) -> None:
         """Run diagnostic function."""
         logger.debug(f"Creating cfg for ESMValTool diagnostic '{self.name}'")
-        cfg = self._get_cfg(loader, **kwargs)
+        cfg = self._get_cfg(loader, planner, **kwargs)
+        try:
+            diag_key = self._run_esmvaltool_diag_if_outdated(cfg)
+        finally:
+            self._wait_for_input_files()
+        if self._manifest is not None and diag_key is not None:
+            self._manifest.set_diagnostic(diag_key)
+            self._manifest.save()
+
+    def _run_esmvaltool_diag_if_outdated(
+        self,
+        cfg: dict[str, Any],
+    ) -> str | None:
+        """Run ESMValTool diagnostic if any of its inputs changed.
+
+        Returns the hash of all inputs of the diagnostic if it has been run,
+        `None` otherwise.
+
+        """
+        # When continuing a session, only rerun diagnostic if any input
+        # changed
+        diag_key: str | None = None
+        if self._manifest is not None:
+            variables = {
+                **self._manifest.variables,
+                **{v: k for (v, (_, k)) in self._pending_files.items()},
+            }
+            diag_key = get_hash({"cfg": cfg, "variables": variables})
+            if self._manifest.is_diagnostic_done(diag_key):
+                logger.debug(
+                    f"Skipping ESMValTool diagnostic '{self.name}', output "
+                    f"in {self.output_dir} is up to date"
+                )
+                return None
+            self._manifest.discard_diagnostic()
+            self._manifest.save()
+
+            # ESMValTool diagnostics do not overwrite existing output of
+            # previous runs (directories of fresh sessions are empty)
+            for dir_name in ("plot_dir", "run_dir", "work_dir"):
+                shutil.rmtree(cfg[dir_name])
+                Path(cfg[dir_name]).mkdir(parents=True)
+
         logger.debug(f"Running ESMValTool diagnostic '{self.name}'")
-        self._run_esmvaltool_diag(cfg)
+        with _PLOT_LOCK:
+            try:
+                self._run_esmvaltool_diag(cfg)
+            finally:
+                # Do not leave (possibly unfinished) figures behind that
+                # would be picked up by pyplot in other diagnostics
+                plt.close("all")
+                self._cubes = {}
+        return diag_key
+
+    def _wait_for_input_files(self) -> None:
+        """Wait until all input files are written and record them."""
+        if not self._pending_files:
+            return
+        logger.debug(
+            f"Waiting for {len(self._pending_files)} input files of "
+            f"diagnostic '{self.name}'"
+        )
+        errors: list[str] = []
+        for var_id, (future, key) in self._pending_files.items():
+            try:
+                future.result()
+            except Exception as exc:
+                errors.append(f"'{var_id}': {exc}")
+                continue
+            if self._manifest is not None:
+                self._manifest.set_variable(var_id, key)
+        if self._manifest is not None:
+            self._manifest.save()
+        self._pending_files = {}
+        self._input_writer.close()
+        if errors:
+            msg = f"Failed to save input files of variables {errors}"
+            raise HybridESMBenchException(msg)
+        logger.debug(f"Saved input files in {self.input_dir}")
+
+    def _load_cube(self, filename: str) -> Cube | None:
+        """Load cube of input file from memory.
+
+        Returns `None` if the cube is neither available in the registry of
+        preprocessed input data nor in the reference store.
+
+        """
+        if filename in self._cubes:
+            return self._cubes[filename]
+        return self._reference_store.load_cube(filename)
 
     def _run_esmvaltool_diag(self, cfg: dict[str, Any]) -> None:
         """Run ESMValTool diagnostic.
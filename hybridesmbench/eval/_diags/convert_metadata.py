@@ -1,7 +1,26 @@
-"""Make ESMValTool metadata.yml files HybridESMBench-compatible."""
+"""Make ESMValTool metadata.yml files HybridESMBench-compatible.
 
+Afterwards, compile all metadata.yml files of each diagnostic into a single
+catalogue file (``data/catalogue.json``) that can be loaded quickly, and
+consolidate the reference datasets of each variable group into a single file
+(``data/store/``). Run with ``--check`` to only check that all catalogues and
+stores are up to date.
+
+"""
+
+import argparse
+import sys
 from pathlib import Path
 
+from hybridesmbench.eval._diags._catalogue import (
+    check_catalogue,
+    save_catalogue,
+)
+from hybridesmbench.eval._diags._store import check_store, save_store
+
+# Diagnostics that read reference datasets from a store
+STORE_DIAGNOSTICS = ("portrait_plot", "timeseries")
+
 
 def main() -> None:
     """Make ESMValTool metadata.yml files HybridESMBench-compatible."""
@@ -18,6 +37,40 @@ def main() -> None:
         metadata_file.write_text(new_metadata, encoding="utf-8")
         print("   -> Converted")
 
+    for data_dir in sorted(Path(__file__).parent.glob("*/data")):
+        catalogue_file = save_catalogue(data_dir)
+        print(f"Wrote {catalogue_file}")
+        if data_dir.parent.name in STORE_DIAGNOSTICS:
+            store_dir = save_store(data_dir)
+            print(f"Wrote {store_dir}")
+
+
+def check() -> bool:
+    """Check that all catalogues and stores match their sources."""
+    valid = True
+    for data_dir in sorted(Path(__file__).parent.glob("*/data")):
+        if check_catalogue(data_dir):
+            print(f"Catalogue of {data_dir} is up to date")
+        else:
+            print(f"Catalogue of {data_dir} is missing or outdated")
+            valid = False
+        if data_dir.parent.name not in STORE_DIAGNOSTICS:
+            continue
+        if check_store(data_dir):
+            print(f"Store of {data_dir} is up to date")
+        else:
+            print(f"Store of {data_dir} is missing or outdated")
+            valid = False
+    return valid
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only check that all catalogues and stores are up to date",
+    )
+    if parser.parse_args().check:
+        sys.exit(0 if check() else 1)
     main()
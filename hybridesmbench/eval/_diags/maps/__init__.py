@@ -3,21 +3,10 @@
 import warnings
 from typing import Any
 
-from esmvalcore.preprocessor import (
-    climate_statistics,
-    convert_units,
-    regrid,
-)
-from esmvaltool.diag_scripts.monitor.multi_datasets import MultiDatasets
-from iris import Constraint
-from iris.cube import Cube
-
-from hybridesmbench._utils import (
-    extract_final_20_years,
-    extract_vertical_level,
-)
 from hybridesmbench.eval._diags import ESMValToolDiagnostic
+from hybridesmbench.eval._diags._esmvaltool import InMemoryMultiDatasets
 from hybridesmbench.eval._loaders import Loader
+from hybridesmbench.eval._preprocessor import PreprocessorStep
 
 
 class MapsDiagnostic(ESMValToolDiagnostic):
@@ -69,16 +58,27 @@ class MapsDiagnostic(ESMValToolDiagnostic):
         "ua85000": {"var_name": "ua", "mip_table": "Amon"},
     }
 
-    def _preprocess(self, var_id: str, cube: Cube) -> Cube:
-        """Preprocess input data."""
-        cube = cube.extract(Constraint(time=lambda c: c.point.year >= 1979))
-        cube = extract_final_20_years(cube)
-        cube = extract_vertical_level(var_id, cube, coordinate="air_pressure")
-        cube = regrid(cube, "2x2", "area_weighted", cache_weights=True)
-        cube = climate_statistics(cube, operator="mean", period="full")
-        if cube.var_name == "pr":
-            cube = convert_units(cube, "mm day-1")
-        return cube
+    def _get_preprocessor(self, var_id: str) -> list[PreprocessorStep]:
+        """Get preprocessor steps for variable."""
+        steps: list[PreprocessorStep] = [
+            ("extract_years", {"start_year": 1979, "last_n_years": 20}),
+            (
+                "extract_vertical_level",
+                {"var_id": var_id, "coordinate": "air_pressure"},
+            ),
+            (
+                "regrid",
+                {
+                    "target_grid": "2x2",
+                    "scheme": "area_weighted",
+                    "cache_weights": True,
+                },
+            ),
+            ("climate_statistics", {"operator": "mean", "period": "full"}),
+        ]
+        if self._VARS[var_id]["var_name"] == "pr":
+            steps.append(("convert_units", {"units": "mm day-1"}))
+        return steps
 
     def _run_esmvaltool_diag(self, cfg: dict[str, Any]) -> None:
         """Run ESMValTool diagnostic."""
@@ -91,7 +91,7 @@ class MapsDiagnostic(ESMValToolDiagnostic):
                 category=UserWarning,
                 module="iris",
             )
-            MultiDatasets(cfg).compute()
+            InMemoryMultiDatasets(cfg, self._load_cube).compute()
 
     def _update_cfg(
         self,
@@ -1,22 +1,13 @@
 """Run portrait plot diagnostic."""
 
+from pathlib import Path
 from typing import Any
 
-import iris
-from esmvalcore.preprocessor import (
-    climate_statistics,
-    distance_metric,
-    regrid,
-)
-from esmvaltool.diag_scripts.portrait_plot import main
-from iris import Constraint
-from iris.cube import Cube
+import numpy as np
 
-from hybridesmbench._utils import (
-    extract_final_20_years,
-    extract_vertical_level,
-)
+from hybridesmbench.eval._diags._esmvaltool import run_portrait_plot
 from hybridesmbench.eval._diags.base import ESMValToolDiagnostic
+from hybridesmbench.eval._preprocessor import PreprocessorStep
 from hybridesmbench.exceptions import HybridESMBenchException
 
 
@@ -64,7 +55,7 @@ class PortraiPlotDiagnostic(ESMValToolDiagnostic):
         "ua85000": {"var_name": "ua", "mip_table": "Amon"},
     }
 
-    def _get_ref_cube(self, var_id: str) -> Cube:
+    def _get_ref_path(self, var_id: str) -> Path:
         """Get reference data for calculation of distance metrics."""
         ref_dir = self._data_dir / "references" / var_id
         ref_paths = list(ref_dir.glob("*.nc"))
@@ -73,19 +64,41 @@ class PortraiPlotDiagnostic(ESMValToolDiagnostic):
                 f"Expected exactly 1 reference dataset for variable "
                 f"'{var_id}' located at {ref_dir}/*.nc, got {len(ref_paths)}"
             )
-        return iris.load_cube(ref_paths[0])
+        return ref_paths[0]
 
-    def _preprocess(self, var_id: str, cube: Cube) -> Cube:
-        """Preprocess input data."""
-        cube = cube.extract(Constraint(time=lambda c: c.point.year >= 1979))
-        cube = extract_final_20_years(cube)
-        cube = extract_vertical_level(var_id, cube, coordinate="air_pressure")
-        cube = regrid(cube, "2x2", "area_weighted", cache_weights=True)
-        cube = climate_statistics(cube, operator="mean", period="month")
-        ref_cube = self._get_ref_cube(var_id)
-        cube = distance_metric([cube], "weighted_rmse", reference=ref_cube)[0]
-        return cube
+    def _get_preprocessor(self, var_id: str) -> list[PreprocessorStep]:
+        """Get preprocessor steps for variable."""
+        return [
+            ("extract_years", {"start_year": 1979, "last_n_years": 20}),
+            (
+                "extract_vertical_level",
+                {"var_id": var_id, "coordinate": "air_pressure"},
+            ),
+            (
+                "regrid",
+                {
+                    "target_grid": "2x2",
+                    "scheme": "area_weighted",
+                    "cache_weights": True,
+                },
+            ),
+            ("climate_statistics", {"operator": "mean", "period": "month"}),
+            (
+                "distance_to_reference",
+                {
+                    "metric": "weighted_rmse",
+                    "reference": str(self._get_ref_path(var_id)),
+                },
+            ),
+        ]
+
+    def _load_value(self, filename: str) -> float | None:
+        """Load scalar input data from memory (if available)."""
+        cube = self._load_cube(filename)
+        if cube is not None:
+            return np.ma.filled(cube.data, np.nan).item()
+        return self._reference_store.load_value(filename)
 
     def _run_esmvaltool_diag(self, cfg: dict[str, Any]) -> None:
         """Run ESMValTool diagnostic."""
-        return main(cfg)
+        run_portrait_plot(cfg, self._load_value)
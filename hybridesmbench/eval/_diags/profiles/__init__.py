@@ -3,19 +3,11 @@
 import warnings
 from typing import Any
 
-from esmvalcore.preprocessor import (
-    climate_statistics,
-    extract_levels,
-    regrid,
-    zonal_statistics,
-)
-from esmvaltool.diag_scripts.monitor.multi_datasets import MultiDatasets
-from iris import Constraint
-from iris.cube import Cube
-
-from hybridesmbench._utils import PLEV_19_LEVELS, extract_final_20_years
+from hybridesmbench._utils import PLEV_19_LEVELS
 from hybridesmbench.eval._diags import ESMValToolDiagnostic
+from hybridesmbench.eval._diags._esmvaltool import InMemoryMultiDatasets
 from hybridesmbench.eval._loaders import Loader
+from hybridesmbench.eval._preprocessor import PreprocessorStep
 
 
 class ProfilesDiagnostic(ESMValToolDiagnostic):
@@ -51,20 +43,28 @@ class ProfilesDiagnostic(ESMValToolDiagnostic):
         "ua": {"var_name": "ua", "mip_table": "Amon"},
     }
 
-    def _preprocess(self, var_id: str, cube: Cube) -> Cube:
-        """Preprocess input data."""
-        cube = cube.extract(Constraint(time=lambda c: c.point.year >= 1979))
-        cube = extract_final_20_years(cube)
-        cube = extract_levels(
-            cube,
-            PLEV_19_LEVELS,
-            "linear",
-            coordinate="air_pressure",
-        )
-        cube = regrid(cube, "2x2", "area_weighted", cache_weights=True)
-        cube = zonal_statistics(cube, "mean")
-        cube = climate_statistics(cube, operator="mean", period="full")
-        return cube
+    def _get_preprocessor(self, var_id: str) -> list[PreprocessorStep]:
+        """Get preprocessor steps for variable."""
+        return [
+            ("extract_years", {"start_year": 1979, "last_n_years": 20}),
+            (
+                "extract_levels",
+                {
+                    "levels": PLEV_19_LEVELS,
+                    "scheme": "linear",
+                    "coordinate": "air_pressure",
+                },
+            ),
+            (
+                "zonal_mean",
+                {
+                    "target_grid": "2x2",
+                    "scheme": "area_weighted",
+                    "cache_weights": True,
+                },
+            ),
+            ("climate_statistics", {"operator": "mean", "period": "full"}),
+        ]
 
     def _run_esmvaltool_diag(self, cfg: dict[str, Any]) -> None:
         """Run ESMValTool diagnostic."""
@@ -77,7 +77,7 @@ class ProfilesDiagnostic(ESMValToolDiagnostic):
                 category=UserWarning,
                 module="iris",
             )
-            MultiDatasets(cfg).compute()
+            InMemoryMultiDatasets(cfg, self._load_cube).compute()
 
     def _update_cfg(
         self,
@@ -0,0 +1,508 @@
+"""Cache data loaded by a loader."""
+
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, TypeVar
+
+import esmvalcore
+import iris
+import numpy as np
+import xarray as xr
+from cf_units import Unit
+from iris.cube import Cube
+from loguru import logger
+
+from hybridesmbench._utils import get_iris_state, use_iris_state
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+
+def get_nbytes(value: Any) -> int:
+    """Get number of bytes that a cached object keeps in memory.
+
+    Only realized (i.e., non-lazy) arrays are counted.
+
+    """
+    if isinstance(value, Cube):
+        arrays = [] if value.has_lazy_data() else [value.data]
+        for coord in value.coords():
+            if not coord.has_lazy_points():
+                arrays.append(coord.points)
+            if coord.has_bounds() and not coord.has_lazy_bounds():
+                arrays.append(coord.bounds)
+        return sum(a.nbytes for a in arrays)
+    if isinstance(value, xr.Dataset):
+        return sum(
+            v.nbytes for v in value.variables.values() if v.chunks is None
+        )
+    return 0
+
+
+def get_file_stats(files: Iterable[Path]) -> list[list[Any]]:
+    """Get absolute paths, sizes and modification times of files."""
+    file_stats = []
+    for path in files:
+        stat = os.stat(path)
+        file_stats.append(
+            [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+        )
+    return file_stats
+
+
+class LoaderCache:
+    """Least recently used (LRU) cache for data loaded by a loader.
+
+    Objects with a ``close()`` method (e.g., :class:`xarray.Dataset`) are
+    closed when they are evicted from the cache to release their file
+    handles.
+
+    Parameters
+    ----------
+    max_items:
+        Maximum number of cached objects. If `None`, do not limit the number
+        of objects.
+    max_bytes:
+        Maximum number of bytes that cached objects keep in memory (only
+        realized arrays are counted, lazy data is not). If `None`, do not
+        limit the memory usage.
+
+    Note
+    ----
+    This class is thread-safe. Its lock is only held to look up and insert
+    objects, so different objects are loaded concurrently. Threads that
+    request an object which is currently loaded by another thread wait for
+    it (each object is only loaded once).
+
+    """
+
+    def __init__(
+        self,
+        max_items: int | None = 128,
+        max_bytes: int | None = None,
+    ) -> None:
+        """Initialize class instance."""
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        self._loading: dict[Hashable, Future[Any]] = {}
+
+    def __len__(self) -> int:
+        """Get number of cached objects."""
+        with self._lock:
+            return len(self._data)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Get cache statistics.
+
+        This includes the number of `hits`, `misses`, and `evictions`, and the
+        current number of cached objects (`items`) and bytes (`nbytes`).
+
+        """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "items": len(self._data),
+                "nbytes": self._nbytes,
+            }
+
+    def clear(self) -> None:
+        """Remove (and close) all cached objects."""
+        with self._lock:
+            while self._data:
+                self._evict()
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """Get cached object or load and cache it if necessary.
+
+        Parameters
+        ----------
+        key:
+            Key of the object.
+        load:
+            Function (without arguments) that loads the object.
+
+        Returns
+        -------
+        Any
+            Cached or loaded object.
+
+        """
+        with self._lock:
+            if key in self._data:
+                self._hits += 1
+                self._data.move_to_end(key)
+                return self._data[key][0]
+            future = self._loading.get(key)
+            if future is None:
+                self._misses += 1
+                future = Future()
+                self._loading[key] = future
+                is_loading = True
+            else:
+                self._hits += 1
+                is_loading = False
+        if not is_loading:
+            return future.result()
+
+        # Load object without holding the lock
+        try:
+            value = load()
+        except BaseException as exc:
+            with self._lock:
+                self._loading.pop(key)
+            future.set_exception(exc)
+            raise
+        nbytes = get_nbytes(value)
+        with self._lock:
+            self._loading.pop(key)
+            self._data[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while len(self._data) > 1 and self._exceeds_limits():
+                self._evict()
+        future.set_result(value)
+        return value
+
+    def _evict(self) -> None:
+        """Remove (and close) least recently used object (must hold lock)."""
+        (key, (value, nbytes)) = self._data.popitem(last=False)
+        self._nbytes -= nbytes
+        self._evictions += 1
+        logger.debug(f"Evicted {key} from loader cache")
+        if callable(getattr(value, "close", None)):
+            value.close()
+
+    def _exceeds_limits(self) -> bool:
+        """Check if cache exceeds its limits (must hold the lock)."""
+        if self._max_items is not None and len(self._data) > self._max_items:
+            return True
+        if self._max_bytes is not None and self._nbytes > self._max_bytes:
+            return True
+        return False
+
+
+class CMORizedCache:
+    """Persistently cache fixed (i.e., CMORized) variables on disk.
+
+    Fixed variables are stored as chunked netCDF files in `cache_dir`. They
+    are keyed by the paths, sizes and modification times of the source files,
+    the variable facets, and the versions of the cache, the loader and
+    ESMValCore (which provides the fixes).
+
+    Files are written in a background thread, so that the fixed variable can
+    be used immediately. A file is only used once it has been written
+    completely and the variable loaded from it has the same metadata as the
+    fixed variable (including its mesh, coordinates, cell measures and
+    ancillary variables). If the total size of the cache exceeds `max_bytes`,
+    the least recently used files are removed.
+
+    Parameters
+    ----------
+    cache_dir:
+        Directory where the fixed variables are stored.
+    loader_id:
+        Identifier of the loader (including its version).
+    max_bytes:
+        Maximum total size of the cache in bytes.
+
+    """
+
+    _VERSION = 2
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        loader_id: str,
+        max_bytes: int = 10 * 1024**3,
+    ) -> None:
+        """Initialize class instance."""
+        self._cache_dir = cache_dir
+        self._loader_id = loader_id
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: set[Path] = set()
+
+        # Files loaded by this instance are never evicted since lazy data
+        # loaded from them may still be in use
+        self._used_files: set[Path] = set()
+
+    def close(self) -> None:
+        """Wait until all files have been written.
+
+        The cache can still be used afterwards.
+
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def get_or_fix(
+        self,
+        files: Iterable[Path],
+        fix: Callable[[], Cube],
+        **facets: Any,
+    ) -> Cube:
+        """Load cached fixed variable or fix and cache it if necessary.
+
+        Parameters
+        ----------
+        files:
+            Source files of the variable.
+        fix:
+            Function (without arguments) that loads and fixes the variable.
+        **facets:
+            Facets that describe the variable (e.g., variable name and MIP
+            table).
+
+        Returns
+        -------
+        Cube
+            Fixed variable.
+
+        """
+        cache_file = self._get_cache_file(files, facets)
+        if cache_file.exists():
+            try:
+                cube = iris.load_cube(cache_file)
+            except Exception as exc:
+                logger.debug(
+                    f"Cannot load cached fixed variable {cache_file}: {exc}"
+                )
+            else:
+                with self._lock:
+                    self._used_files.add(cache_file)
+                os.utime(cache_file)  # mark file as recently used
+                logger.debug(f"Loaded cached fixed variable {cache_file}")
+                return cube
+        cube = fix()
+        if cache_file.with_suffix(".invalid").exists():
+            return cube
+        with self._lock:
+            if cache_file not in self._pending:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="cmorized_cache"
+                    )
+                self._pending.add(cache_file)
+                self._executor.submit(
+                    self._save, cube.copy(), cache_file, get_iris_state()
+                )
+        return cube
+
+    def _get_cache_file(
+        self,
+        files: Iterable[Path],
+        facets: dict[str, Any],
+    ) -> Path:
+        """Get path to cache file."""
+        key = {
+            "version": self._VERSION,
+            "loader": self._loader_id,
+            "esmvalcore": esmvalcore.__version__,
+            "facets": {k: str(v) for (k, v) in facets.items()},
+            "files": get_file_stats(files),
+        }
+        key_hash = hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode()
+        ).hexdigest()
+        return self._cache_dir / f"{key_hash}.nc"
+
+    def _save(
+        self,
+        cube: Cube,
+        cache_file: Path,
+        iris_state: dict[str, Any],
+    ) -> None:
+        """Save fixed variable (atomically) in chunked netCDF format.
+
+        Runs in the background thread (with the given iris state, see
+        :func:`get_iris_state`). Variables that do not round-trip through
+        netCDF are marked as invalid and not cached again.
+
+        """
+        with use_iris_state(iris_state):
+            try:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    dir=cache_file.parent, suffix=".nc.tmp", delete=False
+                ) as file:
+                    tmp_file = Path(file.name)
+                kwargs: dict[str, Any] = {}
+                if cube.has_lazy_data() and cube.ndim > 0:
+                    kwargs["chunksizes"] = cube.lazy_data().chunksize
+                try:
+                    iris.save(cube, tmp_file, saver="nc", **kwargs)
+                    mismatch = _get_round_trip_mismatch(
+                        cube, iris.load_cube(tmp_file)
+                    )
+                    if mismatch is None:
+                        os.replace(tmp_file, cache_file)
+                finally:
+                    tmp_file.unlink(missing_ok=True)
+                if mismatch is not None:
+                    logger.debug(
+                        f"Not caching fixed variable '{cube.var_name}' since "
+                        f"it does not round-trip through netCDF ({mismatch})"
+                    )
+                    cache_file.with_suffix(".invalid").touch()
+                    return
+                logger.debug(f"Cached fixed variable in {cache_file}")
+                self._evict()
+            except Exception as exc:
+                logger.debug(
+                    f"Caching fixed variable {cache_file} failed: {exc}"
+                )
+            finally:
+                with self._lock:
+                    self._pending.discard(cache_file)
+
+    def _evict(self) -> None:
+        """Remove least recently used files if cache is too large."""
+        with self._lock:
+            used_files = set(self._used_files)
+        files = []
+        for path in self._cache_dir.glob("*.nc"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by concurrent process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for (_, size, _) in files)
+        for _, size, path in sorted(files):
+            if total_bytes <= self._max_bytes:
+                break
+            if path in used_files:
+                continue
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            logger.debug(f"Removed least recently used fixed variable {path}")
+
+
+def _describe_items(
+    cube: Cube,
+    get_items: Callable[[Cube], list[Any]],
+    get_dims: Callable[[Cube, Any], tuple[int, ...]],
+) -> list[tuple[str, tuple[int, ...], tuple[int, ...], Unit]]:
+    """Get names, shapes, dimensions and units of coordinate-like items."""
+    return sorted(
+        (
+            (str(item.name()), item.shape, get_dims(cube, item), item.units)
+            for item in get_items(cube)
+        ),
+        key=lambda description: description[:3],
+    )
+
+
+def _have_equivalent_units(units: Unit, other_units: Unit) -> bool:
+    """Check if units are equivalent (e.g., `degrees` and `degrees_north`)."""
+    if units == other_units:
+        return True
+    if not units.is_convertible(other_units):
+        return False
+    return bool(np.isclose(units.convert(1.0, other_units), 1.0))
+
+
+def _get_round_trip_mismatch(cube: Cube, loaded_cube: Cube) -> str | None:
+    """Compare fixed variable with variable loaded from cache file.
+
+    Attributes and variable names of coordinates are not compared since
+    netCDF files may alter them. Returns a description of the first mismatch
+    or `None` if everything else (including the mesh, coordinates, cell
+    measures and ancillary variables) matches.
+
+    """
+    for attr in (
+        "shape",
+        "dtype",
+        "standard_name",
+        "long_name",
+        "var_name",
+        "units",
+        "cell_methods",
+        "location",
+    ):
+        if getattr(loaded_cube, attr) != getattr(cube, attr):
+            return attr
+    if (loaded_cube.mesh is None) != (cube.mesh is None):
+        return "mesh"
+    if cube.mesh is not None:
+        if loaded_cube.mesh_dim() != cube.mesh_dim():
+            return "mesh"
+        for coord, loaded_coord in zip(
+            cube.mesh.all_coords, loaded_cube.mesh.all_coords, strict=True
+        ):
+            if (coord is None) != (loaded_coord is None):
+                return "mesh coordinates"
+            if coord is not None and not np.array_equal(
+                coord.points, loaded_coord.points
+            ):
+                return f"mesh coordinate '{coord.name()}'"
+        for conn, loaded_conn in zip(
+            cube.mesh.all_connectivities,
+            loaded_cube.mesh.all_connectivities,
+            strict=True,
+        ):
+            if (conn is None) != (loaded_conn is None):
+                return "mesh connectivities"
+            if conn is not None and not np.array_equal(
+                conn.indices_by_location(), loaded_conn.indices_by_location()
+            ):
+                return f"mesh connectivity '{conn.cf_role}'"
+    for name, get_items, get_dims in (
+        ("coordinates", Cube.coords, Cube.coord_dims),
+        ("cell measures", Cube.cell_measures, Cube.cell_measure_dims),
+        (
+            "ancillary variables",
+            Cube.ancillary_variables,
+            Cube.ancillary_variable_dims,
+        ),
+    ):
+        items = _describe_items(cube, get_items, get_dims)
+        loaded_items = _describe_items(loaded_cube, get_items, get_dims)
+        if [i[:3] for i in loaded_items] != [i[:3] for i in items]:
+            return name
+        for item, loaded_item in zip(items, loaded_items, strict=True):
+            if not _have_equivalent_units(item[3], loaded_item[3]):
+                return f"{name} ('{item[0]}')"
+    if sorted(f.name() for f in loaded_cube.aux_factories) != sorted(
+        f.name() for f in cube.aux_factories
+    ):
+        return "derived coordinates"
+    return None
+
+
+def cached(method: _F) -> _F:
+    """Cache results of a loader method in the loader's cache.
+
+    Replacement for :func:`functools.lru_cache` that uses the cache of the
+    instance (attribute ``_cache``) instead of a class-level cache (which
+    would keep all instances alive).
+
+    """
+
+    @functools.wraps(method)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        return self._cache.get_or_load(
+            key, functools.partial(method, self, *args, **kwargs)
+        )
+
+    return wrapper  # type: ignore[return-value]
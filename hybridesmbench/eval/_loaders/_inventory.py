@@ -0,0 +1,178 @@
+"""Index files of CMIP6-style model output."""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any
+
+from loguru import logger
+
+# Time range at the end of CMIP6-style file names, e.g.,
+# tas_Amon_MODEL_historical_r1i1p1f1_gn_185001-201412.nc
+_TIMERANGE_REGEX = re.compile(r"_(\d{4})\d*-(\d{4})\d*\.nc$")
+
+
+def _get_years(file_name: str) -> tuple[int, int] | tuple[None, None]:
+    """Get start and end year from file name (if possible)."""
+    match = _TIMERANGE_REGEX.search(file_name)
+    if match is None:
+        return (None, None)
+    return (int(match.group(1)), int(match.group(2)))
+
+
+class FileInventory:
+    """Index files of CMIP6-style model output.
+
+    The directory tree is scanned only once. The index is persisted as JSON
+    file in `cache_dir` and reused as long as the modification times of all
+    scanned directories are unchanged (i.e., no files have been added,
+    removed, or renamed).
+
+    Parameters
+    ----------
+    path:
+        Root directory of the model output.
+    cache_dir:
+        Directory where the index is stored. If `None`, the index is only kept
+        in memory.
+
+    """
+
+    _VERSION = 1
+
+    def __init__(self, path: Path, cache_dir: Path | None = None) -> None:
+        """Initialize class instance."""
+        self._path = path.resolve()
+        if cache_dir is None:
+            self._index_file = None
+        else:
+            path_hash = hashlib.sha256(str(self._path).encode()).hexdigest()
+            self._index_file = (
+                cache_dir / "cmip_inventory" / f"{path_hash}.json"
+            )
+        self._index: dict[str, Any] | None = None
+        self._lock = threading.Lock()
+
+    def get_files(self, var_name: str) -> list[dict[str, Any]]:
+        """Get files of a variable.
+
+        Files located in (sub)directories called like the variable are
+        preferred. If there are none, use files whose names start with
+        ``{var_name}_``.
+
+        Parameters
+        ----------
+        var_name:
+            Variable name.
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            Files of the variable given by their absolute `path`,
+            `start_year` and `end_year` (`None` if the time range cannot be
+            inferred from the file name).
+
+        """
+        index = self._get_index()
+        file_ids = index["dirs"].get(var_name) or index["prefixes"].get(
+            var_name, []
+        )
+        files = []
+        for file_id in file_ids:
+            (rel_path, start_year, end_year) = index["files"][file_id]
+            files.append(
+                {
+                    "path": self._path / rel_path,
+                    "start_year": start_year,
+                    "end_year": end_year,
+                }
+            )
+        return files
+
+    def _get_index(self) -> dict[str, Any]:
+        """Get index (load or create it if necessary)."""
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            if self._index is None:
+                self._index = self._scan()
+                self._save_index(self._index)
+            return self._index
+
+    def _load_index(self) -> dict[str, Any] | None:
+        """Load index from file if it is still valid."""
+        if self._index_file is None:
+            return None
+        try:
+            with self._index_file.open(encoding="utf-8") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if index.get("version") != self._VERSION:
+            return None
+        for rel_dir, mtime in index["mtimes"].items():
+            try:
+                current_mtime = os.stat(self._path / rel_dir).st_mtime_ns
+            except OSError:
+                current_mtime = None
+            if current_mtime != mtime:
+                logger.debug(
+                    f"File index {self._index_file} is outdated, rescanning "
+                    f"{self._path}"
+                )
+                return None
+        logger.debug(f"Loaded file index {self._index_file}")
+        return index
+
+    def _save_index(self, index: dict[str, Any]) -> None:
+        """Save index to file."""
+        if self._index_file is None:
+            return
+        self._index_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=self._index_file.parent,
+            suffix=".json.tmp",
+            delete=False,
+            encoding="utf-8",
+        ) as file:
+            json.dump(index, file)
+        os.replace(file.name, self._index_file)
+        logger.debug(f"Saved file index {self._index_file}")
+
+    def _scan(self) -> dict[str, Any]:
+        """Scan directory tree for netCDF files."""
+        logger.debug(f"Scanning {self._path} for '*.nc' files")
+        index: dict[str, Any] = {
+            "version": self._VERSION,
+            "mtimes": {},
+            "files": [],
+            "dirs": {},
+            "prefixes": {},
+        }
+        for root, dir_names, file_names in os.walk(
+            self._path, followlinks=True
+        ):
+            dir_names.sort()
+            rel_root = Path(root).relative_to(self._path)
+            index["mtimes"][str(rel_root)] = os.stat(root).st_mtime_ns
+            for file_name in sorted(file_names):
+                if not file_name.endswith(".nc"):
+                    continue
+                file_id = len(index["files"])
+                index["files"].append(
+                    [str(rel_root / file_name), *_get_years(file_name)]
+                )
+                for dir_name in set(rel_root.parts):
+                    index["dirs"].setdefault(dir_name, []).append(file_id)
+                if "_" in file_name:
+                    prefix = file_name.split("_", 1)[0]
+                    index["prefixes"].setdefault(prefix, []).append(file_id)
+        logger.debug(
+            f"Found {len(index['files'])} '*.nc' files in {self._path}"
+        )
+        return index
@@ -0,0 +1,147 @@
+"""Load variables in the background before they are requested."""
+
+import threading
+from collections import deque
+from collections.abc import Callable, Hashable
+from typing import Any
+
+from loguru import logger
+
+from hybridesmbench._utils import get_iris_state, use_iris_state
+from hybridesmbench.eval._loaders._cache import get_nbytes
+
+
+class Prefetcher:
+    """Load variables in a background thread before they are requested.
+
+    Requested variables are loaded in the order of their requests. The
+    prefetcher runs at most `depth` variables ahead of the consumer, i.e., it
+    pauses while `depth` prefetched variables have not been consumed yet (see
+    :meth:`release`) or while these keep more than `max_bytes` in memory.
+
+    Parameters
+    ----------
+    load:
+        Function that loads (and caches) a variable given the arguments of a
+        request. Needs to be thread-safe.
+    depth:
+        Maximum number of prefetched variables that have not been consumed
+        yet. If 0, do not prefetch anything.
+    max_bytes:
+        Maximum number of bytes that prefetched variables that have not been
+        consumed yet keep in memory (only realized arrays are counted, lazy
+        data is not). If `None`, do not limit the memory usage.
+
+    """
+
+    def __init__(
+        self,
+        load: Callable[..., Any],
+        depth: int = 2,
+        max_bytes: int | None = None,
+    ) -> None:
+        """Initialize class instance."""
+        self._load = load
+        self._depth = depth
+        self._max_bytes = max_bytes
+        self._condition = threading.Condition()
+        self._pending: deque[Hashable] = deque()
+        self._ready: dict[Hashable, int] = {}
+        self._loading: Hashable | None = None
+        self._discard_loading = False
+        self._thread: threading.Thread | None = None
+
+    def close(self) -> None:
+        """Cancel all requests and wait for the background thread.
+
+        The prefetcher can still be used afterwards.
+
+        """
+        with self._condition:
+            self._pending.clear()
+            self._ready.clear()
+            self._discard_loading = True
+            thread = self._thread
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def release(self, *args: Hashable) -> None:
+        """Mark request as consumed (or cancel it if it is still pending).
+
+        Parameters
+        ----------
+        *args:
+            Arguments of the request.
+
+        """
+        with self._condition:
+            if args in self._pending:
+                self._pending.remove(args)
+            self._ready.pop(args, None)
+            if args == self._loading:
+                self._discard_loading = True
+            self._condition.notify_all()
+
+    def request(self, *args: Hashable) -> None:
+        """Request variable to be loaded in the background.
+
+        Parameters
+        ----------
+        *args:
+            Arguments passed to `load`.
+
+        """
+        if self._depth < 1:
+            return
+        with self._condition:
+            if (
+                args in self._pending
+                or args in self._ready
+                or args == self._loading
+            ):
+                return
+            self._pending.append(args)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work,
+                    args=(get_iris_state(),),
+                    name="prefetcher",
+                    daemon=True,
+                )
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _can_load(self) -> bool:
+        """Check if another variable can be loaded (must hold the lock)."""
+        if len(self._ready) >= self._depth:
+            return False
+        if self._max_bytes is not None:
+            return sum(self._ready.values()) < self._max_bytes
+        return True
+
+    def _work(self, iris_state: dict[str, Any]) -> None:
+        """Load requested variables until there are no more requests."""
+        with use_iris_state(iris_state):
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: not self._pending or self._can_load()
+                    )
+                    if not self._pending:
+                        self._thread = None
+                        return
+                    args = self._pending.popleft()
+                    self._loading = args
+                    self._discard_loading = False
+                logger.debug(f"Prefetching {args}")
+                try:
+                    nbytes = get_nbytes(self._load(*args))
+                except Exception as exc:
+                    logger.debug(f"Prefetching {args} failed: {exc}")
+                    nbytes = None
+                with self._condition:
+                    if nbytes is not None and not self._discard_loading:
+                        self._ready[args] = nbytes
+                    self._loading = None
+                    self._condition.notify_all()
@@ -1,22 +1,39 @@
 """Load hybrid Earth system model output (base class)."""
 
+import fnmatch
 import functools
+import hashlib
 import inspect
+import json
+import re
 import warnings
+from collections.abc import Collection, Iterable
 from pathlib import Path
-from typing import Any
+from typing import Any, Self
 
+import iris
 import xarray as xr
 from esmvalcore.cmor.fix import fix_data, fix_metadata
 from esmvalcore.cmor.table import get_var_info
+from esmvalcore.config import CFG
+from esmvalcore.iris_helpers import rechunk_cube
+from iris import NameConstraint
 from iris.cube import Cube
 from loguru import logger
 from ncdata.iris_xarray import cubes_from_xarray
 
+from hybridesmbench.eval._loaders._cache import (
+    CMORizedCache,
+    LoaderCache,
+    cached,
+    get_file_stats,
+)
+from hybridesmbench.eval._loaders._prefetch import Prefetcher
 from hybridesmbench.exceptions import (
     HybridESMBenchException,
     HybridESMBenchWarning,
 )
+from hybridesmbench.typing import ChunkHint, ChunkPolicy
 
 
 class Loader:
@@ -26,16 +43,91 @@ class Loader:
     ----------
     path:
         Path to hybrid Earth system model output.
+    model_name:
+        Custom name for the hybrid Earth system model.
+    cache_dir:
+        Directory used to persistently cache data across runs. If `None`, do
+        not cache data persistently.
+    max_cache_items:
+        Maximum number of objects (e.g., opened files or loaded variables)
+        kept in the in-memory cache of the loader. If `None`, do not limit
+        the number of objects.
+    max_cache_bytes:
+        Maximum number of bytes of realized data kept in the in-memory cache
+        of the loader. If `None`, do not limit the memory usage.
+    cache_cmorized:
+        If `True`, persistently cache fixed (i.e., CMORized) variables in
+        `cache_dir` so that the ESMValCore fixes only run once as long as the
+        source files do not change. Variables are written in the background
+        and only used if they round-trip through netCDF. Requires
+        `cache_dir`.
+    prefetch_depth:
+        Maximum number of variables that are loaded ahead in the background
+        (see :meth:`prefetch`). If 0, do not prefetch variables.
+    max_prefetch_bytes:
+        Maximum number of bytes of realized data that prefetched variables
+        which have not been requested yet keep in memory. If `None`, only
+        limit the number of prefetched variables.
+    chunk_policy:
+        Chunking of loaded variables. If ``"auto"``, let Dask choose the
+        chunks of each file. If ``"reductions"``, use chunks that span the
+        entire dimensions given by the `chunk_hints` of
+        :meth:`load_variable` (Dask chooses the chunks along all other
+        dimensions). If ``"time"``, additionally use chunks that span the
+        entire time axis for all variables.
+
+    Note
+    ----
+    Loaded data is cached in memory (least recently used objects are evicted
+    first). Use :meth:`close` or use the loader as context manager to release
+    the cache and all file handles. Public methods are thread-safe, i.e., a
+    loader can be shared by diagnostics that run concurrently in multiple
+    threads. Different variables are loaded concurrently; threads that
+    request a variable which is currently loaded by another thread wait for
+    it.
 
     """
 
     _DATASET: str
     _PROJECT: str
 
-    def __init__(self, path: Path, model_name: str | None = None) -> None:
+    # Increase this whenever the data returned by the loader changes (this
+    # invalidates the persistent cache of fixed variables)
+    _VERSION = 1
+
+    def __init__(
+        self,
+        path: Path,
+        model_name: str | None = None,
+        cache_dir: Path | None = None,
+        max_cache_items: int | None = 128,
+        max_cache_bytes: int | None = None,
+        cache_cmorized: bool = False,
+        prefetch_depth: int = 2,
+        max_prefetch_bytes: int | None = None,
+        chunk_policy: ChunkPolicy = "reductions",
+    ) -> None:
         """Initialize class instance."""
         self._root_file = Path(inspect.getfile(self.__class__))
         self._path = path
+        self._cache_dir = cache_dir
+        self._chunk_policy = chunk_policy
+        self._cache = LoaderCache(
+            max_items=max_cache_items, max_bytes=max_cache_bytes
+        )
+        self._cmorized_cache: CMORizedCache | None = None
+        if cache_cmorized:
+            if cache_dir is None:
+                msg = "Caching fixed variables requires a cache directory"
+                raise HybridESMBenchException(msg)
+            self._cmorized_cache = CMORizedCache(
+                cache_dir / "cmorized", self._loader_id
+            )
+        self._prefetcher = Prefetcher(
+            self._prefetch_variable,
+            depth=prefetch_depth,
+            max_bytes=max_prefetch_bytes,
+        )
         self._exp = path.name
         if model_name is None:
             model_name = self.model_type.upper()
@@ -45,6 +137,32 @@ class Loader:
             f"'{self.model_type}' located at {path}"
         )
 
+    def __enter__(self) -> Self:
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Exit context manager (release cache and file handles)."""
+        self.close()
+
+    def close(self) -> None:
+        """Release in-memory cache and close all files opened by the loader.
+
+        This also cancels all prefetch requests and waits until all fixed
+        variables have been written to the persistent cache (if
+        `cache_cmorized` is used). The loader can still be used afterwards
+        (files are opened again if necessary).
+
+        """
+        self._prefetcher.close()
+        if self._cmorized_cache is not None:
+            self._cmorized_cache.close()
+        logger.debug(
+            f"Closing loader for model '{self.model_name}' (cache "
+            f"statistics: {self._cache.stats})"
+        )
+        self._cache.clear()
+
     def get_metadata(self, var_name: str, mip_table: str) -> dict[str, Any]:
         """Get variable metadata.
 
@@ -82,7 +200,46 @@ class Loader:
 
         return metadata
 
-    def load_variable(self, var_name: str, mip_table: str) -> Cube:
+    def get_fingerprint(self, var_name: str, mip_table: str) -> str:
+        """Get fingerprint of the input data of a variable.
+
+        The fingerprint changes whenever any of the files the variable is
+        loaded from (or the loader version) changes.
+
+        Parameters
+        ----------
+        var_name:
+            CMOR variable name, e.g., `"tas"`.
+        mip_table:
+            CMOR MIP table, e.g., `"Amon"`.
+
+        Returns
+        -------
+        str
+            Fingerprint (SHA-256 hash).
+
+        """
+        files = self._get_source_files(
+            self._get_variable_files(var_name, mip_table)
+        )
+        key = {
+            "loader": self._loader_id,
+            "var_name": var_name,
+            "mip_table": mip_table,
+            "files": get_file_stats(files),
+        }
+        return hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode()
+        ).hexdigest()
+
+    def load_variable(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None = None,
+        end_year: int | None = None,
+        chunk_hints: Collection[ChunkHint] = (),
+    ) -> Cube:
         """Load single variable.
 
         Parameters
@@ -91,6 +248,20 @@ class Loader:
             CMOR variable name, e.g., `"tas"`.
         mip_table:
             CMOR MIP table, e.g., `"Amon"`.
+        start_year:
+            If given, files that only contain data before this year (as given
+            by the time stamps in their names) are not opened. The returned
+            data may still contain earlier years.
+        end_year:
+            If given, files that only contain data after this year (as given
+            by the time stamps in their names) are not opened. The returned
+            data may still contain later years.
+        chunk_hints:
+            Dimensions along which the returned data should not be chunked
+            since it is reduced or interpolated along them, e.g., ``"time"``
+            for climatologies or ``"vertical"`` for the extraction of
+            vertical levels. Ignored if the chunk policy of the loader is
+            ``"auto"``.
 
         Returns
         -------
@@ -101,17 +272,117 @@ class Loader:
         logger.debug(
             f"Loading variable '{var_name}' from MIP table '{mip_table}'"
         )
-        cube = self._load_single_variable(var_name, mip_table).copy()
+        try:
+            cube = self._load_single_variable(
+                var_name, mip_table, start_year, end_year
+            )
+        finally:
+            self._prefetcher.release(var_name, mip_table, start_year, end_year)
         logger.debug(
             f"Loaded variable '{var_name}' from MIP table' {mip_table}'"
         )
-        return cube
+        return self._rechunk(cube, chunk_hints)
+
+    def prefetch(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None = None,
+        end_year: int | None = None,
+    ) -> None:
+        """Load single variable in the background.
+
+        Opening and fixing the files of a variable (which is often dominated
+        by file system latency) then overlaps with processing of previously
+        loaded variables. Variables are prefetched in the order of their
+        requests; prefetching pauses while too many prefetched variables have
+        not been loaded with :meth:`load_variable` yet (see `prefetch_depth`
+        and `max_prefetch_bytes`). Failures are ignored here; they are raised
+        once the variable is loaded with :meth:`load_variable`.
+
+        Parameters
+        ----------
+        var_name:
+            CMOR variable name, e.g., `"tas"`.
+        mip_table:
+            CMOR MIP table, e.g., `"Amon"`.
+        start_year:
+            Same as for :meth:`load_variable`.
+        end_year:
+            Same as for :meth:`load_variable`.
+
+        """
+        self._prefetcher.request(var_name, mip_table, start_year, end_year)
+
+    def cancel_prefetch(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None = None,
+        end_year: int | None = None,
+    ) -> None:
+        """Cancel prefetch request of a variable that will not be loaded.
+
+        Parameters
+        ----------
+        var_name:
+            CMOR variable name, e.g., `"tas"`.
+        mip_table:
+            CMOR MIP table, e.g., `"Amon"`.
+        start_year:
+            Same as for :meth:`prefetch`.
+        end_year:
+            Same as for :meth:`prefetch`.
+
+        """
+        self._prefetcher.release(var_name, mip_table, start_year, end_year)
+
+    def load_cell_area(self) -> Cube | None:
+        """Load areas of the horizontal grid cells of the model.
+
+        Returns
+        -------
+        Cube | None
+            Grid cell areas (variable name ``areacella``, standard name
+            ``cell_area``). `None` if the model does not provide them.
+
+        """
+        return self._load_cell_area()
+
+    @property
+    def cache_stats(self) -> dict[str, int]:
+        """Get statistics of the in-memory cache.
+
+        This includes the number of `hits`, `misses`, and `evictions`, and the
+        current number of cached objects (`items`) and bytes (`nbytes`).
+
+        """
+        return self._cache.stats
+
+    @property
+    def grid_id(self) -> str | None:
+        """Get unique identifier of horizontal model grid.
+
+        `None` if the model does not provide such an identifier.
+
+        """
+        return None
+
+    @property
+    def _loader_id(self) -> str:
+        """Get identifier of loader class (including its version)."""
+        return f"{type(self).__qualname__}_v{self._VERSION}"
 
     @property
     def model_name(self) -> str:
         """Get model name."""
         return self._model_name
 
+    @property
+    def cache_dir(self) -> Path | None:
+        """Get directory used to persistently cache data across runs."""
+        return self._cache_dir
+
     @property
     def exp(self) -> str:
         """Get ICON experiment."""
@@ -127,17 +398,161 @@ class Loader:
         """Get path to hybrid Earth system model output."""
         return self._path
 
-    @functools.lru_cache
+    @cached
     def _load_files(self, path: str | Path, **kwargs: Any) -> xr.Dataset:
         """Load files using :func:`xarray.open_mfdataset.`
 
-        Use LRU cache to avoid loading the same files over and over.
+        Use cache to avoid loading the same files over and over.
 
         """
         kwargs.setdefault("chunks", "auto")
         return xr.open_mfdataset(path, **kwargs)
 
-    def _load_single_variable(self, var_name: str, mip_table: str) -> Cube:
+    @staticmethod
+    def _filter_files(
+        files: Iterable[tuple[Path, int | None, int | None]],
+        start_year: int | None,
+        end_year: int | None,
+    ) -> tuple[Path, ...]:
+        """Remove files that lie entirely outside of the desired years.
+
+        Files are given by their path and the first and last year they
+        contain (`None` if unknown).
+
+        """
+        selected_files = []
+        for path, file_start_year, file_end_year in files:
+            if (
+                start_year is not None
+                and file_end_year is not None
+                and file_end_year < start_year
+            ):
+                continue
+            if (
+                end_year is not None
+                and file_start_year is not None
+                and file_start_year > end_year
+            ):
+                continue
+            selected_files.append(path)
+        return tuple(selected_files)
+
+    def _load_cell_area(self) -> Cube | None:
+        """Load areas of the horizontal grid cells of the model.
+
+        Returns `None` by default.
+
+        """
+        return None
+
+    def _rechunk(self, cube: Cube, chunk_hints: Collection[ChunkHint]) -> Cube:
+        """Rechunk variable according to the chunk policy (returns a copy).
+
+        Coordinates that are necessary to handle the given dimensions (e.g.,
+        a 4D pressure coordinate for vertical interpolation) are rechunked as
+        well.
+
+        """
+        if self._chunk_policy == "auto" or not cube.has_lazy_data():
+            return cube.copy()
+        hints = set(chunk_hints)
+        if self._chunk_policy == "time":
+            hints.add("time")
+        axes = {"time": "T", "vertical": "Z"}
+        complete_coords = [
+            coord
+            for hint in sorted(hints)
+            for coord in cube.coords(axis=axes[hint], dim_coords=True)
+        ]
+        if not complete_coords:
+            return cube.copy()
+        old_chunks = cube.lazy_data().chunks
+        cube = rechunk_cube(cube, complete_coords)
+        if cube.lazy_data().chunks != old_chunks:
+            logger.debug(
+                f"Rechunked variable '{cube.var_name}' to have complete "
+                f"dimensions {[c.name() for c in complete_coords]} (chunk "
+                f"size: {cube.lazy_data().chunksize})"
+            )
+        return cube
+
+    def _prefetch_variable(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None,
+        end_year: int | None,
+    ) -> Cube:
+        """Load single variable into the in-memory cache.
+
+        This runs in the background thread of the prefetcher. It only
+        synchronizes with foreground loads via the in-memory cache, i.e., a
+        foreground load only waits for the prefetcher if it requests the same
+        variable.
+
+        """
+        return self._load_single_variable(
+            var_name, mip_table, start_year, end_year
+        )
+
+    def _fix_variable(
+        self,
+        files: str | tuple[Path, ...],
+        var_name: str,
+        mip_table: str,
+    ) -> Cube:
+        """Load files and fix variable.
+
+        Should be implemented by child classes.
+
+        """
+        raise NotImplementedError()
+
+    def _get_variable_files(
+        self,
+        var_name: str,
+        mip_table: str,
+    ) -> str | tuple[Path, ...]:
+        """Get all files of a variable (as paths or glob pattern).
+
+        Should be implemented by child classes.
+
+        """
+        raise NotImplementedError()
+
+    def _get_source_files(
+        self,
+        files: str | tuple[Path, ...],
+    ) -> tuple[Path, ...]:
+        """Get all files the fixed variable depends on."""
+        if isinstance(files, str):
+            pattern = Path(files)
+            return tuple(sorted(pattern.parent.glob(pattern.name)))
+        return files
+
+    def _load_fixed_variable(
+        self,
+        files: str | tuple[Path, ...],
+        var_name: str,
+        mip_table: str,
+    ) -> Cube:
+        """Load fixed variable (from persistent cache if possible)."""
+        if self._cmorized_cache is None:
+            return self._fix_variable(files, var_name, mip_table)
+        return self._cmorized_cache.get_or_fix(
+            self._get_source_files(files),
+            functools.partial(self._fix_variable, files, var_name, mip_table),
+            var_name=var_name,
+            mip_table=mip_table,
+        )
+
+    def _load_single_variable(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None = None,
+        end_year: int | None = None,
+    ) -> Cube:
         """Load single variable.
 
         Should be implemented by child classes.
@@ -146,6 +561,11 @@ class Loader:
         raise NotImplementedError()
 
 
+# Time stamp at the end of ICON output file names, e.g.,
+# exp_atm_2d_ml_19790101T000000Z.nc
+_ICON_TIMESTAMP_REGEX = re.compile(r"_(\d{4})(\d{4})(T\d+Z?)?\.nc$")
+
+
 class BaseICONLoader(Loader):
     """Load ICON hybrid Earth system model output (base class).
 
@@ -159,9 +579,40 @@ class BaseICONLoader(Loader):
     _PROJECT = "ICON"
     _VAR_TYPES: dict[str, str]
 
-    def __init__(self, path: Path, model_name: str | None = None) -> None:
+    # Extra facets of the ESMValCore ICON fixes that name auxiliary variables
+    # used to add additional coordinates (e.g., air pressure or altitude of
+    # model levels) and their default values
+    _AUX_VAR_FACETS: dict[str, str] = {
+        "pfull_var": "pfull",
+        "phalf_var": "phalf",
+        "zgfull_var": "zg",
+        "zghalf_var": "zghalf",
+    }
+
+    def __init__(
+        self,
+        path: Path,
+        model_name: str | None = None,
+        cache_dir: Path | None = None,
+        max_cache_items: int | None = 128,
+        max_cache_bytes: int | None = None,
+        cache_cmorized: bool = False,
+        prefetch_depth: int = 2,
+        max_prefetch_bytes: int | None = None,
+        chunk_policy: ChunkPolicy = "reductions",
+    ) -> None:
         """Initialize class instance."""
-        super().__init__(path, model_name=model_name)
+        super().__init__(
+            path,
+            model_name=model_name,
+            cache_dir=cache_dir,
+            max_cache_items=max_cache_items,
+            max_cache_bytes=max_cache_bytes,
+            cache_cmorized=cache_cmorized,
+            prefetch_depth=prefetch_depth,
+            max_prefetch_bytes=max_prefetch_bytes,
+            chunk_policy=chunk_policy,
+        )
 
         # ICON model name
         if model_name is None:
@@ -191,19 +642,98 @@ class BaseICONLoader(Loader):
         """Get path to ICON grid file."""
         return self._grid_file
 
-    @functools.lru_cache
-    def _load_single_variable(self, var_name: str, mip_table: str) -> Cube:
-        """Load single variable."""
-        msg = (
-            f"Invalid variable '{var_name}' for model type '{self.model_type}'"
-        )
-        assert var_name in self._VAR_TYPES, msg
-        var_type = self._VAR_TYPES[var_name]
+    @functools.cached_property
+    def grid_id(self) -> str:
+        """Get unique identifier of ICON grid.
+
+        This is the UUID of the ICON grid file (global attribute
+        ``uuidOfHGrid``). If that is not available, use a hash of the ICON
+        grid file.
 
-        # Load xarray.Dataset and convert to iris.cube.CubeList
-        file_pattern = str(self.path / f"{self.exp}_{var_type}_*.nc")
+        """
+        with xr.open_dataset(self.grid_file) as grid:
+            grid_uuid = grid.attrs.get("uuidOfHGrid")
+        if grid_uuid is not None:
+            return str(grid_uuid)
+        sha256 = hashlib.sha256()
+        with self.grid_file.open("rb") as grid_file:
+            while chunk := grid_file.read(2**20):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @cached
+    def _load_cell_area(self) -> Cube:
+        """Load areas of the horizontal grid cells from the ICON grid file."""
+        logger.debug(f"Loading cell areas from grid file {self.grid_file}")
+        cell_area = iris.load_cube(
+            self.grid_file, NameConstraint(var_name="cell_area")
+        )
+        cell_area.var_name = "areacella"
+        cell_area.standard_name = "cell_area"
+        cell_area.convert_units("m2")
+        for coord_name in ("latitude", "longitude"):
+            if cell_area.coords(coord_name):
+                cell_area.coord(coord_name).convert_units("degrees")
+        return cell_area
+
+    @cached
+    def _load_single_variable(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None = None,
+        end_year: int | None = None,
+    ) -> Cube:
+        """Load single variable."""
+        file_pattern = self._get_variable_files(var_name, mip_table)
         logger.debug(f"Loading files {file_pattern}")
-        xr_ds = self._load_files(file_pattern).copy()
+        files: str | tuple[Path, ...] = file_pattern
+        if start_year is not None or end_year is not None:
+            files = self._filter_files(
+                self._get_file_years(file_pattern), start_year, end_year
+            )
+            if not files:
+                msg = (
+                    f"No files {file_pattern} for variable '{var_name}' "
+                    f"cover the years {start_year} to {end_year}"
+                )
+                raise HybridESMBenchException(msg)
+            logger.debug(f"Selected {len(files)} files within time range")
+        return self._load_fixed_variable(files, var_name, mip_table)
+
+    def _fix_variable(
+        self,
+        files: str | tuple[Path, ...],
+        var_name: str,
+        mip_table: str,
+    ) -> Cube:
+        """Load files and fix variable."""
+        xr_ds = self._load_files(files).copy()
+        extra_facets = self._get_extra_facets(var_name, mip_table)
+        selected_ds = self._select_variables(xr_ds, var_name, extra_facets)
+        try:
+            return self._fix_dataset(
+                selected_ds, var_name, mip_table, extra_facets
+            )
+        except Exception as exc:
+            # Some fixes derive the CMOR variable from other raw variables
+            # (e.g., clwvi = cllvi + clivi), so try again with all variables
+            if selected_ds is xr_ds:
+                raise
+            logger.debug(
+                f"Fixing selected variables of '{var_name}' failed ({exc}), "
+                f"using all variables instead"
+            )
+            return self._fix_dataset(xr_ds, var_name, mip_table, extra_facets)
+
+    def _fix_dataset(
+        self,
+        xr_ds: xr.Dataset,
+        var_name: str,
+        mip_table: str,
+        extra_facets: dict[str, Any],
+    ) -> Cube:
+        """Convert dataset to cubes and fix variable."""
         cubes = cubes_from_xarray(xr_ds)
 
         # Remove lat/lon information from cubes (we will use the ones given by
@@ -215,9 +745,6 @@ class BaseICONLoader(Loader):
 
         # Run ESMValCore fixes on the data to "CMORize" it
         cmor_var_info = get_var_info(self._PROJECT, mip_table, var_name)
-        extra_facets: dict[str, Any] = {
-            "horizontal_grid": self.grid_file,
-        }
         cube = fix_metadata(
             cubes,
             short_name=var_name,
@@ -238,3 +765,141 @@ class BaseICONLoader(Loader):
         )
 
         return cube
+
+    def _get_extra_facets(
+        self,
+        var_name: str,
+        mip_table: str,
+    ) -> dict[str, Any]:
+        """Get extra facets of variable passed to the ESMValCore fixes.
+
+        These are the extra facets configured for the project in ESMValCore
+        (e.g., ``raw_name``) and the ICON grid file.
+
+        """
+        extra_facets: dict[str, Any] = {}
+        raw_extra_facets = (
+            CFG["projects"].get(self._PROJECT, {}).get("extra_facets", {})
+        )
+        for dataset_pattern, mips in raw_extra_facets.items():
+            if not fnmatch.fnmatchcase(self._DATASET, dataset_pattern):
+                continue
+            for mip_pattern, variables in mips.items():
+                if not fnmatch.fnmatchcase(mip_table, mip_pattern):
+                    continue
+                for var_pattern, facets in variables.items():
+                    if fnmatch.fnmatchcase(var_name, var_pattern):
+                        extra_facets.update(facets)
+        extra_facets["horizontal_grid"] = self.grid_file
+        return extra_facets
+
+    def _get_variable_files(self, var_name: str, mip_table: str) -> str:
+        """Get glob pattern of all files of a variable."""
+        msg = (
+            f"Invalid variable '{var_name}' for model type '{self.model_type}'"
+        )
+        assert var_name in self._VAR_TYPES, msg
+        var_type = self._VAR_TYPES[var_name]
+        return str(self.path / f"{self.exp}_{var_type}_*.nc")
+
+    def _get_source_files(
+        self,
+        files: str | tuple[Path, ...],
+    ) -> tuple[Path, ...]:
+        """Get all files the fixed variable depends on (incl. grid file)."""
+        return (*super()._get_source_files(files), self.grid_file)
+
+    @staticmethod
+    def _get_file_years(
+        file_pattern: str,
+    ) -> list[tuple[Path, int | None, int | None]]:
+        """Get first and last year of ICON output files.
+
+        ICON output file names only contain the time stamp of the first time
+        step (e.g., ``exp_atm_2d_ml_19790101T000000Z.nc``), so each file is
+        assumed to end at the start of the next file. Since ICON time stamps
+        may refer to the end of the time interval, the years are estimated
+        conservatively.
+
+        """
+        files: list[tuple[Path, int | None, int | None]] = []
+        stamps: list[tuple[str, int, Path]] = []
+        pattern = Path(file_pattern)
+        for path in pattern.parent.glob(pattern.name):
+            match = _ICON_TIMESTAMP_REGEX.search(path.name)
+            if match is None:  # files without time stamp are always loaded
+                files.append((path, None, None))
+                continue
+            (year, month_day, time) = match.groups()
+            first_year = int(year)
+
+            # 1 January 00:00 may be the end of the last interval of the
+            # previous year
+            if month_day == "0101" and not (time or "").strip("TZ0"):
+                first_year -= 1
+            stamps.append((f"{year}{month_day}{time or ''}", first_year, path))
+        stamps.sort()
+        for idx, (_, first_year, path) in enumerate(stamps):
+            last_year = None
+            if idx + 1 < len(stamps):
+                last_year = int(stamps[idx + 1][0][:4])
+            files.append((path, first_year, last_year))
+        return files
+
+    def _select_variables(
+        self,
+        xr_ds: xr.Dataset,
+        var_name: str,
+        extra_facets: dict[str, Any],
+    ) -> xr.Dataset:
+        """Select variables necessary to create a CMOR variable.
+
+        This includes the raw ICON variable (extra facet ``raw_name``),
+        auxiliary variables for 3D variables (see :attr:`_AUX_VAR_FACETS`),
+        and all variables referenced by those (e.g., bounds). If the raw
+        variable is not available (e.g., because the fixes derive the
+        variable from others), return the unmodified dataset.
+
+        """
+        raw_name = extra_facets.get("raw_name", var_name)
+        if raw_name not in xr_ds.data_vars:
+            return xr_ds
+        selected_vars = {raw_name}
+
+        # Auxiliary variables are only relevant for 3D variables (time,
+        # height, cell)
+        if xr_ds[raw_name].ndim > 2:
+            for facet, default in self._AUX_VAR_FACETS.items():
+                aux_var = extra_facets.get(facet, default)
+                if aux_var in xr_ds:
+                    selected_vars.add(aux_var)
+
+        # Add variables referenced by selected variables and their coordinates
+        # via CF attributes (e.g., bounds, coordinates, cell_measures)
+        to_check = list(selected_vars)
+        while to_check:
+            xr_var = xr_ds[to_check.pop()]
+            refs = []
+            for obj in (xr_var, *xr_var.coords.values()):
+                for attr in (
+                    "ancillary_variables",
+                    "bounds",
+                    "cell_measures",
+                    "coordinates",
+                ):
+                    value = obj.attrs.get(attr, obj.encoding.get(attr, ""))
+                    refs.extend(
+                        ref
+                        for ref in str(value).split()
+                        if not ref.endswith(":")
+                    )
+            for ref in refs:
+                if ref in xr_ds.data_vars and ref not in selected_vars:
+                    selected_vars.add(ref)
+                    to_check.append(ref)
+
+        logger.debug(
+            f"Selected variables {sorted(selected_vars)} (out of "
+            f"{len(xr_ds.data_vars)}) to create variable '{var_name}'"
+        )
+        return xr_ds[sorted(selected_vars)]
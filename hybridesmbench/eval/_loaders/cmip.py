@@ -1,6 +1,7 @@
 """Load CMIP6-style (i.e., CMORized) hybrid Earth system model output."""
 
 import functools
+from pathlib import Path
 
 from esmvalcore.cmor.fix import fix_data, fix_metadata
 from esmvalcore.cmor.table import get_var_info
@@ -9,6 +10,8 @@ from loguru import logger
 from ncdata.iris_xarray import cubes_from_xarray
 
 from hybridesmbench.eval._loaders import Loader
+from hybridesmbench.eval._loaders._cache import cached
+from hybridesmbench.eval._loaders._inventory import FileInventory
 from hybridesmbench.exceptions import HybridESMBenchException
 
 
@@ -25,37 +28,67 @@ class CMIPLoader(Loader):
     _PROJECT = "CMIP-style"
     _DATASET = "CMIP-style"
 
-    @functools.lru_cache
-    def _load_single_variable(self, var_name: str, mip_table: str) -> Cube:
-        """Load single variable."""
-        # First, try to find files in subdirectories called like the variable
-        logger.debug(
-            f"Looking for '*.nc' files in subdirectories '{var_name}' of "
-            f"{self.path}"
-        )
-        nc_files = tuple(
-            f for d in self.path.rglob(var_name) for f in d.rglob("*.nc")
-        )
+    @functools.cached_property
+    def _inventory(self) -> FileInventory:
+        """Get index of all files (only scan directory tree once)."""
+        return FileInventory(self.path, cache_dir=self.cache_dir)
 
-        # If that didn't work, try to find files which contain the variables
-        # name in their file name
-        if not nc_files:
-            logger.debug(
-                f"Looking for {var_name}_*.nc files in {self.path} (incl. "
-                f"subdirectories)"
-            )
-            nc_files = tuple(self.path.rglob(f"{var_name}_*.nc"))
+    @cached
+    def _load_cell_area(self) -> Cube | None:
+        """Load areas of the horizontal grid cells (``areacella``)."""
+        try:
+            return self._load_single_variable("areacella", "fx")
+        except HybridESMBenchException as exc:
+            logger.debug(f"Cell areas are not available: {exc}")
+            return None
 
-        # If that didn't work, raise exception
-        if not nc_files:
+    @cached
+    def _load_single_variable(
+        self,
+        var_name: str,
+        mip_table: str,
+        start_year: int | None = None,
+        end_year: int | None = None,
+    ) -> Cube:
+        """Load single variable."""
+        all_files = self._inventory.get_files(var_name)
+        if not all_files:
             msg = (
                 f"No files for variable '{var_name}' found (looked for *.nc "
                 f"files in subdirectories '{var_name}' and {var_name}_*.nc "
                 f"files in {self.path} [incl. subdirectories])"
             )
             raise HybridESMBenchException(msg)
+        nc_files = self._filter_files(
+            [(f["path"], f["start_year"], f["end_year"]) for f in all_files],
+            start_year,
+            end_year,
+        )
+        if not nc_files:
+            msg = (
+                f"No files for variable '{var_name}' cover the years "
+                f"{start_year} to {end_year}"
+            )
+            raise HybridESMBenchException(msg)
+        logger.debug(f"Found {len(nc_files)} files for variable '{var_name}'")
+        return self._load_fixed_variable(nc_files, var_name, mip_table)
+
+    def _get_variable_files(
+        self,
+        var_name: str,
+        mip_table: str,
+    ) -> tuple[Path, ...]:
+        """Get all files of a variable."""
+        return tuple(f["path"] for f in self._inventory.get_files(var_name))
 
-        xr_ds = self._load_files(nc_files).copy()
+    def _fix_variable(
+        self,
+        files: str | tuple[Path, ...],
+        var_name: str,
+        mip_table: str,
+    ) -> Cube:
+        """Load files and fix variable."""
+        xr_ds = self._load_files(files).copy()
         cubes = cubes_from_xarray(xr_ds)
 
         # Run automatic fixes on data (there is no specific fix for
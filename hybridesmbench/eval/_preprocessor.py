@@ -0,0 +1,1223 @@
+"""Plan and run preprocessing chains of diagnostics."""
+
+import functools
+import threading
+import warnings
+from collections.abc import Callable, Hashable, Mapping
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, TypeVar
+
+import dask
+import dask.array as da
+import esmvalcore.preprocessor
+import numpy as np
+from iris.cube import Cube
+from loguru import logger
+
+from hybridesmbench import _utils
+from hybridesmbench.eval import _regrid
+from hybridesmbench.eval._loaders import Loader
+from hybridesmbench.exceptions import (
+    HybridESMBenchException,
+    HybridESMBenchWarning,
+)
+from hybridesmbench.typing import ChunkHint, PreprocessingMode
+
+PreprocessorStep = tuple[str, dict[str, Any]]
+"""Single preprocessor step given by name of function and its settings."""
+
+_NodeKey = tuple[Hashable, ...]
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+# Horizontal preprocessor steps that are linear in the input data at every
+# time step (if used with the given settings)
+_LINEAR_HORIZONTAL_STEPS: dict[str, tuple[str, set[str]]] = {
+    "area_statistics": ("operator", {"mean"}),
+    "meridional_statistics": ("operator", {"mean"}),
+    "regrid": ("scheme", {"area_weighted", "linear", "nearest"}),
+    "zonal_mean": ("scheme", {"area_weighted", "linear", "nearest"}),
+    "zonal_statistics": ("operator", {"mean"}),
+}
+
+# Preprocessor steps that select or linearly reduce time steps independently
+# of the horizontal grid (if used with the given settings)
+_LINEAR_TIME_STEPS: dict[str, tuple[str, set[str]] | None] = {
+    "annual_statistics": ("operator", {"mean"}),
+    "climate_statistics": ("operator", {"mean"}),
+    "extract_final_20_years": None,
+    "extract_years": None,
+    "monthly_statistics": ("operator", {"mean"}),
+    "seasonal_statistics": ("operator", {"mean"}),
+}
+
+# Vertical interpolation usually introduces time-dependent masks (e.g., for
+# pressure levels below the surface); with those, a time mean does not commute
+# with horizontal regridding anymore
+_VERTICAL_INTERPOLATION_STEPS = (
+    "extract_levels",
+    "extract_merged_levels",
+    "extract_vertical_level",
+)
+
+# Preprocessor steps that only select time steps; these commute with any
+# preprocessor step that is applied to every time step independently
+_TIME_SELECTION_STEPS = ("extract_final_20_years", "extract_years")
+
+# Preprocessor steps that aggregate over time steps
+_TIME_REDUCTION_STEPS = (
+    "annual_statistics",
+    "climate_statistics",
+    "daily_statistics",
+    "decadal_statistics",
+    "hourly_statistics",
+    "monthly_statistics",
+    "seasonal_statistics",
+)
+
+# Preprocessor steps that aggregate over the horizontal grid; afterwards, the
+# chunks of the loaded data along time and vertical dimensions do not matter
+# anymore
+_HORIZONTAL_REDUCTION_STEPS = (
+    "area_statistics",
+    "meridional_statistics",
+    "zonal_mean",
+    "zonal_statistics",
+)
+
+
+def _is_linear(
+    step: PreprocessorStep,
+    steps: Mapping[str, tuple[str, set[str]] | None],
+) -> bool:
+    """Check if preprocessor step is linear with respect to the input data."""
+    (name, settings) = step
+    if name not in steps:
+        return False
+    if (requirement := steps[name]) is None:
+        return True
+    (option, allowed_values) = requirement
+    return settings.get(option) in allowed_values
+
+
+def _is_vertical_interpolation(
+    var_dict: dict[str, str],
+    step: PreprocessorStep,
+) -> bool:
+    """Check if preprocessor step is a vertical interpolation."""
+    (name, settings) = step
+    if name not in _VERTICAL_INTERPOLATION_STEPS:
+        return False
+    # extract_vertical_level is a no-op if var_id is the variable name
+    return name != "extract_vertical_level" or settings.get(
+        "var_id"
+    ) != var_dict.get("var_name")
+
+
+def _has_vertical_interpolation(
+    var_dict: dict[str, str],
+    steps: list[PreprocessorStep],
+) -> bool:
+    """Check if preprocessing chain contains a vertical interpolation."""
+    return any(_is_vertical_interpolation(var_dict, step) for step in steps)
+
+
+def get_chunk_hints(
+    var_dict: dict[str, str],
+    steps: list[PreprocessorStep],
+) -> set[ChunkHint]:
+    """Get dimensions along which the loaded data should not be chunked.
+
+    These are the dimensions that are reduced (e.g., time for climatologies)
+    or interpolated (e.g., vertical levels) by the preprocessing chain before
+    the data is aggregated over the horizontal grid. Loading data with chunks
+    that span these dimensions entirely avoids aggregation across chunks.
+
+    Parameters
+    ----------
+    var_dict:
+        Keyword arguments for :meth:`Loader.load_variable`.
+    steps:
+        Preprocessor steps applied to the loaded variable.
+
+    Returns
+    -------
+    set[ChunkHint]
+        Chunk hints for :meth:`Loader.load_variable`.
+
+    """
+    chunk_hints: set[ChunkHint] = set()
+    for step in steps:
+        if step[0] in _HORIZONTAL_REDUCTION_STEPS:
+            break
+        if step[0] in _TIME_REDUCTION_STEPS:
+            chunk_hints.add("time")
+        elif _is_vertical_interpolation(var_dict, step):
+            chunk_hints.add("vertical")
+    return chunk_hints
+
+
+def reduce_before_regrid(
+    var_dict: dict[str, str],
+    steps: list[PreprocessorStep],
+) -> list[PreprocessorStep]:
+    """Move time selections and time means in front of horizontal steps.
+
+    Area-weighted (or linear) regridding, spatial means and time means are
+    all linear. Thus, for data with a time-independent mask, the time
+    reduction can be applied first on the native model grid, so that only a
+    single (or a few) fields need to be regridded instead of every time step.
+    The reordered steps must only be used for such data (see
+    :func:`has_time_invariant_mask`).
+
+    Parameters
+    ----------
+    var_dict:
+        Keyword arguments for :meth:`Loader.load_variable`.
+    steps:
+        Preprocessor steps applied to the loaded variable.
+
+    Returns
+    -------
+    list[PreprocessorStep]
+        Equivalent preprocessor steps in optimized order. These are identical
+        to `steps` if no mathematically equivalent reordering is possible.
+
+    """
+    steps = list(steps)
+    if _has_vertical_interpolation(var_dict, steps):
+        return steps
+    reordered = True
+    while reordered:
+        reordered = False
+        for idx in range(len(steps) - 1):
+            horizontal = _is_linear(steps[idx], _LINEAR_HORIZONTAL_STEPS)
+            time = _is_linear(steps[idx + 1], _LINEAR_TIME_STEPS)
+            if horizontal and time:
+                (steps[idx], steps[idx + 1]) = (steps[idx + 1], steps[idx])
+                reordered = True
+    return steps
+
+
+def has_time_invariant_mask(cube: Cube) -> bool:
+    """Check if the mask of the data is identical for all time steps.
+
+    This computes the mask of the entire data.
+
+    Parameters
+    ----------
+    cube:
+        Input data.
+
+    Returns
+    -------
+    bool
+        `True` if the mask does not change over time (or if the data has no
+        time dimension), `False` otherwise.
+
+    """
+    if not cube.coords("time", dim_coords=True):
+        return True
+    time_dim = cube.coord_dims("time")[0]
+    mask = da.ma.getmaskarray(cube.lazy_data())
+    first_mask = mask[(slice(None),) * time_dim + (slice(0, 1),)]
+    return not bool(da.any(mask != first_mask).compute())
+
+
+def _get_vertical_levels(
+    var_dict: dict[str, str],
+    step: PreprocessorStep,
+) -> tuple[dict[str, Any], list[float]] | None:
+    """Get settings and target levels of vertical interpolation step.
+
+    Returns `None` if `step` is not a vertical interpolation or if its target
+    levels are not strictly monotonic.
+
+    """
+    (name, settings) = step
+    if name == "extract_vertical_level":
+        level = _utils.get_vertical_level(
+            settings["var_id"], var_dict["var_name"]
+        )
+        if level is None:
+            return None
+        settings = {k: v for (k, v) in settings.items() if k != "var_id"}
+        settings.setdefault("scheme", "linear")
+        return (settings, [level])
+    if name == "extract_levels":
+        levels = [float(lev) for lev in np.ravel(settings["levels"])]
+        diffs = np.diff(levels)
+        if not levels or not (np.all(diffs > 0.0) or np.all(diffs < 0.0)):
+            return None
+        settings = {k: v for (k, v) in settings.items() if k != "levels"}
+        return (settings, levels)
+    return None
+
+
+def merge_vertical_levels(
+    var_dict: dict[str, str],
+    steps: list[PreprocessorStep],
+) -> list[PreprocessorStep]:
+    """Move vertical interpolation to a shared step in front of the chain.
+
+    Vertical interpolation is applied to every time step independently, so it
+    commutes with time selections (e.g., :func:`_utils.extract_years`). If a
+    chain only selects time steps before its vertical interpolation, a step
+    ``extract_merged_levels`` is inserted at the beginning of the chain that
+    interpolates to the union of all levels that are requested for the
+    variable (see :meth:`PreprocessingPlanner.add`). This step is identical
+    for all chains of the variable, so the interpolation only runs once; the
+    original vertical interpolation step then simply extracts the requested
+    levels from its result.
+
+    Parameters
+    ----------
+    var_dict:
+        Keyword arguments for :meth:`Loader.load_variable`.
+    steps:
+        Preprocessor steps applied to the loaded variable.
+
+    Returns
+    -------
+    list[PreprocessorStep]
+        Equivalent preprocessor steps. These are identical to `steps` if the
+        vertical interpolation cannot be moved.
+
+    """
+    for step in steps:
+        if step[0] in _TIME_SELECTION_STEPS:
+            continue
+        if (vertical_levels := _get_vertical_levels(var_dict, step)) is None:
+            break
+        (settings, levels) = vertical_levels
+
+        # Levels are merged separately for ascending and descending lists
+        # since extracting levels preserves their order
+        merged_step = (
+            "extract_merged_levels",
+            {**settings, "descending": levels[0] >= levels[-1]},
+        )
+        return [merged_step, *steps]
+    return list(steps)
+
+
+def _get_required_years(
+    steps: list[PreprocessorStep],
+) -> tuple[int | None, int | None]:
+    """Get first and last year required by chain (`None` means unbounded)."""
+    if steps and steps[0][0] == "extract_years":
+        settings = steps[0][1]
+        return (settings.get("start_year"), settings.get("end_year"))
+    return (None, None)
+
+
+def _matches_grid(cell_area: Cube, cube: Cube) -> bool:
+    """Check if cell areas match the horizontal grid of the data."""
+    first_dim = cube.ndim - cell_area.ndim
+    if first_dim < 0 or cube.shape[first_dim:] != cell_area.shape:
+        return False
+    for coord_name in ("latitude", "longitude"):
+        if not (cube.coords(coord_name) and cell_area.coords(coord_name)):
+            continue
+        points = cube.coord(coord_name).core_points()
+        cell_area_points = cell_area.coord(coord_name).core_points()
+        if points.shape != cell_area_points.shape:
+            return False
+        diff = np.asarray(points) - np.asarray(cell_area_points)
+        if coord_name == "longitude":
+            diff = (diff + 180.0) % 360.0 - 180.0
+        if not np.allclose(diff, 0.0, atol=1e-4):
+            return False
+    return True
+
+
+def _synchronized(method: _F) -> _F:
+    """Run method while holding the lock of the instance."""
+
+    @functools.wraps(method)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper  # type: ignore
+
+
+def _freeze(value: Any) -> Hashable:
+    """Convert value into a hashable object that can be used as key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for (k, v) in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class PreprocessingPlanner:
+    """Plan and run preprocessing chains of diagnostics.
+
+    The preprocessing chain of a single variable starts with loading the
+    variable and continues with a list of preprocessor steps (see
+    :attr:`PreprocessorStep`). Chains of all variables and diagnostics are
+    registered with :meth:`add` before any diagnostic is run. Common prefixes
+    of these chains (e.g., load, extraction of years and vertical levels,
+    regridding) are then only evaluated once and their results are shared by
+    all chains that contain them.
+
+    If all chains of a variable start with :func:`_utils.extract_years`, only
+    files that contain the union of the requested years are loaded.
+
+    Vertical interpolation of a variable is run only once for the union of
+    all levels requested by any chain (see :func:`merge_vertical_levels`).
+
+    Each variable is loaded with chunks that match the reductions of all its
+    chains (see :func:`get_chunk_hints`), e.g., with chunks that span the
+    entire time axis if a climatology is calculated from it.
+
+    If the loader provides grid cell areas (see :meth:`Loader.load_cell_area`)
+    and they match the horizontal grid of the data, these are used as weights
+    for :func:`esmvalcore.preprocessor.area_statistics` and
+    :func:`_regrid.zonal_mean`. Thus, area statistics and zonal means can be
+    calculated on the native model grid without any regridding. Otherwise,
+    the data is regridded first (for area statistics, only if the setting
+    ``fallback_regrid`` with the arguments of the regridding is given).
+
+    All public methods are thread-safe, i.e., a single planner can be shared
+    by diagnostics that run concurrently in multiple threads.
+
+    Preprocessor steps are run as ``function(cube, **settings)``. Functions
+    are taken from :mod:`hybridesmbench._utils` or
+    :mod:`esmvalcore.preprocessor` (in this order).
+
+    Parameters
+    ----------
+    loader:
+        Loader instance of hybrid Earth system model output.
+    mode:
+        Preprocessing mode. If ``"default"``, run all preprocessor steps in
+        the order given by the diagnostics. If ``"optimized"``, reorder steps
+        where this is mathematically equivalent (see
+        :func:`reduce_before_regrid`); reordered chains of variables whose
+        mask changes over time (this is checked once per variable, see
+        :func:`has_time_invariant_mask`) are run in the default order
+        without sharing results. If ``"check"``, run the default order,
+        additionally run the optimized order and warn if the results do not
+        match within `check_rtol`; the results of the default order are used.
+    max_persist_bytes:
+        Shared intermediate results at which chains branch off are computed
+        once and kept in memory as long as the total size of all computed
+        results kept in memory does not exceed this value. All other results
+        (e.g., data on the native model grid) are only shared lazily.
+    check_rtol:
+        Relative tolerance used to compare results if ``mode="check"``. The
+        absolute tolerance is this value times the maximum absolute value of
+        the result.
+    cache_dir:
+        Directory used to persistently cache regridding weights across runs.
+        If `None`, weights are only cached in memory.
+    batch_regrid:
+        If `True`, regrid all chains that are about to run (see
+        :meth:`prefetch`) with identical regridding steps and source grids at
+        once (see :func:`_regrid.regrid_batch`) as soon as the first of them
+        needs to be regridded. The results are computed and kept in memory
+        within the limit given by `max_persist_bytes`.
+    merge_levels:
+        If `True`, interpolate each variable only once to all vertical levels
+        requested by the registered chains (see
+        :func:`merge_vertical_levels`).
+
+    """
+
+    def __init__(
+        self,
+        loader: Loader,
+        *,
+        mode: PreprocessingMode = "default",
+        max_persist_bytes: int = 1024**3,
+        check_rtol: float = 1e-5,
+        cache_dir: Path | None = None,
+        batch_regrid: bool = True,
+        merge_levels: bool = True,
+    ) -> None:
+        """Initialize class instance."""
+        if mode not in ("default", "optimized", "check"):
+            msg = (
+                f"Got invalid preprocessing mode '{mode}', must be one of "
+                f"['default', 'optimized', 'check']"
+            )
+            raise HybridESMBenchException(msg)
+        self._loader = loader
+        self._lock = threading.RLock()
+        self._mode = mode
+        self._max_persist_bytes = max_persist_bytes
+        self._check_rtol = check_rtol
+        self._batch_regrid = batch_regrid
+        self._merge_levels = merge_levels
+        self._consumers: dict[_NodeKey, int] = {}
+        self._cache: dict[_NodeKey, Cube] = {}
+        self._persisted_nbytes: dict[_NodeKey, int] = {}
+        self._computing: dict[_NodeKey, threading.Event] = {}
+        self._active: dict[_NodeKey, int] = {}
+        self._chains: dict[
+            _NodeKey, tuple[dict[str, str], list[PreprocessorStep]]
+        ] = {}
+        self._required_years: dict[Hashable, tuple[int | None, int | None]] = (
+            {}
+        )
+        self._merged_levels: dict[Hashable, set[float]] = {}
+        self._chunk_hints: dict[Hashable, set[ChunkHint]] = {}
+        self._mask_checks: dict[Hashable, Future[bool]] = {}
+
+        # Preprocessor functions that are overwritten by the planner
+        regrid_kwargs: dict[str, Any] = {}
+        if cache_dir is not None:
+            regrid_kwargs["cache_dir"] = cache_dir
+            regrid_kwargs["grid_id"] = loader.grid_id
+        self._regrid_kwargs = regrid_kwargs
+        self._functions: dict[str, Callable[..., Any]] = {
+            "regrid": functools.partial(_regrid.regrid, **regrid_kwargs),
+            "regrid_batch": functools.partial(
+                _regrid.regrid_batch, **regrid_kwargs
+            ),
+            "area_statistics": self._area_statistics,
+            "extract_merged_levels": self._extract_merged_levels,
+            "zonal_mean": self._zonal_mean,
+        }
+
+    @property
+    def loader(self) -> Loader:
+        """Get loader instance."""
+        return self._loader
+
+    @property
+    def lock(self) -> threading.RLock:
+        """Get (reentrant) lock that protects the internal state.
+
+        This can be used to run multiple operations atomically. It is only
+        held for the bookkeeping of chains and shared results. It must not be
+        held while calling :meth:`load_variable` or :meth:`preprocess`, which
+        load data and run preprocessor steps without holding the lock and may
+        wait for other threads.
+
+        """
+        return self._lock
+
+    @property
+    def mode(self) -> PreprocessingMode:
+        """Get preprocessing mode."""
+        return self._mode
+
+    @_synchronized
+    def add(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> None:
+        """Register preprocessing chain of a single variable.
+
+        Parameters
+        ----------
+        var_dict:
+            Keyword arguments for :meth:`Loader.load_variable`.
+        steps:
+            Preprocessor steps applied to the loaded variable.
+
+        """
+        final_steps = self._get_steps(var_dict, steps)
+        for idx, key in enumerate(self._get_node_keys(var_dict, final_steps)):
+            self._consumers[key] = self._consumers.get(key, 0) + 1
+            self._chains.setdefault(key, (var_dict, final_steps[:idx]))
+
+        # Vertical levels that are needed for this variable
+        if final_steps and final_steps[0][0] == "extract_merged_levels":
+            levels_key = (var_dict["var_name"], _freeze(final_steps[0][1]))
+            for step in final_steps[1:]:
+                vertical_levels = _get_vertical_levels(var_dict, step)
+                if vertical_levels is not None:
+                    self._merged_levels.setdefault(levels_key, set()).update(
+                        vertical_levels[1]
+                    )
+                    break
+
+        # Dimensions that should not be chunked for this variable
+        var_key = _freeze(var_dict)
+        self._chunk_hints.setdefault(var_key, set()).update(
+            get_chunk_hints(var_dict, final_steps)
+        )
+
+        # Years of data that need to be loaded for this variable
+        (start_year, end_year) = _get_required_years(steps)
+        if var_key in self._required_years:
+            (other_start_year, other_end_year) = self._required_years[var_key]
+            if start_year is not None and other_start_year is not None:
+                start_year = min(start_year, other_start_year)
+            else:
+                start_year = None
+            if end_year is not None and other_end_year is not None:
+                end_year = max(end_year, other_end_year)
+            else:
+                end_year = None
+        self._required_years[var_key] = (start_year, end_year)
+
+    @_synchronized
+    def discard(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> None:
+        """Unregister preprocessing chain of a single variable.
+
+        This releases cached intermediate results that are no longer needed.
+
+        Parameters
+        ----------
+        var_dict:
+            Keyword arguments for :meth:`Loader.load_variable`.
+        steps:
+            Preprocessor steps applied to the loaded variable.
+
+        """
+        steps = self._get_steps(var_dict, steps)
+        keys = self._get_node_keys(var_dict, steps)
+        self._deactivate(keys[-1])
+        for key in keys:
+            if key not in self._consumers:
+                continue
+            self._consumers[key] -= 1
+            if self._consumers[key] < 1:
+                self._consumers.pop(key)
+                self._chains.pop(key, None)
+                self._persisted_nbytes.pop(key, None)
+                if self._cache.pop(key, None) is not None:
+                    logger.debug(f"Released shared result {self._str(key)}")
+
+    def load_variable(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> tuple[Cube, int]:
+        """Load variable.
+
+        If possible, this returns the latest cached intermediate result of the
+        preprocessing chain instead of the raw variable. The variable is
+        loaded without holding :attr:`lock`.
+
+        Parameters
+        ----------
+        var_dict:
+            Keyword arguments for :meth:`Loader.load_variable`.
+        steps:
+            Preprocessor steps applied to the loaded variable.
+
+        Returns
+        -------
+        tuple[Cube, int]
+            Data and number of preprocessor steps that have already been
+            applied to it.
+
+        """
+        if not self._can_reorder(var_dict, steps):
+            return (self._load_raw_variable(var_dict), 0)
+        with self._lock:
+            steps = self._get_steps(var_dict, steps)
+        return self._load_variable(var_dict, steps)
+
+    def _load_variable(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> tuple[Cube, int]:
+        """Load variable (preprocessor steps need to be final already)."""
+        keys = self._get_node_keys(var_dict, steps)
+        with self._lock:
+            for idx in range(len(keys) - 1, 0, -1):
+                if keys[idx] in self._cache:
+                    logger.debug(f"Using shared result {self._str(keys[idx])}")
+                    cube = self._cache[keys[idx]].copy()
+                    break
+            else:
+                (cube, idx) = (None, 0)
+            load_kwargs = self._get_load_kwargs(var_dict)
+        if cube is not None:
+            self._loader.cancel_prefetch(**load_kwargs)
+            return (cube, idx)
+        return (self._load_raw_variable(var_dict), 0)
+
+    def _load_raw_variable(self, var_dict: dict[str, str]) -> Cube:
+        """Load variable with loader (only required years if possible)."""
+        with self._lock:
+            load_kwargs = self._get_load_kwargs(var_dict)
+            chunk_hints = tuple(self._chunk_hints.get(_freeze(var_dict), ()))
+        return self._loader.load_variable(
+            **load_kwargs, chunk_hints=chunk_hints
+        )
+
+    def _get_load_kwargs(self, var_dict: dict[str, str]) -> dict[str, Any]:
+        """Get keyword arguments to load only required years of variable."""
+        (start_year, end_year) = self._required_years.get(
+            _freeze(var_dict), (None, None)
+        )
+        kwargs: dict[str, Any] = dict(var_dict)
+        if start_year is not None:
+            kwargs["start_year"] = start_year
+        if end_year is not None:
+            kwargs["end_year"] = end_year
+        return kwargs
+
+    @_synchronized
+    def prefetch(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> None:
+        """Load variable in the background (see :meth:`Loader.prefetch`).
+
+        This also marks the preprocessing chain as about to run, which makes
+        it eligible for batched regridding (until it is processed or
+        discarded). Nothing is prefetched if a
+        cached intermediate result of the preprocessing chain is available
+        already.
+
+        Parameters
+        ----------
+        var_dict:
+            Keyword arguments for :meth:`Loader.load_variable`.
+        steps:
+            Preprocessor steps applied to the loaded variable.
+
+        """
+        keys = self._get_node_keys(var_dict, self._get_steps(var_dict, steps))
+        self._active[keys[-1]] = self._active.get(keys[-1], 0) + 1
+        if any(key in self._cache for key in keys[1:]):
+            return
+        self._loader.prefetch(**self._get_load_kwargs(var_dict))
+
+    @_synchronized
+    def cancel_prefetch(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> None:
+        """Cancel prefetch request of variable (see :meth:`prefetch`).
+
+        The preprocessing chain stays registered (and marked as about to run)
+        until it is discarded (see :meth:`discard`).
+
+        Parameters
+        ----------
+        var_dict:
+            Keyword arguments for :meth:`Loader.load_variable`.
+        steps:
+            Preprocessor steps applied to the loaded variable.
+
+        """
+        self._loader.cancel_prefetch(**self._get_load_kwargs(var_dict))
+
+    def preprocess(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+        cube: Cube,
+        n_applied: int = 0,
+    ) -> Cube:
+        """Run remaining preprocessor steps on data.
+
+        Intermediate results that are shared with other registered chains are
+        cached. Afterwards, the chain is unregistered (see :meth:`discard`).
+
+        :attr:`lock` is only held to look up and register shared results.
+        Preprocessor steps (including the loading of other variables for
+        batched regridding) and computations of shared results run without
+        holding it. Threads that need a shared result which is currently
+        built by another thread wait for it.
+
+        Parameters
+        ----------
+        var_dict:
+            Keyword arguments for :meth:`Loader.load_variable`.
+        steps:
+            Preprocessor steps applied to the loaded variable.
+        cube:
+            Input data as returned by :meth:`load_variable`.
+        n_applied:
+            Number of preprocessor steps that have already been applied to
+            `cube` as returned by :meth:`load_variable`.
+
+        Returns
+        -------
+        Cube
+            Preprocessed data.
+
+        """
+        original_steps = steps
+        with self._lock:
+            steps = self._get_steps(var_dict, steps)
+        keys = self._get_node_keys(var_dict, steps)
+        batched: set[_NodeKey] = set()
+        try:
+            if not self._can_reorder(var_dict, original_steps):
+                default_steps = self._get_steps(
+                    var_dict, original_steps, reorder=False
+                )
+                for name, settings in default_steps[n_applied:]:
+                    cube = self._get_function(name)(cube, **settings)
+                return cube
+            idx = n_applied
+            while idx < len(steps):
+                (cube, idx) = self._run_step(keys, steps, cube, idx, batched)
+        finally:
+            self.discard(var_dict, original_steps)
+        if self._mode == "check":
+            self._check_optimized_steps(var_dict, steps, cube)
+        return cube
+
+    def _run_step(
+        self,
+        keys: list[_NodeKey],
+        steps: list[PreprocessorStep],
+        cube: Cube,
+        idx: int,
+        batched: set[_NodeKey],
+    ) -> tuple[Cube, int]:
+        """Apply preprocessor step `idx` to `cube` (or use its shared result).
+
+        Returns the data and the index of the next step that needs to be
+        applied to it (which is still `idx` if the step needs to be retried,
+        e.g., after waiting for another thread). `batched` contains all
+        regridding steps for which batched regridding has been tried already.
+
+        """
+        key = keys[idx + 1]
+        (name, settings) = steps[idx]
+        batch: list[_NodeKey] = []
+        with self._lock:
+            if key in self._cache:
+                return (self._cache[key].copy(), idx + 1)
+            event = self._computing.get(key)
+            if event is None:
+                if name == "regrid" and key not in batched:
+                    batched.add(key)
+                    batch = self._claim_regrid_batch(key)
+                shared = self._consumers.get(key, 0) > 1
+                if shared and not batch:
+                    self._computing[key] = threading.Event()
+
+                # Only compute results at which chains branch off; all others
+                # are shared lazily
+                next_key = keys[idx + 2] if idx + 2 < len(keys) else None
+                is_branch = next_key is None or (
+                    self._consumers.get(next_key, 0)
+                    < self._consumers.get(key, 0)
+                )
+        if event is not None:
+            event.wait()
+            return (cube, idx)
+        if batch:
+            self._regrid_batch(key, cube, settings, batch)
+            return (cube, idx)
+
+        try:
+            logger.debug(f"Running preprocessor step '{name}'")
+            result = self._get_function(name)(cube, **settings)
+        except BaseException:
+            if shared:
+                self._release([key])
+            raise
+        if not shared:
+            return (result, idx + 1)
+        self._share([(key, result, is_branch)])
+        return (cube, idx)
+
+    def _share(self, results: list[tuple[_NodeKey, Cube, bool]]) -> None:
+        """Publish shared results in the cache.
+
+        Results need to be registered as being built by the calling thread
+        (see :attr:`_computing`). Results whose third element is `True` are
+        computed (together) and kept in memory if the memory limit allows it;
+        all others are shared lazily. Must be called without holding
+        :attr:`lock`.
+
+        """
+        to_persist: list[tuple[_NodeKey, Cube]] = []
+        with self._lock:
+            for key, cube, compute in results:
+                if compute and self._reserve_persist(key, cube):
+                    logger.debug(f"Computing shared result {self._str(key)}")
+                    to_persist.append((key, cube))
+                    continue
+                if key in self._consumers:
+                    self._cache[key] = cube
+                self._computing.pop(key).set()
+        computed = False
+        try:
+            self._persist([c for (_, c) in to_persist])
+            computed = True
+        finally:
+            with self._lock:
+                for key, cube in to_persist:
+                    self._computing.pop(key).set()
+                    if computed and key in self._consumers:
+                        self._cache[key] = cube
+                    else:
+                        self._persisted_nbytes.pop(key, None)
+
+    def _release(self, keys: list[_NodeKey]) -> None:
+        """Release results that have not been published by the caller.
+
+        Threads that wait for them then build the results themselves.
+
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._computing:
+                    self._computing.pop(key).set()
+
+    def _check_optimized_steps(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+        cube: Cube,
+    ) -> None:
+        """Check that optimized preprocessor steps give identical results."""
+        optimized_steps = reduce_before_regrid(var_dict, steps)
+        if optimized_steps == steps:
+            return
+        chain = self._str(self._get_node_keys(var_dict, optimized_steps)[-1])
+        logger.debug(f"Checking optimized preprocessing chain {chain}")
+        optimized_cube = self._load_raw_variable(var_dict)
+        for name, settings in optimized_steps:
+            optimized_cube = self._get_function(name)(
+                optimized_cube, **settings
+            )
+
+        expected = np.ma.masked_invalid(cube.data)
+        result = np.ma.masked_invalid(optimized_cube.data)
+        atol = self._check_rtol * float(np.ma.max(np.ma.abs(expected)) or 0.0)
+        if expected.shape == result.shape and (
+            np.array_equal(
+                np.ma.getmaskarray(expected), np.ma.getmaskarray(result)
+            )
+            and np.ma.allclose(
+                expected, result, rtol=self._check_rtol, atol=atol
+            )
+        ):
+            logger.debug(f"Optimized preprocessing chain {chain} is valid")
+            return
+        msg = (
+            f"Optimized preprocessing chain {chain} gives different results "
+            f"than the default order of preprocessor steps for variable "
+            f"'{var_dict.get('var_name')}', using results of the default "
+            f"order"
+        )
+        warnings.warn(msg, HybridESMBenchWarning, stacklevel=2)
+
+    def _can_reorder(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> bool:
+        """Check if the preprocessor steps can be run in their planned order.
+
+        Reordered steps (see :func:`reduce_before_regrid`) require a
+        time-invariant mask, which is only checked once per variable. Must be
+        called without holding :attr:`lock`.
+
+        """
+        if self._get_steps(var_dict, steps) == self._get_steps(
+            var_dict, steps, reorder=False
+        ):
+            return True
+        var_key = _freeze(var_dict)
+        with self._lock:
+            future = self._mask_checks.get(var_key)
+            if future is None:
+                future = Future()
+                self._mask_checks[var_key] = future
+                is_checking = True
+            else:
+                is_checking = False
+        if not is_checking:
+            return future.result()
+        try:
+            result = has_time_invariant_mask(self._load_raw_variable(var_dict))
+        except BaseException as exc:
+            with self._lock:
+                self._mask_checks.pop(var_key)
+            future.set_exception(exc)
+            raise
+        if not result:
+            logger.debug(
+                f"Mask of variable '{var_dict['var_name']}' changes over "
+                f"time, running its reordered preprocessor steps in default "
+                f"order"
+            )
+        future.set_result(result)
+        return result
+
+    def _claim_regrid_batch(self, key: _NodeKey) -> list[_NodeKey]:
+        """Register all active chains with identical regridding step.
+
+        The returned nodes are registered as being built by the calling thread
+        (see :meth:`_regrid_batch`). Returns an empty list if batched
+        regridding is not possible. Must be called while holding
+        :attr:`lock`.
+
+        """
+        if not self._batch_regrid:
+            return []
+        pending_keys = [
+            other_key
+            for other_key in self._consumers
+            if other_key[-1] == key[-1]
+            and other_key not in self._cache
+            and not any(
+                other_key[:n] in self._computing
+                for n in range(2, len(other_key) + 1)
+            )
+            and (other_key == key or self._is_active(other_key))
+        ]
+        if len(pending_keys) < 2:
+            return []
+        for other_key in pending_keys:
+            self._computing[other_key] = threading.Event()
+        return pending_keys
+
+    def _regrid_batch(
+        self,
+        key: _NodeKey,
+        cube: Cube,
+        settings: dict[str, Any],
+        pending_keys: list[_NodeKey],
+    ) -> None:
+        """Regrid all chains with identical regridding step at once.
+
+        `pending_keys` need to be registered with
+        :meth:`_claim_regrid_batch`. The regridded results are published in
+        the cache; if the result for `key` is not among them, the regridding
+        needs to be done regularly. Must be called without holding
+        :attr:`lock`.
+
+        """
+        try:
+            # Get input data of all pending chains and group them by grid
+            groups: dict[str, list[tuple[_NodeKey, Cube]]] = {}
+            for other_key in pending_keys:
+                if other_key == key:
+                    src_cube = cube
+                else:
+                    try:
+                        src_cube = self._run_chain(other_key[:-1])
+                    except Exception as exc:
+                        logger.debug(
+                            f"Cannot regrid {self._str(other_key)} in batch: "
+                            f"{exc}"
+                        )
+                        continue
+                grid_key = _regrid.get_grid_key(src_cube)
+                groups.setdefault(grid_key, []).append((other_key, src_cube))
+
+            regrid_batch = self._get_function("regrid_batch")
+            results: list[tuple[_NodeKey, Cube, bool]] = []
+            for group in groups.values():
+                if len(group) < 2:
+                    continue
+                logger.debug(
+                    f"Regridding {len(group)} variables in batch: "
+                    f"{[self._str(k) for (k, _) in group]}"
+                )
+                try:
+                    regridded_cubes = regrid_batch(
+                        [c for (_, c) in group], **settings
+                    )
+                except ValueError as exc:
+                    logger.debug(f"Batched regridding not possible: {exc}")
+                    continue
+
+                # Compute results together (as long as the memory limit is
+                # not reached) so that the stacked regridding only runs once
+                results.extend(
+                    (other_key, regridded_cube, True)
+                    for ((other_key, _), regridded_cube) in zip(
+                        group, regridded_cubes, strict=True
+                    )
+                )
+            self._share(results)
+        finally:
+            self._release(pending_keys)
+
+    def _run_chain(self, key: _NodeKey) -> Cube:
+        """Run preprocessing chain of node.
+
+        Shared intermediate results are cached lazily (i.e., without computing
+        them) so that other chains do not need to rebuild them. Must be called
+        without holding :attr:`lock`.
+
+        """
+        with self._lock:
+            (var_dict, steps) = self._chains[key]
+        (cube, n_applied) = self._load_variable(var_dict, steps)
+        keys = self._get_node_keys(var_dict, steps)
+        for idx in range(n_applied, len(steps)):
+            (name, settings) = steps[idx]
+            cube = self._get_function(name)(cube, **settings)
+            with self._lock:
+                if (
+                    self._consumers.get(keys[idx + 1], 0) > 1
+                    and keys[idx + 1] not in self._computing
+                ):
+                    cube = self._cache.setdefault(keys[idx + 1], cube).copy()
+        return cube
+
+    @staticmethod
+    def _persist(cubes: list[Cube]) -> None:
+        """Compute lazy data of cubes together and keep it in memory."""
+        if not cubes:
+            return
+        arrays = dask.persist(*[c.lazy_data() for c in cubes])
+        for cube, array in zip(cubes, arrays, strict=True):
+            cube.data = array
+
+    def _reserve_persist(self, key: _NodeKey, cube: Cube) -> bool:
+        """Reserve memory to keep computed shared result in memory.
+
+        Returns `False` if the result cannot be computed because it is not
+        lazy or the total size of computed results would exceed the limit.
+
+        """
+        if not cube.has_lazy_data():
+            return False
+        nbytes = cube.lazy_data().nbytes
+        total_nbytes = sum(self._persisted_nbytes.values())
+        if total_nbytes + nbytes > self._max_persist_bytes:
+            logger.debug(
+                f"Sharing result {self._str(key)} lazily ({total_nbytes} of "
+                f"{self._max_persist_bytes} bytes for computed results in "
+                f"use)"
+            )
+            return False
+        self._persisted_nbytes[key] = nbytes
+        return True
+
+    def _is_active(self, key: _NodeKey) -> bool:
+        """Check if node is part of a chain that is about to run."""
+        return any(chain_key[: len(key)] == key for chain_key in self._active)
+
+    def _deactivate(self, chain_key: _NodeKey) -> None:
+        """Mark chain as no longer about to run."""
+        if chain_key not in self._active:
+            return
+        self._active[chain_key] -= 1
+        if self._active[chain_key] < 1:
+            self._active.pop(chain_key)
+
+    def _get_cell_area(self, cube: Cube) -> Cube | None:
+        """Get cell areas of model if they match the grid of the data."""
+        cell_area = self._loader.load_cell_area()
+        if cell_area is None or not _matches_grid(cell_area, cube):
+            return None
+        logger.debug(f"Using cell areas of model for '{cube.var_name}'")
+        return cell_area
+
+    def _area_statistics(
+        self,
+        cube: Cube,
+        *,
+        fallback_regrid: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> Cube:
+        """Calculate area statistics (with cell areas given by loader).
+
+        If no cell areas are available for the grid of the data and
+        `fallback_regrid` is given, the data is regridded with these settings
+        first (ESMValCore cannot calculate cell areas of irregular grids).
+
+        """
+        if not cube.cell_measures("cell_area"):
+            cell_area = self._get_cell_area(cube)
+            if cell_area is not None:
+                cube = esmvalcore.preprocessor.add_supplementary_variables(
+                    cube, [cell_area]
+                )
+            elif fallback_regrid is not None:
+                logger.debug(
+                    f"No cell areas available for '{cube.var_name}', "
+                    f"regridding before calculating area statistics"
+                )
+                cube = self._functions["regrid"](cube, **fallback_regrid)
+        return esmvalcore.preprocessor.area_statistics(cube, **kwargs)
+
+    def _zonal_mean(self, cube: Cube, **kwargs: Any) -> Cube:
+        """Calculate zonal means (with cell areas given by loader)."""
+        return _regrid.zonal_mean(
+            cube,
+            cell_area=self._get_cell_area(cube),
+            **kwargs,
+            **self._regrid_kwargs,
+        )
+
+    def _extract_merged_levels(
+        self,
+        cube: Cube,
+        *,
+        descending: bool,
+        **kwargs: Any,
+    ) -> Cube:
+        """Interpolate to all vertical levels requested for the variable."""
+        settings = {**kwargs, "descending": descending}
+        levels = sorted(
+            self._merged_levels[(cube.var_name, _freeze(settings))],
+            reverse=descending,
+        )
+        logger.debug(
+            f"Extracting {len(levels)} merged vertical levels for variable "
+            f"'{cube.var_name}'"
+        )
+        return esmvalcore.preprocessor.extract_levels(cube, levels, **kwargs)
+
+    def _get_function(self, name: str) -> Callable[..., Any]:
+        """Get preprocessor function."""
+        if name in self._functions:
+            return self._functions[name]
+        for module in (_utils, esmvalcore.preprocessor):
+            if hasattr(module, name):
+                return getattr(module, name)
+        msg = (
+            f"Preprocessor step '{name}' is not available in "
+            f"hybridesmbench._utils or esmvalcore.preprocessor"
+        )
+        raise HybridESMBenchException(msg)
+
+    def _get_steps(
+        self,
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+        reorder: bool = True,
+    ) -> list[PreprocessorStep]:
+        """Get preprocessor steps that are actually run.
+
+        If `reorder` is `False`, do not reorder steps (see
+        :meth:`_can_reorder`).
+
+        """
+        if self._merge_levels:
+            steps = merge_vertical_levels(var_dict, steps)
+        if self._mode == "optimized" and reorder:
+            return reduce_before_regrid(var_dict, steps)
+        return steps
+
+    @staticmethod
+    def _get_node_keys(
+        var_dict: dict[str, str],
+        steps: list[PreprocessorStep],
+    ) -> list[_NodeKey]:
+        """Get keys of all nodes of a chain (element 0 = loaded variable)."""
+        keys: list[_NodeKey] = [(_freeze(var_dict),)]
+        for step in steps:
+            keys.append(keys[-1] + (_freeze(step),))
+        return keys
+
+    @staticmethod
+    def _str(key: _NodeKey) -> str:
+        """Get string representation of node key used for logging."""
+        var_name = dict(key[0]).get("var_name")  # type: ignore
+        step_names = [step[0] for step in key[1:]]  # type: ignore
+        return " -> ".join([f"load({var_name})", *step_names])
@@ -0,0 +1,677 @@
+"""Regrid data with persistently cached regridding weights."""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Any
+
+import dask
+import dask.array as da
+import esmvalcore.preprocessor
+import numpy as np
+import scipy.sparse
+from esmf_regrid.schemes import (
+    ESMFAreaWeightedRegridder,
+    ESMFBilinearRegridder,
+    ESMFNearestRegridder,
+)
+from esmvalcore.iris_helpers import has_irregular_grid
+from esmvalcore.preprocessor._regrid import parse_cell_spec
+from esmvalcore.preprocessor.regrid_schemes import IrisESMFRegrid
+from iris.coords import CellMethod, DimCoord
+from iris.cube import Cube
+from iris.util import guess_coord_axis
+from loguru import logger
+
+# Regridding schemes of ESMValCore for irregular grids and meshes (these are
+# the only ones for which weight computation is expensive)
+_ESMF_METHODS = {
+    "area_weighted": "conservative",
+    "linear": "bilinear",
+    "nearest": "nearest",
+}
+_ESMF_REGRIDDERS: dict[str, type] = {
+    "bilinear": ESMFBilinearRegridder,
+    "conservative": ESMFAreaWeightedRegridder,
+    "nearest": ESMFNearestRegridder,
+}
+
+
+def _get_horizontal_dims(cube: Cube) -> tuple[int, ...]:
+    """Get horizontal dimensions of cube."""
+    if cube.mesh is not None:
+        return (cube.mesh_dim(),)
+    dims = cube.coord_dims("latitude") + cube.coord_dims("longitude")
+    return tuple(sorted(set(dims)))
+
+
+def _hash_coords(cube: Cube) -> str:
+    """Get hash of horizontal coordinates (points and bounds) of cube."""
+    sha256 = hashlib.sha256()
+    for coord_name in ("latitude", "longitude"):
+        coord = cube.coord(coord_name)
+        sha256.update(np.ascontiguousarray(coord.points, dtype=np.float64))
+        if coord.has_bounds():
+            sha256.update(np.ascontiguousarray(coord.bounds, dtype=np.float64))
+    return sha256.hexdigest()
+
+
+class RegridWeightStore:
+    """Persistent store of sparse regridding weights.
+
+    Weights are saved as compressed sparse matrices (one ``.npz`` file per
+    key). If the total size of the store exceeds `max_bytes`, the least
+    recently used weights are removed.
+
+    Parameters
+    ----------
+    cache_dir:
+        Directory where the weights are stored.
+    max_bytes:
+        Maximum total size of the store in bytes.
+
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path,
+        max_bytes: int = 2 * 1024**3,
+    ) -> None:
+        """Initialize class instance."""
+        self._weights_dir = Path(cache_dir).expanduser() / "regrid_weights"
+        self._max_bytes = max_bytes
+
+    @property
+    def weights_dir(self) -> Path:
+        """Get directory where the weights are stored."""
+        return self._weights_dir
+
+    def get(self, key: str) -> scipy.sparse.csr_matrix | None:
+        """Get weights.
+
+        Parameters
+        ----------
+        key:
+            Key of the weights.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix | None
+            Weights. `None` if the weights are not available.
+
+        """
+        path = self._get_path(key)
+        try:
+            weights = scipy.sparse.load_npz(path)
+        except (OSError, ValueError):
+            return None
+
+        # Mark weights as recently used
+        os.utime(path)
+
+        logger.debug(f"Loaded regridding weights from {path}")
+        return scipy.sparse.csr_matrix(weights)
+
+    def put(self, key: str, weights: scipy.sparse.spmatrix) -> None:
+        """Save weights.
+
+        Parameters
+        ----------
+        key:
+            Key of the weights.
+        weights:
+            Weights.
+
+        """
+        self.weights_dir.mkdir(parents=True, exist_ok=True)
+        path = self._get_path(key)
+
+        # Write to temporary file first so that concurrent processes never see
+        # incomplete files
+        with tempfile.NamedTemporaryFile(
+            dir=self.weights_dir, suffix=".npz.tmp", delete=False
+        ) as tmp_file:
+            scipy.sparse.save_npz(
+                tmp_file, scipy.sparse.csr_matrix(weights), compressed=True
+            )
+        os.replace(tmp_file.name, path)
+        logger.debug(f"Saved regridding weights to {path}")
+
+        self._evict()
+
+    def _evict(self) -> None:
+        """Remove least recently used weights if store is too large."""
+        files = []
+        for path in self.weights_dir.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by concurrent process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for (_, size, _) in files)
+        for _, size, path in sorted(files):
+            if total_bytes <= self._max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            logger.debug(f"Removed least recently used weights {path}")
+
+    def _get_path(self, key: str) -> Path:
+        """Get path to weights file."""
+        return self.weights_dir / f"{key}.npz"
+
+
+class CachedIrisESMFRegrid(IrisESMFRegrid):
+    """:class:`IrisESMFRegrid` scheme with persistently cached weights.
+
+    Parameters
+    ----------
+    method:
+        Regridding method.
+    cache_dir:
+        Directory where the weights are stored (see
+        :class:`RegridWeightStore`).
+    grid_id:
+        Unique identifier of the source grid. If `None`, use a hash of the
+        horizontal coordinates of the source cube.
+    max_bytes:
+        Maximum total size of the weight store in bytes.
+    **kwargs:
+        Additional keyword arguments for :class:`IrisESMFRegrid`.
+
+    """
+
+    def __init__(
+        self,
+        method: str,
+        cache_dir: str | Path,
+        grid_id: str | None = None,
+        max_bytes: int = 2 * 1024**3,
+        **kwargs: Any,
+    ) -> None:
+        """Initialize class instance."""
+        super().__init__(method, **kwargs)  # type: ignore
+        self._store = RegridWeightStore(cache_dir, max_bytes=max_bytes)
+        self._grid_id = grid_id
+
+    def regridder(  # type: ignore
+        self,
+        src_cube: Cube,
+        tgt_cube: Cube,
+    ) -> Any:
+        """Create regridder, reusing persistently cached weights.
+
+        Parameters
+        ----------
+        src_cube:
+            Cube defining the source grid.
+        tgt_cube:
+            Cube defining the target grid.
+
+        Returns
+        -------
+        Any
+            An :doc:`esmf_regrid:index` regridder.
+
+        """
+        kwargs = self.kwargs.copy()
+        method = kwargs.pop("method")
+        src_mask = kwargs.pop("use_src_mask")
+        collapse_mask_along = kwargs.pop("collapse_src_mask_along")
+        if src_mask is True:
+            src_mask = self._get_mask(src_cube, collapse_mask_along)
+        tgt_mask = kwargs.pop("use_tgt_mask")
+        collapse_mask_along = kwargs.pop("collapse_tgt_mask_along")
+        if tgt_mask is True:
+            tgt_mask = self._get_mask(tgt_cube, collapse_mask_along)
+        (src_mask, tgt_mask) = dask.compute(src_mask, tgt_mask)
+
+        # Weights depend on grids, masks, and regridding settings
+        grid_id = self._grid_id
+        if grid_id is None:
+            grid_id = _hash_coords(src_cube)
+        sha256 = hashlib.sha256()
+        sha256.update(grid_id.encode())
+        sha256.update(_hash_coords(tgt_cube).encode())
+        sha256.update(repr(sorted(self.kwargs.items())).encode())
+        for mask in (src_mask, tgt_mask):
+            sha256.update(
+                np.packbits(np.atleast_1d(np.asarray(mask, dtype=bool)))
+            )
+        key = sha256.hexdigest()
+
+        regridder_cls = _ESMF_REGRIDDERS[method]
+        weights = self._store.get(key)
+        regridder = regridder_cls(
+            src_cube,
+            tgt_cube,
+            precomputed_weights=weights,
+            use_src_mask=src_mask,
+            use_tgt_mask=tgt_mask,
+            **kwargs,
+        )
+        if weights is None:
+            self._store.put(key, regridder.regridder.weight_matrix)
+        return regridder
+
+
+def regrid(
+    cube: Cube,
+    target_grid: str,
+    scheme: str,
+    *,
+    cache_dir: str | Path | None = None,
+    grid_id: str | None = None,
+    **kwargs: Any,
+) -> Cube:
+    """Regrid data with persistently cached weights.
+
+    Weights are only cached persistently for irregular grids and meshes
+    (e.g., the native ICON grid); all other data is regridded with
+    :func:`esmvalcore.preprocessor.regrid`.
+
+    Parameters
+    ----------
+    cube:
+        Input data.
+    target_grid:
+        Target grid (see :func:`esmvalcore.preprocessor.regrid`).
+    scheme:
+        Regridding scheme (see :func:`esmvalcore.preprocessor.regrid`).
+    cache_dir:
+        Directory where the weights are stored. If `None`, do not cache
+        weights persistently.
+    grid_id:
+        Unique identifier of the source grid. If `None`, use a hash of the
+        horizontal coordinates of `cube`.
+    **kwargs:
+        Additional keyword arguments for
+        :func:`esmvalcore.preprocessor.regrid`.
+
+    Returns
+    -------
+    Cube
+        Regridded data.
+
+    """
+    if (
+        cache_dir is not None
+        and scheme in _ESMF_METHODS
+        and (cube.mesh is not None or has_irregular_grid(cube))
+    ):
+        scheme = {  # type: ignore
+            "reference": f"{__name__}:CachedIrisESMFRegrid",
+            "method": _ESMF_METHODS[scheme],
+            "cache_dir": str(cache_dir),
+            "grid_id": grid_id,
+        }
+    return esmvalcore.preprocessor.regrid(cube, target_grid, scheme, **kwargs)
+
+
+def _uses_src_mask(cube: Cube) -> bool:
+    """Check if regridding schemes derive a source mask from the data."""
+    return cube.mesh is not None or has_irregular_grid(cube)
+
+
+def _get_src_mask(cube: Cube) -> da.Array:
+    """Get source mask derived by the regridding schemes of ESMValCore.
+
+    The mask is collapsed along the vertical dimension; for all other
+    non-horizontal dimensions (e.g., time), the first slice is used.
+
+    """
+    return IrisESMFRegrid._get_mask(cube, ("Z",))
+
+
+def get_grid_key(cube: Cube) -> str:
+    """Get key that identifies the horizontal grid of a cube for regridding.
+
+    Cubes with identical keys can be regridded together with
+    :func:`regrid_batch`. For irregular grids and meshes, this includes the
+    source mask used by the regridding schemes of ESMValCore (which is also
+    used for the batched regridding).
+
+    Parameters
+    ----------
+    cube:
+        Input data.
+
+    Returns
+    -------
+    str
+        Key that identifies the horizontal grid.
+
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(_hash_coords(cube).encode())
+    sha256.update(str(cube.dtype).encode())
+    if _uses_src_mask(cube):
+        mask = _get_src_mask(cube).compute()
+        sha256.update(np.packbits(np.atleast_1d(mask)))
+    return sha256.hexdigest()
+
+
+def _stack_horizontal(
+    cubes: list[Cube],
+    n_dims: int,
+    src_mask: da.Array | None = None,
+) -> Cube:
+    """Stack data of cubes along a new leading dimension.
+
+    All cubes need to have the same horizontal grid given by their last
+    `n_dims` dimensions. The new cube only contains horizontal coordinates.
+    If `src_mask` is given, the first element along the new dimension is a
+    fully masked slice with this mask (regridding schemes derive the source
+    mask from the first slice).
+
+    """
+    template = cubes[0][(0,) * (cubes[0].ndim - n_dims)]
+    arrays = [
+        cube.lazy_data().reshape((-1, *cube.shape[-n_dims:])) for cube in cubes
+    ]
+    if src_mask is not None:
+        mask_slice = da.ma.masked_array(
+            da.zeros(src_mask.shape, dtype=cubes[0].dtype), mask=src_mask
+        )
+        arrays.insert(0, mask_slice[np.newaxis])
+    data = da.concatenate(arrays)
+
+    # The regridder runs once per chunk, so use large chunks along the
+    # stacked dimension (instead of the chunks of the individual cubes)
+    data = data.rechunk({0: "auto", **{d: -1 for d in range(1, n_dims + 1)}})
+    stacked_cube = Cube(data, var_name="stack", units=template.units)
+    stacked_cube.add_dim_coord(
+        DimCoord(np.arange(data.shape[0]), var_name="stack_index"), 0
+    )
+    for coord in template.coords(dim_coords=True):
+        dims = [d + 1 for d in template.coord_dims(coord)]
+        stacked_cube.add_dim_coord(coord.copy(), dims)
+    for coord in template.coords(dim_coords=False):
+        if dims := [d + 1 for d in template.coord_dims(coord)]:
+            stacked_cube.add_aux_coord(coord.copy(), dims)
+    return stacked_cube
+
+
+def _get_regridded_cube(
+    cube: Cube,
+    data: da.Array,
+    grid_cube: Cube,
+    n_dims: int,
+) -> Cube:
+    """Create cube with regridded data.
+
+    Same as the cubes created by the regridding schemes: metadata and all
+    coordinates that do not span the horizontal grid are taken from `cube`,
+    horizontal coordinates are taken from `grid_cube` (whose first dimension
+    is ignored), cell measures and ancillary variables are dropped.
+
+    """
+    n_leading_dims = cube.ndim - n_dims
+    horizontal_dims = set(range(n_leading_dims, cube.ndim))
+    regridded_cube = Cube(data)
+    regridded_cube.metadata = cube.metadata
+    coord_mapping: dict[int, Any] = {}
+    for coord in cube.coords():
+        dims = cube.coord_dims(coord)
+        if set(dims) & horizontal_dims or guess_coord_axis(coord) in (
+            "X",
+            "Y",
+        ):
+            continue
+        new_coord = coord.copy()
+        if coord in cube.coords(dim_coords=True):
+            regridded_cube.add_dim_coord(new_coord, dims)
+        else:
+            regridded_cube.add_aux_coord(new_coord, dims)
+        coord_mapping[id(coord)] = new_coord
+    for coord in grid_cube.coords():
+        dims = tuple(
+            d - 1 + n_leading_dims for d in grid_cube.coord_dims(coord)
+        )
+        if not dims or min(dims) < n_leading_dims:
+            continue
+        if coord in grid_cube.coords(dim_coords=True):
+            regridded_cube.add_dim_coord(coord.copy(), dims)
+        else:
+            regridded_cube.add_aux_coord(coord.copy(), dims)
+    for factory in cube.aux_factories:
+        regridded_cube.add_aux_factory(factory.updated(coord_mapping))
+    return regridded_cube
+
+
+def regrid_batch(
+    cubes: list[Cube],
+    target_grid: str,
+    scheme: str,
+    **kwargs: Any,
+) -> list[Cube]:
+    """Regrid multiple cubes on the same horizontal grid at once.
+
+    The data of all cubes (i.e., all variables, time steps, vertical levels,
+    etc.) is stacked into a single array with shape (N, cells), which is
+    regridded with a single call of the regridder. Thus, the (sparse) weight
+    matrix is only applied once per chunk of the stacked array.
+
+    All cubes need to have the same horizontal grid (see
+    :func:`get_grid_key`) given by their last dimensions. Derived coordinates
+    (e.g., hybrid height) must not depend on horizontal coordinates.
+    Regridders are always cached in memory (i.e., ``cache_weights=True``).
+    For irregular grids and meshes, the source mask of the first cube (see
+    :func:`get_grid_key`) is used for all cubes.
+
+    Parameters
+    ----------
+    cubes:
+        Input data.
+    target_grid:
+        Target grid (see :func:`esmvalcore.preprocessor.regrid`).
+    scheme:
+        Regridding scheme (see :func:`esmvalcore.preprocessor.regrid`).
+    **kwargs:
+        Additional keyword arguments for :func:`regrid`.
+
+    Returns
+    -------
+    list[Cube]
+        Regridded data with lazy data that shares the same regridding
+        computation. Use :func:`dask.persist` on all of them to compute the
+        regridding only once.
+
+    """
+    kwargs["cache_weights"] = True
+    n_dims = len(_get_horizontal_dims(cubes[0]))
+    for cube in cubes:
+        horizontal_dims = _get_horizontal_dims(cube)
+        if horizontal_dims != tuple(range(cube.ndim - n_dims, cube.ndim)):
+            msg = (
+                f"Horizontal dimensions need to be the last dimensions for "
+                f"batched regridding, got {horizontal_dims} for cube\n{cube}"
+            )
+            raise ValueError(msg)
+        for factory in cube.aux_factories:
+            if any(
+                coord is not None
+                and set(cube.coord_dims(coord)) & set(horizontal_dims)
+                for coord in factory.dependencies.values()
+            ):
+                msg = (
+                    f"Derived coordinate '{factory.name()}' depends on "
+                    f"horizontal coordinates, cannot use batched regridding "
+                    f"for cube\n{cube}"
+                )
+                raise ValueError(msg)
+
+    # Regrid stacked data (with the same source mask that is used for the
+    # grid key instead of the mask of the first slice of the first cube)
+    src_mask = _get_src_mask(cubes[0]) if _uses_src_mask(cubes[0]) else None
+    stacked_cube = regrid(
+        _stack_horizontal(cubes, n_dims, src_mask=src_mask),
+        target_grid,
+        scheme,
+        **kwargs,
+    )
+    stacked_data = stacked_cube.lazy_data()
+    tgt_grid_shape = stacked_cube.shape[1:]
+
+    # Split regridded data
+    regridded_cubes = []
+    start = 0 if src_mask is None else 1
+    for cube in cubes:
+        size = int(np.prod(cube.shape[:-n_dims], dtype=int))
+        stop = start + size
+        data = stacked_data[start:stop].reshape(
+            (*cube.shape[:-n_dims], *tgt_grid_shape)
+        )
+        regridded_cubes.append(
+            _get_regridded_cube(cube, data, stacked_cube, n_dims)
+        )
+        start = stop
+    return regridded_cubes
+
+
+def _get_zonal_mean_matrix(
+    lat: np.ndarray,
+    cell_area: np.ndarray,
+    lat_bounds: np.ndarray,
+) -> scipy.sparse.csr_matrix:
+    """Get sparse matrix that sums cell areas into latitude bands."""
+    n_bands = lat_bounds.shape[0]
+    edges = np.append(lat_bounds[:, 0], lat_bounds[-1, 1])
+    bands = np.clip(np.searchsorted(edges, lat, side="right") - 1, 0, None)
+    bands = np.minimum(bands, n_bands - 1)
+    return scipy.sparse.csr_matrix(
+        (cell_area, (bands, np.arange(lat.size))), shape=(n_bands, lat.size)
+    )
+
+
+def _apply_zonal_mean_matrix(
+    block: np.ndarray,
+    matrix: scipy.sparse.csr_matrix,
+) -> np.ndarray:
+    """Apply sparse zonal mean matrix to last dimension of block."""
+    flat_block = np.ma.reshape(block, (-1, block.shape[-1]))
+    valid = ~np.ma.getmaskarray(flat_block)
+    data = np.ma.filled(flat_block, 0.0).astype(np.float64)
+    data[~np.isfinite(data)] = 0.0
+    valid &= np.isfinite(np.ma.getdata(flat_block))
+    weighted_sum = matrix.dot(data.T).T
+    weight = matrix.dot(valid.T.astype(np.float64)).T
+
+    # Bands without any valid cells are masked
+    no_data = weight == 0.0
+    result = np.ma.masked_array(
+        weighted_sum / np.where(no_data, 1.0, weight), mask=no_data
+    )
+    return result.reshape(*block.shape[:-1], matrix.shape[0])
+
+
+def zonal_mean(
+    cube: Cube,
+    target_grid: str,
+    scheme: str,
+    *,
+    cell_area: Cube | None = None,
+    **kwargs: Any,
+) -> Cube:
+    """Calculate area-weighted zonal means in latitude bands of target grid.
+
+    For irregular grids and meshes (e.g., the native ICON grid) with given
+    cell areas, all cells are directly binned into the latitude bands of the
+    target grid by their center latitude. This uses a single sparse matrix
+    that is applied to all time steps and vertical levels at once; no data on
+    the target grid is created.
+
+    In all other cases, the data is regridded to the target grid (see
+    :func:`regrid`) and :func:`esmvalcore.preprocessor.zonal_statistics` is
+    used to calculate the zonal mean.
+
+    Parameters
+    ----------
+    cube:
+        Input data.
+    target_grid:
+        Target grid given as ``MxN`` cell specification (see
+        :func:`esmvalcore.preprocessor.regrid`).
+    scheme:
+        Regridding scheme (see :func:`esmvalcore.preprocessor.regrid`). Only
+        used if the data needs to be regridded.
+    cell_area:
+        Grid cell areas that match the horizontal grid of `cube`.
+    **kwargs:
+        Additional keyword arguments for :func:`regrid`.
+
+    Returns
+    -------
+    Cube
+        Zonal means.
+
+    """
+    horizontal_dims = _get_horizontal_dims(cube)
+    n_dims = len(horizontal_dims)
+    if (
+        cell_area is None
+        or not (cube.mesh is not None or has_irregular_grid(cube))
+        or horizontal_dims != tuple(range(cube.ndim - n_dims, cube.ndim))
+    ):
+        regridded_cube = regrid(cube, target_grid, scheme, **kwargs)
+        return esmvalcore.preprocessor.zonal_statistics(regridded_cube, "mean")
+
+    # Latitude bands given by target grid
+    (_, dlat) = parse_cell_spec(target_grid)
+    n_bands = int(round(180.0 / dlat))
+    lat_coord = DimCoord(
+        np.linspace(-90.0 + dlat / 2.0, 90.0 - dlat / 2.0, n_bands),
+        standard_name="latitude",
+        units="degrees_north",
+        var_name="lat",
+    )
+    lat_coord.guess_bounds()
+    lon_coord = DimCoord(
+        [180.0],
+        bounds=[[0.0, 360.0]],
+        standard_name="longitude",
+        units="degrees_east",
+        var_name="lon",
+    )
+
+    # Zonal means of all time steps and levels at once
+    n_cells = int(np.prod(cube.shape[-n_dims:], dtype=int))
+    lat = cube.coord("latitude")
+    matrix = _get_zonal_mean_matrix(
+        np.ravel(lat.units.convert(lat.points, "degrees_north")),
+        np.ravel(np.ma.filled(cell_area.data, 0.0)),
+        lat_coord.bounds,
+    )
+    logger.debug(
+        f"Calculating zonal means of {n_cells} cells in {n_bands} latitude "
+        f"bands"
+    )
+    src_data = cube.lazy_data()
+    src_data = src_data.rechunk({d: -1 for d in horizontal_dims}).reshape(
+        (*cube.shape[:-n_dims], n_cells)
+    )
+    data = src_data.map_blocks(
+        _apply_zonal_mean_matrix,
+        matrix,
+        chunks=(*src_data.chunks[:-1], (n_bands,)),
+        dtype=np.float64,
+        meta=np.ma.masked_array(np.empty((0,) * src_data.ndim)),
+    ).astype(cube.dtype)
+
+    # Create result cube with all coordinates that do not span horizontal
+    # dimensions
+    zonal_mean_cube = Cube(data)
+    zonal_mean_cube.metadata = cube.metadata
+    for coord in cube.coords():
+        dims = cube.coord_dims(coord)
+        if set(dims) & set(horizontal_dims):
+            continue
+        if coord in cube.coords(dim_coords=True):
+            zonal_mean_cube.add_dim_coord(coord.copy(), dims)
+        else:
+            zonal_mean_cube.add_aux_coord(coord.copy(), dims)
+    zonal_mean_cube.add_dim_coord(lat_coord, cube.ndim - n_dims)
+    zonal_mean_cube.add_aux_coord(lon_coord, ())
+    zonal_mean_cube.add_cell_method(CellMethod("mean", coords="longitude"))
+    return zonal_mean_cube
@@ -1,6 +1,29 @@
 """Provide types for HybridESMBench."""
 
-from typing import Literal
+from typing import Literal, TypedDict
+
+ChunkHint = Literal[
+    "time",
+    "vertical",
+]
+
+ChunkPolicy = Literal[
+    "auto",
+    "reductions",
+    "time",
+]
+
+Compression = Literal[
+    "zlib",
+    "zstd",
+]
+
+DaskScheduler = Literal[
+    "threads",
+    "processes",
+    "local_cluster",
+    "distributed",
+]
 
 DiagnosticName = Literal[
     "maps",
@@ -9,7 +32,33 @@ DiagnosticName = Literal[
     "timeseries",
 ]
 
+ExecutorType = Literal[
+    "thread",
+    "process",
+]
+
 ModelType = Literal[
     "cmip",
     "icon",
 ]
+
+PreprocessingMode = Literal[
+    "default",
+    "optimized",
+    "check",
+]
+
+
+class DaskConfig(TypedDict, total=False):
+    """Configuration of the Dask execution backend (all keys are optional).
+
+    See :func:`hybridesmbench.eval.evaluate` for a description of the keys.
+
+    """
+
+    scheduler: DaskScheduler
+    address: str
+    n_workers: int
+    threads_per_worker: int
+    memory_limit: str | int | None
+    chunks: ChunkPolicy
@@ -3,7 +3,6 @@ import sys
 import warnings
 from pprint import pprint
 
-from distributed import Client
 from loguru import logger
 
 from hybridesmbench.eval import evaluate
@@ -17,14 +16,6 @@ def main():
     logger.add(sys.stdout, colorize=True)
     logging.getLogger("esmvalcore").setLevel(logging.ERROR)
 
-    cluster_kwargs = dict(
-        n_workers=6,
-        threads_per_worker=2,
-        memory_limit="6 GiB",
-    )
-    client = Client(**cluster_kwargs)
-    print("Dask dashboard:", client.dashboard_link)
-
     # modeL_output = (
     #   "/mnt/d/data/icon/ag_atm_amip_r2b5_auto_tuned_baseline_20yrs"
     # )
@@ -53,6 +44,12 @@ def main():
             # diagnostics=["maps", "profiles"],
             # fail_on_diag_error=False,
             fail_on_missing_variable=False,
+            dask_config={
+                "scheduler": "local_cluster",
+                "n_workers": 6,
+                "threads_per_worker": 2,
+                "memory_limit": "6 GiB",
+            },
         )
 
     for diag_name, diag_output in output.items():